@@ -1,9 +1,18 @@
+from homeassistant.core import SupportsResponse
 from homeassistant.helpers import config_validation as cv
+from homeassistant.helpers.reload import async_integration_yaml_config
 from .metadata import MetadataManager
 import voluptuous as vol
 from .run_preprocessor import RunPreprocessor
 from .run_config import DOMAIN, RunConfig
 from .hot_reload_worker import HotReloadWorker
+from .config_reloader import ConfigReloader
+from .preprocessor_worker import LANES, PreprocessorWorker
+from .backup_store import BackupStore
+from .observers import OBSERVER_MODES
+from .utils import get_logger
+
+_LOGGER = get_logger("setup")
 
 def validate_extensions(config):
     render_ext = config.get("render_extensions", [])
@@ -55,10 +64,103 @@ CONFIG_SCHEMA = vol.Schema(
                         cv.positive_int,
                         vol.Range(min=1, max=1000)
                     ),
+                    vol.Optional("batch_budget_secs", default=2): vol.All(
+                        vol.Coerce(float),
+                        vol.Range(min=0, max=3600)
+                    ),
                     vol.Optional("constants", default={}): vol.Schema({cv.string: cv.string}),
                     vol.Optional("hot_reload_extensions", default=[".yaml"]): vol.All(cv.ensure_list, [cv.string]),
+                    vol.Optional("hot_reload_observer", default="native"): vol.In(OBSERVER_MODES),
+                    vol.Optional("hot_reload_scope", default="all"): vol.In(["relevant", "all"]),
+                    vol.Optional("hot_reload_sweep_secs", default=10): vol.All(
+                        cv.positive_int,
+                        vol.Range(min=1, max=3600)
+                    ),
+                    vol.Optional("storm_threshold_events", default=100): vol.All(
+                        vol.Coerce(int),
+                        vol.Range(min=0, max=100000)
+                    ),
+                    vol.Optional("event_trace_file", default=""): cv.string,
+                    vol.Optional("poll_interval_secs", default=2): vol.All(
+                        cv.positive_int,
+                        vol.Range(min=1, max=3600)
+                    ),
+                    vol.Optional("poll_interval_max_secs", default=30): vol.All(
+                        cv.positive_int,
+                        vol.Range(min=1, max=3600)
+                    ),
                     vol.Optional("backup_enabled", default=False): cv.boolean,
                     vol.Optional("backup_directory", default="/config/backup"): cv.isdir,
+                    vol.Optional("backup_retention_count", default=10): vol.All(
+                        vol.Coerce(int),
+                        vol.Range(min=0, max=10000)
+                    ),
+                    vol.Optional("backup_retention_days", default=30): vol.All(
+                        vol.Coerce(int),
+                        vol.Range(min=0, max=3650)
+                    ),
+                    vol.Optional("backup_max_size_mb", default=100): vol.All(
+                        vol.Coerce(int),
+                        vol.Range(min=0, max=102400)
+                    ),
+                    vol.Optional("fragment_cache_size", default=256): vol.All(
+                        vol.Coerce(int),
+                        vol.Range(min=0, max=100000)
+                    ),
+                    vol.Optional("fragment_cache_disk", default=False): cv.boolean,
+                    vol.Optional("streaming_render", default=False): cv.boolean,
+                    vol.Optional("render_cache_size_mb", default=0): vol.All(
+                        vol.Coerce(int),
+                        vol.Range(min=0, max=10240)
+                    ),
+                    vol.Optional("serialize_workers", default=1): vol.All(
+                        cv.positive_int,
+                        vol.Range(min=1, max=32)
+                    ),
+                    vol.Optional("lane_workers", default={}): vol.Schema(
+                        {
+                            vol.In(LANES): vol.All(cv.positive_int, vol.Range(min=1, max=16))
+                        }
+                    ),
+                    vol.Optional("render_timeout_secs", default=0): vol.All(
+                        vol.Coerce(int),
+                        vol.Range(min=0, max=3600)
+                    ),
+                    vol.Optional("cpu_share", default=0): vol.All(
+                        vol.Coerce(float),
+                        vol.Range(min=0, max=64)
+                    ),
+                    vol.Optional("io_rate_mb_secs", default=0): vol.All(
+                        vol.Coerce(float),
+                        vol.Range(min=0, max=10000)
+                    ),
+                    vol.Optional("render_nice", default=0): vol.All(
+                        vol.Coerce(int),
+                        vol.Range(min=0, max=19)
+                    ),
+                    vol.Optional("hot_reload_rate_per_min", default=0): vol.All(
+                        vol.Coerce(int),
+                        vol.Range(min=0, max=100000)
+                    ),
+                    vol.Optional("loop_lag_threshold_ms", default=0): vol.All(
+                        vol.Coerce(int),
+                        vol.Range(min=0, max=60000)
+                    ),
+                    vol.Optional("failure_backoff_secs", default=5): vol.All(
+                        vol.Coerce(int),
+                        vol.Range(min=0, max=3600)
+                    ),
+                    vol.Optional("failure_backoff_max_secs", default=600): vol.All(
+                        vol.Coerce(int),
+                        vol.Range(min=0, max=86400)
+                    ),
+                    vol.Optional("publish_sync", default=True): cv.boolean,
+                    vol.Optional("publish_mode", default="in_place"): vol.In(["in_place", "generations"]),
+                    vol.Optional("generations_directory", default="/config/.mako_generations"): cv.string,
+                    vol.Optional("generations_keep", default=3): vol.All(
+                        cv.positive_int,
+                        vol.Range(min=2, max=100)
+                    ),
                 }
             ),
             validate_extensions
@@ -67,30 +169,137 @@ CONFIG_SCHEMA = vol.Schema(
     extra=vol.ALLOW_EXTRA,
 )
 
-def setup(hass, config):
+RESTORE_BACKUP_SCHEMA = vol.Schema(
+    {
+        vol.Required("path"): cv.string,
+        vol.Optional("timestamp"): cv.string,
+    }
+)
+
+QUERY_METADATA_SCHEMA = vol.Schema(
+    {
+        vol.Optional("path"): cv.string,
+        vol.Optional("kind"): vol.In(list(MetadataManager.RECORD_KINDS.values()) + ["mtime"]),
+        vol.Optional("limit", default=100): vol.All(vol.Coerce(int), vol.Range(min=1, max=1000)),
+        vol.Optional("cursor"): cv.string,
+    }
+)
+
+WAIT_SCHEMA = vol.Schema(
+    {
+        vol.Optional("wait", default=False): cv.boolean,
+    },
+    extra=vol.ALLOW_EXTRA,
+)
+
+WAIT_TIMEOUT_SECS = 3600
+
+def _start(hass, config):
     run_config = RunConfig.from_setup_config(hass, config[DOMAIN])
-    
+
+    # A watcher left from an earlier setup follows the new configuration, as on reload
     if run_config.hot_reload:
-        HotReloadWorker(run_config)
+        if HotReloadWorker._instance is None:
+            HotReloadWorker(run_config)
+        else:
+            HotReloadWorker(run_config).reconfigure()
+    elif HotReloadWorker._instance is not None:
+        HotReloadWorker._instance.stop()
+    return run_config
+
+def _run_preprocessor(run_config):
+    preprocessor = RunPreprocessor(run_config)
+    preprocessor.run()
+
+def _view_metadata():
+    metadata = MetadataManager()
+    return metadata.data
+
+def _query_metadata(data):
+    metadata = MetadataManager()
+    return metadata.query(
+        path=data.get("path"),
+        kind=data.get("kind"),
+        limit=data.get("limit", 100),
+        cursor=data.get("cursor"),
+    )
+
+def _clear_metadata():
+    metadata = MetadataManager()
+    metadata.clear_all()
+
+def _reload(run_config, config):
+    if not config or DOMAIN not in config:
+        _LOGGER.error(f"MAKO-019 ❌ Configuration for {DOMAIN} is missing or invalid. Keeping current configuration.")
+        return
+    ConfigReloader(run_config).reload(config[DOMAIN])
+
+def _rollback_generation(run_config):
+    worker = PreprocessorWorker(run_config)
+    with PreprocessorWorker.Lock.acquire():
+        generation = worker.template_renderer.rollback_generation()
+    if generation is not None:
+        worker.reload_worker.request_reload()
+
+def _restore_backup(run_config, data):
+    entry = BackupStore(run_config).restore(data["path"], data.get("timestamp"))
+    return { "restored": entry }
+
+def _wait_idle(run_config):
+    if not PreprocessorWorker(run_config).wait_idle(WAIT_TIMEOUT_SECS):
+        _LOGGER.warning(f"MAKO-026 ⚠️ Preprocessing did not finish within {WAIT_TIMEOUT_SECS}s, no longer waiting for it.")
+
+async def async_setup(hass, config):
+    # Reading the manifest and starting the workers block, so nothing of it runs in the event loop
+    run_config = await hass.async_add_executor_job(_start, hass, config)
+
+    async def run_job(call, target, *args):
+        job = hass.async_add_executor_job(target, *args)
+        if call.data.get("wait"):
+            await job
+            await hass.async_add_executor_job(_wait_idle, run_config)
+
+    async def async_handle_run_preprocessor(call):
+        await run_job(call, _run_preprocessor, run_config)
+
+    async def async_handle_view_metadata(call):
+        return await hass.async_add_executor_job(_view_metadata)
+
+    async def async_handle_query_metadata(call):
+        return await hass.async_add_executor_job(_query_metadata, call.data)
+
+    async def async_handle_clear_metadata(call):
+        await hass.async_add_executor_job(_clear_metadata)
+
+    async def async_handle_reload(call):
+        config = await async_integration_yaml_config(hass, DOMAIN)
+        await run_job(call, _reload, run_config, config)
 
-    def handle_run_preprocessor(call):
-        preprocessor = RunPreprocessor(run_config)
-        preprocessor.run()
+    async def async_handle_rollback_generation(call):
+        await run_job(call, _rollback_generation, run_config)
 
-    def handle_view_metadata(call):
-        metadata = MetadataManager()
-        return metadata.data
+    async def async_handle_restore_backup(call):
+        return await hass.async_add_executor_job(_restore_backup, run_config, call.data)
 
-    def handle_clear_metadata(call):
-        metadata = MetadataManager()
-        metadata.clear_all()
+    hass.services.async_register(DOMAIN, "run_preprocessor", async_handle_run_preprocessor, schema=WAIT_SCHEMA)
+    hass.services.async_register(DOMAIN, "view_metadata", async_handle_view_metadata)
+    hass.services.async_register(
+        DOMAIN, "query_metadata", async_handle_query_metadata,
+        schema=QUERY_METADATA_SCHEMA, supports_response=SupportsResponse.ONLY
+    )
+    hass.services.async_register(DOMAIN, "clear_metadata", async_handle_clear_metadata)
+    hass.services.async_register(DOMAIN, "reload", async_handle_reload, schema=WAIT_SCHEMA)
+    hass.services.async_register(DOMAIN, "rollback_generation", async_handle_rollback_generation, schema=WAIT_SCHEMA)
+    hass.services.async_register(
+        DOMAIN, "restore_backup", async_handle_restore_backup,
+        schema=RESTORE_BACKUP_SCHEMA, supports_response=SupportsResponse.OPTIONAL
+    )
 
-    hass.services.register(DOMAIN, "run_preprocessor", handle_run_preprocessor)
-    hass.services.register(DOMAIN, "view_metadata", handle_view_metadata)
-    hass.services.register(DOMAIN, "clear_metadata", handle_clear_metadata)
+    async def async_initial_run():
+        await hass.async_add_executor_job(_run_preprocessor, run_config)
 
     if run_config.run_on_start_ha:
-        preprocessor = RunPreprocessor(run_config)
-        preprocessor.run()
+        # The initial scan is not awaited, the rest of Home Assistant boots while the files render
+        hass.async_create_background_task(async_initial_run(), f"{DOMAIN} initial run")
 
     return True
@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import stat
+import shutil
+import hashlib
+import tempfile
+import threading
+from datetime import datetime, UTC
+from .stat_cache import StatCache
+from .utils import get_logger
+
+INDEX_FILE = "index.json"
+BLOBS_DIR = "blobs"
+
+class BackupStore:
+    _lock = threading.Lock()
+
+    def __init__(self, run_config):
+        self._logger = get_logger(type(self))
+        self.run_config = run_config
+
+    @property
+    def root(self):
+        return self.run_config.backup_directory
+
+    def _index_path(self):
+        return os.path.join(self.root, INDEX_FILE)
+
+    def _blob_path(self, digest):
+        return os.path.join(self.root, BLOBS_DIR, digest[:2], digest)
+
+    def _load_index(self):
+        try:
+            with open(self._index_path(), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError) as e:
+            self._logger.error(f"MAKO-023 ❌ Backup index {self._index_path()} is unreadable, starting a new one: {e}")
+            return []
+
+    def _save_index(self, entries):
+        fd, temp_path = tempfile.mkstemp(dir=self.root, prefix=f".{INDEX_FILE}.", suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(entries, f, indent=2)
+        os.replace(temp_path, self._index_path())
+
+    @staticmethod
+    def _digest(file_path):
+        sha = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def backup(self, file_path):
+        file_path = os.path.abspath(file_path)
+        digest = self._digest(file_path)
+        blob_path = self._blob_path(digest)
+        with self._lock:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            if not os.path.exists(blob_path):
+                fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(blob_path), suffix=".tmp")
+                os.close(fd)
+                shutil.copyfile(file_path, temp_path)
+                os.replace(temp_path, blob_path)
+            else:
+                self._logger.debug("Backup content of %s already stored as %s", file_path, digest)
+
+            entries = self._load_index()
+            file_stat = StatCache.require(file_path)
+            entry = {
+                "path": file_path,
+                "timestamp": datetime.fromtimestamp(file_stat.st_mtime, UTC).strftime('%Y%m%d%H%M%S'),
+                "backed_up": time.time(),
+                "blob": digest,
+                "size": os.path.getsize(blob_path),
+                "mode": stat.S_IMODE(file_stat.st_mode),
+            }
+            entries.append(entry)
+            retained = self._apply_retention(entries)
+            self._save_index(retained)
+            # Blobs can only become unreferenced when retention dropped an entry
+            if len(retained) < len(entries):
+                self._collect_garbage({entry["blob"] for entry in retained})
+        self._logger.debug("📦 Backup created: %s -> %s", file_path, blob_path)
+        return entry
+
+    def _apply_retention(self, entries):
+        now = time.time()
+        if self.run_config.backup_retention_days:
+            max_age = self.run_config.backup_retention_days * 86400
+            entries = [entry for entry in entries if now - entry["backed_up"] <= max_age]
+
+        if self.run_config.backup_retention_count:
+            kept = []
+            per_path = {}
+            for entry in sorted(entries, key=lambda entry: entry["backed_up"], reverse=True):
+                per_path[entry["path"]] = per_path.get(entry["path"], 0) + 1
+                if per_path[entry["path"]] <= self.run_config.backup_retention_count:
+                    kept.append(entry)
+            entries = sorted(kept, key=lambda entry: entry["backed_up"])
+
+        if self.run_config.backup_max_size_mb:
+            max_size = self.run_config.backup_max_size_mb * 1024 * 1024
+            # Oldest entries go first, a blob only stops counting once nothing references it
+            while len(entries) > 1 and sum({entry["blob"]: entry["size"] for entry in entries}.values()) > max_size:
+                entries = entries[1:]
+        return entries
+
+    def _collect_garbage(self, referenced):
+        blobs_dir = os.path.join(self.root, BLOBS_DIR)
+        if not os.path.isdir(blobs_dir):
+            return
+        for prefix in os.listdir(blobs_dir):
+            prefix_dir = os.path.join(blobs_dir, prefix)
+            for digest in os.listdir(prefix_dir):
+                if digest not in referenced:
+                    os.remove(os.path.join(prefix_dir, digest))
+                    self._logger.debug("Evicted backup blob %s", digest)
+            if not os.listdir(prefix_dir):
+                os.rmdir(prefix_dir)
+
+    def entries(self, file_path=None):
+        with self._lock:
+            entries = self._load_index()
+        if file_path is not None:
+            file_path = os.path.abspath(file_path)
+            entries = [entry for entry in entries if entry["path"] == file_path]
+        return entries
+
+    def blob_path(self, entry):
+        return self._blob_path(entry["blob"])
+
+    def restore(self, file_path, timestamp=None):
+        candidates = [
+            entry for entry in self.entries(file_path)
+            if timestamp is None or entry["timestamp"] == timestamp
+        ]
+        if not candidates:
+            self._logger.error(f"MAKO-024 ❌ No backup of {file_path} found{f' at {timestamp}' if timestamp else ''}.")
+            return None
+        entry = candidates[-1]
+        file_path = entry["path"]
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), prefix=f".{os.path.basename(file_path)}.", suffix=".tmp")
+        os.close(fd)
+        shutil.copyfile(self.blob_path(entry), temp_path)
+        # Entries written before modes were recorded take the mode of the file being replaced
+        mode = entry.get("mode")
+        if mode is None:
+            current = StatCache.stat(file_path)
+            mode = stat.S_IMODE(current.st_mode) if current is not None else 0o644
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, file_path)
+        self._logger.info(f"♻️ Restored {file_path} from backup {entry['timestamp']}")
+        return entry
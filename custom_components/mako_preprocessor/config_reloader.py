@@ -0,0 +1,131 @@
+import os
+import traceback
+from .metadata import MetadataManager
+from .run_config import RunConfig
+from .run_preprocessor import RunPreprocessor
+from .preprocessor_worker import PreprocessorWorker
+from .hot_reload_worker import HotReloadWorker
+from .utils import FileMatcher, TrackingMapping, get_logger
+
+PROCESSED_FILE_TYPES = ("render", "serialize")
+FILE_CLASS_KEYS = ("render_extensions", "serialize_extensions", "enable_features")
+SOURCE_RECORD_KINDS = ("generated_files", "constants", "failure", "static_dependencies")
+
+class ConfigReloader:
+    def __init__(self, run_config):
+        self._logger = get_logger(type(self))
+        self._logger.debug("Initializing ConfigReloader")
+        self.run_config = run_config
+        self.metadata = MetadataManager()
+        self.worker = PreprocessorWorker(run_config)
+
+    @staticmethod
+    def _in_directories(file_path, directories):
+        file_path = os.path.abspath(file_path)
+        for directory in directories:
+            directory = os.path.abspath(directory)
+            if os.path.commonpath([file_path, directory]) == directory:
+                return True
+        return False
+
+    def _known_sources(self):
+        # Sources that failed or produced no outputs are only recorded under the other kinds
+        seen = set()
+        for kind in SOURCE_RECORD_KINDS:
+            cursor = None
+            while True:
+                page = self.metadata.query(kind=kind, limit=1000, cursor=cursor)
+                for record in page["records"]:
+                    if record["path"] not in seen:
+                        seen.add(record["path"])
+                        yield record["path"]
+                cursor = page["next_cursor"]
+                if cursor is None:
+                    break
+
+    def _files_for_constants(self, changed_constants, sources):
+        files = set()
+        for source in sources:
+            used_constants = self.metadata.get_constants(source)
+            # Sources rendered before constants were tracked may read any of them
+            if (used_constants is None or TrackingMapping.ALL_KEYS in used_constants
+                    or changed_constants.intersection(used_constants)):
+                files.add(source)
+        self._logger.debug("Constants %s affect %s of %s sources", changed_constants, len(files), len(sources))
+        return files
+
+    def reload(self, config):
+        self._logger.debug("Reloading configuration")
+        previous = self.run_config.snapshot()
+        RunConfig.from_setup_config(self.run_config.hass, config)
+        current = self.run_config.snapshot()
+        changes = RunConfig.diff(previous, current)
+        if not changes:
+            self._logger.info("ℹ️ Configuration unchanged, nothing to do")
+            return
+
+        self._logger.info(f"🔧 Configuration changed: {', '.join(sorted(changes))}")
+        try:
+            self._apply(previous, current, changes)
+        except Exception as e:
+            self._logger.error(f"MAKO-018 ❌ Error applying configuration changes: {e}\n{traceback.format_exc()}")
+
+    def _apply(self, previous, current, changes):
+        if "directories" in changes or "enable_features" in changes:
+            with PreprocessorWorker.Lock.acquire():
+                for renderer in self.worker.renderers():
+                    renderer.reconfigure()
+
+        watcher_keys = ("hot_reload", "directories", "hot_reload_observer", "hot_reload_scope", "event_trace_file")
+        if any(key in changes for key in watcher_keys):
+            if current.hot_reload:
+                HotReloadWorker(self.run_config).reconfigure()
+            elif HotReloadWorker._instance is not None:
+                HotReloadWorker._instance.stop()
+
+        added_directories = set(current.directories) - set(previous.directories)
+        file_classes_changed = any(key in changes for key in FILE_CLASS_KEYS)
+
+        outdated_sources = []
+        valid_sources = []
+        files_to_process = set()
+        for source in self._known_sources():
+            if not self._in_directories(source, current.directories):
+                outdated_sources.append(source)
+                continue
+            file_type, ext = FileMatcher.get_file_type(source, current)
+            if file_type not in PROCESSED_FILE_TYPES:
+                outdated_sources.append(source)
+                continue
+            valid_sources.append(source)
+            if file_classes_changed and FileMatcher.get_file_type(source, previous) != (file_type, ext):
+                files_to_process.add(source)
+
+        if "constants" in changes:
+            old_constants, new_constants = changes["constants"]
+            changed_constants = {
+                key for key in set(old_constants) | set(new_constants)
+                if old_constants.get(key) != new_constants.get(key)
+            }
+            files_to_process.update(self._files_for_constants(changed_constants, valid_sources))
+
+        if outdated_sources:
+            with PreprocessorWorker.Lock.acquire():
+                for source in outdated_sources:
+                    self.worker.template_renderer.cleanup_file(source)
+            self._logger.info(f"🗑️ Cleaned up {len(outdated_sources)} files no longer covered by configuration")
+            self.worker.reload_worker.request_reload()
+
+        if files_to_process:
+            self.worker.add_files(sorted(files_to_process))
+
+        preprocessor = RunPreprocessor(self.run_config)
+        if added_directories:
+            preprocessor.run(directories=sorted(added_directories))
+        if file_classes_changed:
+            def newly_matched(file_path):
+                file_type, ext = FileMatcher.get_file_type(file_path, current)
+                return (file_type in PROCESSED_FILE_TYPES
+                        and FileMatcher.get_file_type(file_path, previous) != (file_type, ext))
+            directories = [directory for directory in current.directories if directory not in added_directories]
+            preprocessor.run(directories=directories, file_filter=newly_matched)
@@ -0,0 +1,50 @@
+import os
+import json
+import threading
+import yaml
+from .stat_cache import StatCache
+from .utils import get_logger
+
+class DataLoader:
+    def __init__(self):
+        self._logger = get_logger(type(self))
+        self._logger.debug("Initializing DataLoader")
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _parse(file_path):
+        with open(file_path, "r", encoding="utf-8") as f:
+            if file_path.endswith((".yaml", ".yml")):
+                return yaml.safe_load(f)
+            if file_path.endswith(".json"):
+                return json.load(f)
+        raise ValueError(f"Unsupported data file format: {file_path}")
+
+    def load(self, file_path):
+        try:
+            stat = StatCache.require(file_path)
+        except FileNotFoundError:
+            with self._lock:
+                self._cache.pop(file_path, None)
+            raise
+
+        fingerprint = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._cache.get(file_path)
+        if cached is not None and cached[0] == fingerprint:
+            self._logger.debug("Data file served from cache: %s", file_path)
+            return cached[1]
+
+        data = self._parse(file_path)
+        with self._lock:
+            self._cache[file_path] = (fingerprint, data)
+        self._logger.debug("Data file loaded: %s", file_path)
+        return data
+
+    def bind(self, base_dir, dependencies):
+        def load_data(path):
+            file_path = os.path.normpath(os.path.join(base_dir, path))
+            dependencies.add(file_path)
+            return self.load(file_path)
+        return load_data
@@ -0,0 +1,53 @@
+import json
+import hashlib
+import threading
+from .stat_cache import StatCache
+from .utils import TrackingMapping, get_logger
+
+class Fingerprinter:
+    def __init__(self, run_config):
+        self._logger = get_logger(type(self))
+        self._logger.debug("Initializing Fingerprinter")
+        self.run_config = run_config
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def file_digest(self, file_path):
+        stat = StatCache.stat(file_path)
+        if stat is None:
+            return None
+
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._digests.get(file_path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+        sha = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        with self._lock:
+            self._digests[file_path] = (signature, digest)
+        return digest
+
+    def constant_values(self, used_constants):
+        constants = self.run_config.constants
+        if TrackingMapping.ALL_KEYS in used_constants:
+            return dict(constants)
+        return {key: constants.get(key) for key in used_constants}
+
+    def inputs_digest(self, template_path, dependencies, variables, used_constants):
+        payload = json.dumps(
+            {
+                "version": self.run_config.version,
+                "template": [template_path, self.file_digest(template_path)],
+                "dependencies": [[dep, self.file_digest(dep)] for dep in sorted(set(dependencies))],
+                "variables": variables,
+                "constants": self.constant_values(used_constants),
+            },
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
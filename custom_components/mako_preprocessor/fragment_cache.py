@@ -0,0 +1,192 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import contextlib
+from collections import OrderedDict
+from mako.cache import CacheImpl, register_plugin
+from .stat_cache import StatCache
+from .utils import TrackingMapping, get_logger
+
+CACHE_DIR = os.path.join(".mako_cache", "fragments")
+PLUGIN_NAME = "mako_preprocessor"
+
+class FragmentCache:
+    _instance = None
+    _lock = threading.Lock()
+    _scope = threading.local()
+
+    class RenderScope:
+        def __init__(self, source):
+            self.source = source
+            self.dependencies = []
+            self.constants = None
+
+        def dependency_signatures(self):
+            files = set()
+            for dependencies in self.dependencies:
+                files.update(dependencies)
+            return {file_path: FragmentCache.signature(file_path) for file_path in sorted(files)}
+
+        def constant_values(self, constants):
+            if self.constants is None:
+                return {}
+            accessed = self.constants.accessed
+            if TrackingMapping.ALL_KEYS in accessed:
+                accessed = set(constants) | (accessed - {TrackingMapping.ALL_KEYS})
+            return {key: constants.get(key) for key in sorted(accessed)}
+
+    def __new__(cls, run_config=None):
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = super().__new__(cls)
+                    cls._instance._initialize(run_config)
+        elif run_config is not None:
+            cls._instance.run_config = run_config
+        return cls._instance
+
+    def _initialize(self, run_config):
+        self._logger = get_logger(type(self))
+        self._logger.debug("Initializing FragmentCache")
+        self.run_config = run_config
+        self._entries = OrderedDict()
+        self._entries_lock = threading.Lock()
+
+    @classmethod
+    @contextlib.contextmanager
+    def rendering(cls, source):
+        previous = getattr(cls._scope, "current", None)
+        cls._scope.current = cls.RenderScope(source)
+        try:
+            yield cls._scope.current
+        finally:
+            cls._scope.current = previous
+
+    @classmethod
+    def current_scope(cls):
+        return getattr(cls._scope, "current", None)
+
+    @staticmethod
+    def signature(file_path):
+        stat = StatCache.stat(file_path)
+        return [stat.st_mtime_ns, stat.st_size] if stat is not None else None
+
+    def _disk_path(self, key):
+        return os.path.join(CACHE_DIR, f"{key}.json")
+
+    def _is_valid(self, entry, timeout):
+        if timeout is not None and time.time() - entry["created"] > timeout:
+            return False
+        for file_path, signature in entry["dependencies"].items():
+            if self.signature(file_path) != signature:
+                return False
+        constants = self.run_config.constants
+        return all(constants.get(key) == value for key, value in entry["constants"].items())
+
+    def _store_memory(self, key, entry):
+        with self._entries_lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.run_config.fragment_cache_size:
+                self._entries.popitem(last=False)
+
+    def _read_disk(self, key):
+        try:
+            with open(self._disk_path(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_disk(self, key, entry):
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            temp_path = f"{self._disk_path(key)}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            os.replace(temp_path, self._disk_path(key))
+        except (OSError, TypeError) as e:
+            self._logger.warning(f"MAKO-020 ⚠️ Unable to write fragment cache entry {key}: {e}")
+
+    def get(self, key, timeout=None):
+        with self._entries_lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None and self.run_config.fragment_cache_disk:
+            entry = self._read_disk(key)
+            if entry is not None:
+                self._store_memory(key, entry)
+        if entry is None:
+            return None
+
+        if not self._is_valid(entry, timeout):
+            self._logger.debug("Fragment cache entry is stale: %s", key)
+            self.invalidate(key)
+            return None
+
+        scope = self.current_scope()
+        if scope is not None and scope.source not in entry["sources"]:
+            entry["sources"].append(scope.source)
+        return entry
+
+    def put(self, key, value):
+        scope = self.current_scope()
+        entry = {
+            "value": value,
+            "created": time.time(),
+            "sources": [scope.source] if scope is not None else [],
+            "dependencies": scope.dependency_signatures() if scope is not None else {},
+            "constants": scope.constant_values(self.run_config.constants) if scope is not None else {},
+        }
+        self._store_memory(key, entry)
+        if self.run_config.fragment_cache_disk:
+            self._write_disk(key, entry)
+
+    def invalidate(self, key):
+        with self._entries_lock:
+            self._entries.pop(key, None)
+        if self.run_config.fragment_cache_disk:
+            with contextlib.suppress(OSError):
+                os.remove(self._disk_path(key))
+
+    def invalidate_sources(self, sources):
+        sources = set(sources)
+        with self._entries_lock:
+            keys = [key for key, entry in self._entries.items() if sources.intersection(entry["sources"])]
+        for key in keys:
+            self.invalidate(key)
+        if keys:
+            self._logger.debug("Invalidated %s fragment cache entries for %s", len(keys), sources)
+
+class FragmentCacheImpl(CacheImpl):
+    def __init__(self, cache):
+        super().__init__(cache)
+        self.fingerprint = hashlib.sha256(cache.template.source.encode("utf-8")).hexdigest()
+
+    def _key(self, key, kw):
+        args = {name: value for name, value in kw.items() if name != "context"}
+        payload = json.dumps([self.cache.template.filename, self.fingerprint, key, args], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get_or_create(self, key, creation_function, **kw):
+        cache_key = self._key(key, kw)
+        entry = FragmentCache().get(cache_key, kw.get("timeout"))
+        if entry is not None:
+            return entry["value"]
+        value = creation_function()
+        FragmentCache().put(cache_key, value)
+        return value
+
+    def set(self, key, value, **kw):
+        FragmentCache().put(self._key(key, kw), value)
+
+    def get(self, key, **kw):
+        entry = FragmentCache().get(self._key(key, kw), kw.get("timeout"))
+        return entry["value"] if entry is not None else None
+
+    def invalidate(self, key, **kw):
+        FragmentCache().invalidate(self._key(key, kw))
+
+register_plugin(PLUGIN_NAME, __name__, "FragmentCacheImpl")
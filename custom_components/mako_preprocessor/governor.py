@@ -0,0 +1,192 @@
+import os
+import time
+import asyncio
+import ctypes
+import platform
+import resource
+import threading
+from .render_supervisor import RenderSupervisor
+from .utils import TokenBucket, get_logger
+
+# Seconds of full speed the CPU and IO budgets allow before throttling starts
+BURST_SECS = 5
+LAG_PROBE_INTERVAL_SECS = 1
+LAG_BACKOFF_SECS = 0.5
+LAG_BACKOFF_MAX_SECS = 30
+
+IOPRIO_SYSCALLS = { "x86_64": 251, "aarch64": 30, "armv7l": 314, "armv6l": 314, "i686": 289, "i386": 289 }
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_BEST_EFFORT_LOWEST = (2 << 13) | 7
+
+def lower_priority(nice):
+    # Linux schedules threads individually, so this lowers the calling thread and leaves Home Assistant's alone
+    if not nice:
+        return
+    _logger = get_logger("ResourceGovernor")
+    tid = threading.get_native_id()
+    try:
+        os.setpriority(os.PRIO_PROCESS, tid, nice)
+    except (AttributeError, OSError) as e:
+        _logger.debug("Cannot set niceness of thread %s: %s", tid, e)
+    syscall = IOPRIO_SYSCALLS.get(platform.machine())
+    if syscall is None:
+        return
+    try:
+        if ctypes.CDLL(None, use_errno=True).syscall(syscall, IOPRIO_WHO_PROCESS, tid, IOPRIO_BEST_EFFORT_LOWEST) != 0:
+            _logger.debug("Cannot set IO priority of thread %s: errno %s", tid, ctypes.get_errno())
+    except (AttributeError, OSError) as e:
+        _logger.debug("Cannot set IO priority of thread %s: %s", tid, e)
+
+def _io_bytes(path):
+    try:
+        with open(path, "rb") as f:
+            fields = dict(line.split(b": ") for line in f.read().splitlines())
+        return int(fields[b"read_bytes"]) + int(fields[b"write_bytes"])
+    except (OSError, KeyError, ValueError):
+        return 0
+
+def _cpu_secs(pid):
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            fields = f.read().rsplit(b")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError):
+        return 0.0
+
+def process_usage():
+    # Reaped children, serialize scripts and killed render processes among them, are folded into
+    # RUSAGE_CHILDREN and /proc/self/io, the render processes still running are read one by one
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = time.process_time() + children.ru_utime + children.ru_stime
+    io = _io_bytes("/proc/self/io")
+    for pid in RenderSupervisor.live_pids():
+        cpu += _cpu_secs(pid)
+        io += _io_bytes(f"/proc/{pid}/io")
+    return cpu, io
+
+class ResourceGovernor:
+    def __init__(self, worker):
+        self._logger = get_logger(type(self))
+        self.worker = worker
+        self._buckets = {}
+        self._local = threading.local()
+        self._charge_lock = threading.Lock()
+        self._charged = (0.0, 0)
+        self._lag_lock = threading.Lock()
+        self._probe_started = None
+        self._measured_lag = 0.0
+        self._probing = False
+
+    def _bucket(self, name, rate, capacity):
+        # Rebuilt when the configured rate changes, so a reload takes effect on the next batch
+        bucket = self._buckets.get(name)
+        if bucket is None or bucket.rate != rate:
+            bucket = self._buckets[name] = TokenBucket(rate, capacity)
+        return bucket
+
+    def _budgets(self):
+        run_config = self.worker.run_config
+        budgets = {}
+        if run_config.cpu_share:
+            budgets["cpu"] = self._bucket("cpu", run_config.cpu_share, run_config.cpu_share * BURST_SECS)
+        if run_config.io_rate_mb_secs:
+            rate = run_config.io_rate_mb_secs * 1024 * 1024
+            budgets["io"] = self._bucket("io", rate, rate * BURST_SECS)
+        return budgets
+
+    def hot_reload_delay(self):
+        rate = self.worker.run_config.hot_reload_rate_per_min
+        if not rate:
+            return 0.0
+        return self._bucket("hot_reload", rate / 60, rate).consume(1)
+
+    def usage(self):
+        return process_usage()
+
+    def charge(self, usage):
+        current = self.usage()
+        with self._charge_lock:
+            # Lanes run side by side, usage since the last charge is already paid for by whichever lane made it
+            start = tuple(max(started, charged) for started, charged in zip(usage, self._charged))
+            self._charged = tuple(max(now, charged) for now, charged in zip(current, self._charged))
+        budgets = self._budgets()
+        if "cpu" in budgets:
+            budgets["cpu"].consume(max(current[0] - start[0], 0.0))
+        if "io" in budgets:
+            budgets["io"].consume(max(current[1] - start[1], 0))
+
+    def before_batch(self, stop_event):
+        nice = self.worker.run_config.render_nice
+        if getattr(self._local, "nice", 0) != nice:
+            lower_priority(nice)
+            self._local.nice = nice
+
+        delay = max((bucket.delay() for bucket in self._budgets().values()), default=0.0)
+        if delay:
+            self._logger.debug("Render budget spent, pausing %.3fs", delay)
+            stop_event.wait(delay)
+
+        threshold = self.worker.run_config.loop_lag_threshold_ms / 1000
+        lag = self.loop_lag()
+        if not threshold or lag <= threshold:
+            self._local.backoff = 0.0
+            return
+        # Doubles while the lag lasts, and a batch still runs after every pause so rendering never stalls
+        backoff = min(max(getattr(self._local, "backoff", 0.0) * 2, LAG_BACKOFF_SECS), LAG_BACKOFF_MAX_SECS)
+        self._local.backoff = backoff
+        self._logger.debug("Event loop lag %.3fs over %.3fs, backing off %.3fs", lag, threshold, backoff)
+        stop_event.wait(backoff)
+
+    def loop_lag(self):
+        with self._lag_lock:
+            if self._probe_started is None:
+                return self._measured_lag
+            # An unanswered probe is a lower bound on the lag of a blocked loop
+            return max(self._measured_lag, time.monotonic() - self._probe_started)
+
+    def _event_loop(self):
+        loop = getattr(getattr(self.worker.run_config, "hass", None), "loop", None)
+        if isinstance(loop, asyncio.AbstractEventLoop) and loop.is_running():
+            return loop
+        return None
+
+    def probe(self):
+        loop = self._event_loop()
+        with self._lag_lock:
+            if loop is None:
+                # A probe left unanswered by a loop that has since stopped says nothing about lag
+                self._probe_started = None
+                return
+            if self._probe_started is not None:
+                return
+            self._probe_started = time.monotonic()
+            started = self._probe_started
+        try:
+            loop.call_soon_threadsafe(self._probe_done, started)
+        except RuntimeError:
+            with self._lag_lock:
+                self._probe_started = None
+
+    def _probe_done(self, started):
+        with self._lag_lock:
+            self._measured_lag = time.monotonic() - started
+            self._probe_started = None
+
+    def start_probing(self):
+        # Probes only run while there is work to pace, an idle pipeline posts nothing to the event loop
+        if self._probing or not self.worker.run_config.loop_lag_threshold_ms:
+            return
+        self._probing = True
+        self._probe_tick()
+
+    def _probe_tick(self):
+        if (self.worker.idle.is_set() or self.worker.stop_event.is_set()
+                or not self.worker.run_config.loop_lag_threshold_ms):
+            self._probing = False
+            with self._lag_lock:
+                # A measurement from before the pause says nothing about the loop when work resumes
+                self._measured_lag = 0.0
+                self._probe_started = None
+            return
+        self.probe()
+        self.worker.scheduler.call_later(LAG_PROBE_INTERVAL_SECS, self._probe_tick)
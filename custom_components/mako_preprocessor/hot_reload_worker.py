@@ -2,11 +2,16 @@ import os
 import time
 import logging
 import threading
+import functools
+import contextlib
+from collections import deque
 from .metadata import MetadataManager
-from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
+from .observers import RACY_MTIME_NS, create_observer
 from .utils import FileMatcher, get_logger
 from .preprocessor_worker import PreprocessorWorker
+from .run_preprocessor import RunPreprocessor
+from .trace import EventTraceRecorder
 
 class HotReloadWorker:
     _instance = None
@@ -16,8 +21,10 @@ class HotReloadWorker:
         if cls._instance is None:
             with cls._lock:
                 if cls._instance is None:
-                    cls._instance = super().__new__(cls)
-                    cls._instance._initialize(run_config)
+                    # Published only once initialized, setup and service calls may construct it from different threads
+                    instance = super().__new__(cls)
+                    instance._initialize(run_config)
+                    cls._instance = instance
         elif run_config is not None:
             cls._instance.run_config = run_config
         return cls._instance
@@ -26,9 +33,28 @@ class HotReloadWorker:
         self._logger = get_logger(type(self))
         self.run_config = run_config
         self.observer = None
+        self.trace = None
+        self.handler = self.FileChangeHandler(self)
+        self.observer_lock = threading.Lock()
         self.metadata = MetadataManager()
         self.stop_event = threading.Event()
         self.preprocessor = PreprocessorWorker(run_config)
+        self.watches = {}
+        self.source_directories = set()
+        self.created_directories = set()
+        self.directory_index = {}
+        self.sweep_generation = 0
+        self.preprocessor.idle_callbacks.append(self.refresh_watches)
+        self.storm_lock = threading.Lock()
+        self.event_times = deque()
+        self.storm_directories = None
+        self.storm_last_event = 0
+        self._start_thread()
+
+    def _start_thread(self):
+        self.observer_mode = self.run_config.hot_reload_observer
+        self.watch_scope = self.run_config.hot_reload_scope
+        self.trace_file = self.run_config.event_trace_file
         self.worker_thread = threading.Thread(target=self._start_monitoring, daemon=True)
         self.worker_thread.start()
 
@@ -37,49 +63,249 @@ class HotReloadWorker:
             self.worker = worker
             self._logger = get_logger("HotReloadWorker.FileChangeHandler")
 
+        def dispatch(self, event):
+            trace = self.worker.trace
+            if trace is not None:
+                trace.record(event)
+            super().dispatch(event)
+
         def _handle_event(self, event, src_path):
             if event.is_directory:
+                if event.event_type in ("created", "moved") and os.path.isdir(src_path):
+                    self.worker.directory_added(src_path)
                 return
             file_type, _ = FileMatcher.get_file_type(src_path, self.worker.run_config)
             if file_type is not None:
-                self.worker.preprocessor.schedule_hot_reload(src_path)
+                self.worker.file_changed(src_path)
             else:
                 dependents = self.worker.metadata.get_dependents(src_path)
                 if dependents:
-                    self.worker.preprocessor.schedule_hot_reload(src_path)
+                    self.worker.file_changed(src_path)
 
         def on_modified(self, event):
-            self._logger.debug(f"File modified: {event.src_path}")
+            self._logger.debug("File modified: %s", event.src_path)
             self._handle_event(event, event.src_path)
 
         def on_created(self, event):
-            self._logger.debug(f"File created: {event.src_path}")
+            self._logger.debug("File created: %s", event.src_path)
             self._handle_event(event, event.src_path)
 
         def on_deleted(self, event):
-            self._logger.debug(f"File deleted: {event.src_path}")
+            self._logger.debug("File deleted: %s", event.src_path)
             self._handle_event(event, event.src_path)
 
         def on_moved(self, event):
-            self._logger.debug(f"File moved: {event.src_path} -> {event.dest_path}")
+            self._logger.debug("File moved: %s -> %s", event.src_path, event.dest_path)
             self._handle_event(event, event.src_path)
             self._handle_event(event, event.dest_path)
 
-    def _start_monitoring(self):
-        self._logger.debug("Starting directory monitoring")
-        self.observer = Observer()
-        handler = self.FileChangeHandler(self)
+    def _watch(self, directory, recursive):
+        try:
+            self.watches[directory] = self.observer.schedule(self.handler, directory, recursive=recursive)
+        except OSError as e:
+            self._logger.error(
+                f"MAKO-029 ❌ Cannot watch {directory}: {e}. Set hot_reload_observer to hybrid or polling."
+            )
+
+    def _schedule_directories(self):
+        self.watches = {}
+        if self.run_config.hot_reload_scope == "relevant":
+            self.directory_index = {}
+            self.source_directories = self._scan_source_directories()
+            self.created_directories = set()
+            self._apply_watch_set()
+            return
         for directory in self.run_config.directories:
             if os.path.exists(directory):
-                self.observer.schedule(handler, directory, recursive=True)
-        
-        self.observer.start()
+                self._watch(directory, recursive=True)
+
+    def _scan_source_directories(self):
+        directories = set()
+        for base_dir in self.run_config.directories:
+            for root, _, files in os.walk(base_dir):
+                root = os.path.abspath(root)
+                self._index_directory(root)
+                if any(FileMatcher.get_file_type(os.path.join(root, name), self.run_config)[0] for name in files):
+                    directories.add(root)
+        return directories
+
+    def _index_directory(self, directory):
+        # Records the mtime of a directory as of a listing taken right after, for the sweep of unwatched directories
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            self.directory_index.pop(directory, None)
+            return
+        self.directory_index[directory] = (mtime, time.time_ns())
+
+    def _start_sweep(self):
+        # A new generation ends the sweeps scheduled under the previous configuration
+        self.sweep_generation += 1
+        if self.run_config.hot_reload_scope == "relevant":
+            self.preprocessor.scheduler.call_later(
+                self.run_config.hot_reload_sweep_secs, functools.partial(self._sweep, self.sweep_generation)
+            )
+
+    def _sweep(self, generation):
+        # Unwatched directories only change mtime when entries are added or removed, so the first source
+        # dropped into one is found by a stat per directory instead of a watch on each
+        with self.observer_lock:
+            if generation != self.sweep_generation or self.observer is None:
+                return
+            found = []
+            pending = []
+            for directory, (mtime, listed_at) in list(self.directory_index.items()):
+                if directory in self.watches:
+                    continue
+                try:
+                    current = os.stat(directory).st_mtime_ns
+                except OSError:
+                    self.directory_index.pop(directory, None)
+                    continue
+                if current != mtime or listed_at - mtime < RACY_MTIME_NS:
+                    pending.append(directory)
+            while pending:
+                directory = pending.pop()
+                self._index_directory(directory)
+                try:
+                    with os.scandir(directory) as entries:
+                        for entry in entries:
+                            if entry.is_dir(follow_symlinks=False):
+                                if entry.path not in self.directory_index:
+                                    pending.append(entry.path)
+                            elif FileMatcher.get_file_type(entry.path, self.run_config)[0] is not None:
+                                found.append(entry.path)
+                                self.source_directories.add(directory)
+                except OSError:
+                    continue
+            if found:
+                self._logger.debug("Sweep found %s sources in unwatched directories", len(found))
+                self._apply_watch_set()
+            interval = self.run_config.hot_reload_sweep_secs
+            self.preprocessor.scheduler.call_later(interval, functools.partial(self._sweep, generation))
+        for file_path in found:
+            self.file_changed(file_path)
+
+    def watch_set(self):
+        # Directories holding sources, their dependencies or data, with every directory up to the root
+        # so that new subdirectories are noticed, and nothing of the rest of the tree
+        roots = [os.path.abspath(directory) for directory in self.run_config.directories]
+        directories = set(self.source_directories) | self.created_directories
+        directories.update(os.path.dirname(os.path.abspath(path)) for path in self.metadata.tracked_paths())
+        watched = set()
+        for directory in directories:
+            root = next((root for root in roots if directory == root or directory.startswith(root + os.sep)), None)
+            while root is not None and directory != root:
+                watched.add(directory)
+                directory = os.path.dirname(directory)
+            watched.add(directory)
+        return {directory for directory in watched if os.path.isdir(directory)}
+
+    def _apply_watch_set(self):
+        watch_set = self.watch_set()
+        for directory in sorted(set(self.watches) - watch_set):
+            # The watch of a deleted directory may already be gone with its emitter
+            with contextlib.suppress(KeyError):
+                self.observer.unschedule(self.watches.pop(directory))
+        for directory in sorted(watch_set - set(self.watches)):
+            self._watch(directory, recursive=False)
+        self._logger.debug("Watching %s directories", len(self.watches))
+
+    def refresh_watches(self):
+        with self.observer_lock:
+            if self.observer is not None and self.run_config.hot_reload_scope == "relevant":
+                self._apply_watch_set()
+
+    def directory_added(self, directory):
+        if self.run_config.hot_reload_scope != "relevant":
+            return
+        # A new directory is watched right away, sources it was created or moved in with are picked up here
+        for root, _, files in os.walk(directory):
+            self.created_directories.add(os.path.abspath(root))
+            for name in files:
+                file_path = os.path.join(root, name)
+                if FileMatcher.get_file_type(file_path, self.run_config)[0] is not None:
+                    self.file_changed(file_path)
+        self.refresh_watches()
+
+    def file_changed(self, file_path):
+        if not self._absorbed_by_storm(file_path):
+            self.preprocessor.schedule_hot_reload(file_path)
+
+    def _absorbed_by_storm(self, file_path):
+        threshold = self.run_config.storm_threshold_events
+        if not threshold:
+            return False
+        now = time.monotonic()
+        with self.storm_lock:
+            self.event_times.append(now)
+            while now - self.event_times[0] > 1:
+                self.event_times.popleft()
+
+            if self.storm_directories is None:
+                if len(self.event_times) <= threshold:
+                    return False
+                # Beyond this rate per-file scheduling costs more than rescanning what the burst touched
+                self._logger.info(f"🌩️ More than {threshold} changes per second, waiting for them to settle")
+                self.storm_directories = set()
+                self.preprocessor.scheduler.call_later(self.run_config.hot_reload_delay_secs, self._settle_storm)
+            self.storm_directories.add(os.path.dirname(os.path.abspath(file_path)))
+            self.storm_last_event = now
+            return True
+
+    def _settle_storm(self):
+        with self.storm_lock:
+            remaining = self.storm_last_event + self.run_config.hot_reload_delay_secs - time.monotonic()
+            if remaining > 0:
+                self.preprocessor.scheduler.call_later(remaining, self._settle_storm)
+                return
+            directories, self.storm_directories = self.storm_directories, None
+            self.event_times.clear()
+
+        subtrees = []
+        for directory in sorted(directories):
+            if not any(directory == subtree or directory.startswith(subtree + os.sep) for subtree in subtrees):
+                subtrees.append(directory)
+        self._logger.info(f"🌩️ Changes settled, rescanning {len(subtrees)} directories")
+        RunPreprocessor(self.run_config).rescan(subtrees)
+
+    def _start_monitoring(self):
+        self._logger.debug("Starting directory monitoring")
+        with self.observer_lock:
+            if self.trace_file:
+                self.trace = EventTraceRecorder(self.trace_file, self.run_config.directories)
+            self.observer = create_observer(self.run_config)
+            # Started first so that a failing watch surfaces on its directory instead of stopping the observer
+            self.observer.start()
+            self._schedule_directories()
+            self._start_sweep()
         
-        while not self.stop_event.is_set():
-            time.sleep(1)
+        self.stop_event.wait()
+
+        with self.observer_lock:
+            self.observer.stop()
+            self.observer.join()
+            self.observer = None
+            if self.trace is not None:
+                self.trace.close()
+                self.trace = None
+
+    def reconfigure(self):
+        self._logger.debug("Reconfiguring HotReloadWorker")
+        if ((self.observer_mode, self.watch_scope, self.trace_file)
+                != (self.run_config.hot_reload_observer, self.run_config.hot_reload_scope, self.run_config.event_trace_file)):
+            self.stop()
+        if self.stop_event.is_set():
+            self.worker_thread.join()
+            self.stop_event.clear()
+            self._start_thread()
+            return
 
-        self.observer.stop()
-        self.observer.join()
+        with self.observer_lock:
+            if self.observer is not None:
+                self.observer.unschedule_all()
+                self._schedule_directories()
+                self._start_sweep()
 
     def stop(self):
         if not self.stop_event.is_set():
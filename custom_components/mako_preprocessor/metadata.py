@@ -1,5 +1,7 @@
 import os
 import json
+import bisect
+import fnmatch
 import logging
 import threading
 import contextlib
@@ -7,11 +9,67 @@ from datetime import datetime
 from .utils import get_logger
 
 META_FILE = ".mako_meta.json"
+GLOB_CHARS = "*?["
+
+class MetadataIndex:
+    def __init__(self, data):
+        self.data = data
+        self.keys = sorted(key for key in data if key != "metadata_version")
+
+    @staticmethod
+    def record_kind(key, value):
+        if isinstance(value, (int, float)):
+            return key, "mtime"
+        for suffix, kind in MetadataManager.RECORD_KINDS.items():
+            if key.endswith(suffix):
+                return key[:-len(suffix)], kind
+        return key, None
+
+    def query(self, path=None, kind=None, limit=100, cursor=None):
+        pattern = None
+        prefix = path or ""
+        if any(char in prefix for char in GLOB_CHARS):
+            pattern = prefix
+            prefix = prefix[:min(prefix.find(char) for char in GLOB_CHARS if char in prefix)]
+
+        start = bisect.bisect_left(self.keys, prefix)
+        if cursor is not None:
+            start = max(start, bisect.bisect_right(self.keys, cursor))
+
+        records = []
+        next_cursor = None
+        for key in self.keys[start:]:
+            if not key.startswith(prefix):
+                break
+            record_path, record_kind = self.record_kind(key, self.data[key])
+            if kind is not None and record_kind != kind:
+                continue
+            if pattern is not None and not fnmatch.fnmatchcase(record_path, pattern):
+                continue
+            if len(records) >= limit:
+                next_cursor = records[-1]["key"]
+                break
+            records.append({"key": key, "path": record_path, "kind": record_kind, "value": self.data[key]})
+        return {"records": records, "next_cursor": next_cursor}
 
 class MetadataManager:
     _instance = None
     _lock = threading.RLock()
     CURRENT_VERSION = "2.0.0"
+    RECORD_KINDS = {
+        "_static_dependencies": "static_dependencies",
+        "_dependencies": "dependencies",
+        "_dependents": "dependents",
+        "_generated_files": "generated_files",
+        "_constants": "constants",
+        "_fingerprint": "fingerprint",
+        "_template_inputs": "template_inputs",
+        "_failure": "failure",
+        "_render_secs": "render_secs",
+    }
+    # Smoothing of recorded render durations, and the relative change worth a metadata write
+    RENDER_SECS_WEIGHT = 0.3
+    RENDER_SECS_TOLERANCE = 0.1
 
     def __new__(cls):
         if cls._instance is None:
@@ -25,10 +83,14 @@ class MetadataManager:
         self._logger = get_logger(type(self))
         self._logger.debug("Initializing MetadataManager")
         self._data = {}
-        self._batch_active = 0
+        self._batch_state = threading.local()
+        self._open_batches = 0
         self._batch_changed = False
+        self._snapshot = "{}"
+        self._index = None
         self._load()
         self._migrate()
+        self._publish(json.dumps(self._data))
 
     def _load(self):
         if os.path.exists(META_FILE):
@@ -50,29 +112,45 @@ class MetadataManager:
 
     def save(self):
         with self._lock:
+            snapshot = json.dumps(self._data, indent=2)
             with open(META_FILE, "w", encoding="utf-8") as f:
-                json.dump(self._data, f, indent=2)
+                f.write(snapshot)
                 self._logger.debug("Metadata saved successfully")
+            self._publish(snapshot)
+
+    def _publish(self, snapshot):
+        # Readers only ever see complete serialized states, so queries never take the lock
+        self._snapshot = snapshot
+
+    def query(self, path=None, kind=None, limit=100, cursor=None):
+        self._logger.debug("Querying metadata: path=%s, kind=%s, limit=%s, cursor=%s", path, kind, limit, cursor)
+        snapshot, cached = self._snapshot, self._index
+        if cached is not None and cached[0] is snapshot:
+            index = cached[1]
+        else:
+            index = MetadataIndex(json.loads(snapshot))
+            self._index = (snapshot, index)
+        return index.query(path, kind, limit, cursor)
 
     def get(self, key, default=None):
         value = self._data.get(key, default)
-        self._logger.debug(f"Getting key: {key}, value: {value}")
+        self._logger.debug("Getting key: %s, value: %s", key, value)
         return value
 
     def set(self, key, value):
-        self._logger.debug(f"Setting key: {key}, value: {value}")
+        self._logger.debug("Setting key: %s, value: %s", key, value)
         with self._lock:
             self._data[key] = value
-            if self._batch_active == 0:
+            if self._open_batches == 0:
                 self.save()
             else:
                 self._batch_changed = True
 
     def update(self, new_data):
-        self._logger.debug(f"Updating data: {new_data}")
+        self._logger.debug("Updating data: %s", new_data)
         with self._lock:
             self._data.update(new_data)
-            if self._batch_active == 0:
+            if self._open_batches == 0:
                 self.save()
             else:
                 self._batch_changed = True
@@ -80,7 +158,8 @@ class MetadataManager:
     @property
     def data(self):
         self._logger.debug("Getting a copy of all data")
-        return self._data.copy()
+        with self._lock:
+            return self._data.copy()
 
     def clear_all(self):
         self._data.clear()
@@ -88,25 +167,37 @@ class MetadataManager:
         self.save()
         self._logger.debug("All metadata cleared")
 
+    @property
+    def _batch_active(self):
+        return getattr(self._batch_state, "depth", 0)
+
     @contextlib.contextmanager
     def batch_update(self):
-        self._batch_active += 1
-        self._logger.debug(f"Starting batch update, level: {self._batch_active}")
+        # Writes are deferred while any thread has a batch open, and saved when the thread
+        # that opened its outermost batch leaves it, so lanes running side by side do not wait for each other
+        with self._lock:
+            self._open_batches += 1
+        self._batch_state.depth = self._batch_active + 1
+        self._logger.debug("Starting batch update, level: %s", self._batch_active)
         try:
             yield
         finally:
-            self._batch_active -= 1
-            if self._batch_active == 0 and self._batch_changed:
-                self.save()
-                self._batch_changed = False
-            self._logger.debug(f"Batch update finished, level: {self._batch_active}")
+            self._batch_state.depth -= 1
+            with self._lock:
+                self._open_batches -= 1
+                if self._batch_active == 0 and self._batch_changed:
+                    self.save()
+                    self._batch_changed = False
+            self._logger.debug("Batch update finished, level: %s", self._batch_active)
 
     @property
     def version(self):
         return self._data.get("metadata_version", "unknown")
 
     def update_dependencies(self, file_path, dependencies):
-        with self.batch_update():
+        with self._lock, self.batch_update():
+            # Statically discovered dependencies stay in the graph even when a render does not reach them
+            dependencies = set(dependencies) | set(self.get_static_dependencies(file_path))
             current_dependencies = self.get_dependencies(file_path)
             self.set_dependencies(file_path, list(dependencies))
 
@@ -126,15 +217,36 @@ class MetadataManager:
                     self.set_dependents(dep, dependents)
 
     def remove_dependency(self, file_path, dependency):
-        dependencies = self.get_dependencies(file_path)
-        if dependency in dependencies:
-            dependencies.remove(dependency)
-            self.set_dependencies(file_path, dependencies)
-        
-        dependents = self.get_dependents(dependency)
-        if file_path in dependents:
-            dependents.remove(file_path)
-            self.set_dependents(dependency, dependents)
+        with self._lock:
+            dependencies = self.get_dependencies(file_path)
+            if dependency in dependencies:
+                dependencies.remove(dependency)
+                self.set_dependencies(file_path, dependencies)
+            
+            dependents = self.get_dependents(dependency)
+            if file_path in dependents:
+                dependents.remove(file_path)
+                self.set_dependents(dependency, dependents)
+
+    def tracked_paths(self):
+        # Sources and everything they depend on, the files whose changes can affect an output
+        with self._lock:
+            items = list(self._data.items())
+        paths = set()
+        for key, value in items:
+            path, kind = MetadataIndex.record_kind(key, value)
+            if kind in ("dependencies", "static_dependencies", "dependents", "fingerprint", "failure"):
+                paths.add(path)
+        return paths
+
+    def generated_outputs(self):
+        with self._lock:
+            items = list(self._data.items())
+        outputs = set()
+        for key, value in items:
+            if MetadataIndex.record_kind(key, value)[1] == "generated_files":
+                outputs.update(value)
+        return outputs
 
     def dependencies_key(self, file_path):
         return f"{file_path}_dependencies"
@@ -145,6 +257,15 @@ class MetadataManager:
     def set_dependencies(self, file_path, dependencies):
         self.set(self.dependencies_key(file_path), dependencies)
     
+    def static_dependencies_key(self, file_path):
+        return f"{file_path}_static_dependencies"
+
+    def get_static_dependencies(self, file_path):
+        return self.get(self.static_dependencies_key(file_path), [])
+
+    def set_static_dependencies(self, file_path, dependencies):
+        self.set(self.static_dependencies_key(file_path), sorted(dependencies))
+
     def dependents_key(self, file_path):
         return f"{file_path}_dependents"
 
@@ -163,8 +284,86 @@ class MetadataManager:
     def set_generated_files(self, file_path, generated_files):
         self.set(self.generated_files_key(file_path), list(generated_files))
 
-    def remove_file_metadata(self, file_path):
+    def constants_key(self, file_path):
+        return f"{file_path}_constants"
+
+    def get_constants(self, file_path):
+        return self.get(self.constants_key(file_path))
+
+    def set_constants(self, file_path, constants):
+        self.set(self.constants_key(file_path), sorted(constants))
+
+    def fingerprint_key(self, file_path):
+        return f"{file_path}_fingerprint"
+
+    def get_fingerprint(self, file_path):
+        return self.get(self.fingerprint_key(file_path))
+
+    def set_fingerprint(self, file_path, fingerprint):
+        self.set(self.fingerprint_key(file_path), fingerprint)
+
+    def template_inputs_key(self, file_path):
+        return f"{file_path}_template_inputs"
+
+    def get_template_inputs(self, file_path):
+        return self.get(self.template_inputs_key(file_path))
+
+    def set_template_inputs(self, file_path, template_inputs):
+        self.set(self.template_inputs_key(file_path), template_inputs)
+
+    def failure_key(self, file_path):
+        return f"{file_path}_failure"
+
+    def get_failure(self, file_path):
+        return self.get(self.failure_key(file_path))
+
+    def set_failure(self, file_path, failure):
+        self.set(self.failure_key(file_path), failure)
+
+    def render_secs_key(self, file_path):
+        return f"{file_path}_render_secs"
+
+    def get_render_secs(self, file_path):
+        record = self.get(self.render_secs_key(file_path))
+        return record["secs"] if record is not None else None
+
+    def record_render_secs(self, file_path, secs):
+        with self._lock:
+            record = self.get(self.render_secs_key(file_path))
+            if record is None:
+                self.set(self.render_secs_key(file_path), {"secs": round(secs, 6), "samples": 1})
+                return
+            smoothed = record["secs"] + self.RENDER_SECS_WEIGHT * (secs - record["secs"])
+            # Small drifts are not saved, a render that costs what it did before leaves the metadata file alone
+            if abs(smoothed - record["secs"]) <= self.RENDER_SECS_TOLERANCE * record["secs"] + 0.001:
+                return
+            self.set(self.render_secs_key(file_path), {"secs": round(smoothed, 6), "samples": record["samples"] + 1})
+
+    def remove_failures(self, files):
         with self.batch_update():
+            for file_path in files:
+                self.remove_failure(file_path)
+
+    def remove_failure(self, file_path):
+        with self._lock:
+            if self._data.pop(self.failure_key(file_path), None) is None:
+                return
+            if self._open_batches == 0:
+                self.save()
+            else:
+                self._batch_changed = True
+
+    def remove_generated_file(self, file_path):
+        with self._lock:
+            self._data.pop(file_path, None)
+            self._data.pop(self.fingerprint_key(file_path), None)
+            if self._open_batches == 0:
+                self.save()
+            else:
+                self._batch_changed = True
+
+    def remove_file_metadata(self, file_path):
+        with self._lock, self.batch_update():
             # Remove the file from dependencies of other files
             dependents = self.get_dependents(file_path)
             for dependent in dependents:
@@ -178,10 +377,14 @@ class MetadataManager:
             # Remove the file's generated files
             generated_files = self.get_generated_files(file_path)
             for generated_file in generated_files:
-                self._data.pop(generated_file, None)
+                self.remove_generated_file(generated_file)
 
             # Remove the file's metadata
             self._data.pop(self.dependencies_key(file_path), None)
             self._data.pop(self.dependents_key(file_path), None)
             self._data.pop(self.generated_files_key(file_path), None)
+            self._data.pop(self.constants_key(file_path), None)
+            self._data.pop(self.failure_key(file_path), None)
+            self._data.pop(self.static_dependencies_key(file_path), None)
+            self._data.pop(self.render_secs_key(file_path), None)
             self._data.pop(file_path, None)
@@ -0,0 +1,265 @@
+import os
+import time
+import functools
+from watchdog.observers import Observer
+from watchdog.observers.api import BaseObserver, EventEmitter, DEFAULT_EMITTER_TIMEOUT
+from watchdog.events import (
+    DirCreatedEvent, DirDeletedEvent, FileCreatedEvent, FileDeletedEvent, FileModifiedEvent
+)
+from .utils import get_logger
+
+OBSERVER_MODES = ("native", "polling", "hybrid")
+
+# Filesystems where inotify does not see changes made by other hosts or the container runtime
+POLLED_FILESYSTEMS = {
+    "nfs", "nfs4", "cifs", "smb3", "smbfs", "9p", "virtiofs", "vboxsf", "prl_fs",
+    "fakeowner", "fuse.grpcfuse", "fuse.sshfs", "fuse.rclone",
+}
+
+# A listing taken this close to the directory mtime may miss entries created in the same timestamp tick
+RACY_MTIME_NS = 2_000_000_000
+
+class StatIndexEmitter(EventEmitter):
+    def __init__(self, event_queue, watch, timeout=DEFAULT_EMITTER_TIMEOUT, event_filter=None,
+                 interval=2, max_interval=30):
+        super().__init__(event_queue, watch, timeout=timeout, event_filter=event_filter)
+        self._logger = get_logger(type(self))
+        self.min_interval = interval
+        self.max_interval = max(interval, max_interval)
+        self.interval = interval
+        self._files = {}
+        self._dirs = {}
+
+    @staticmethod
+    def _file_signature(stat):
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def _list(self, directory, dir_stat, events):
+        # Lists one directory, returning the subdirectories that are new to the index
+        listed_at = time.time_ns()
+        files = set()
+        subdirs = set()
+        new_subdirs = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.add(entry.path)
+                        if entry.path not in self._dirs:
+                            new_subdirs.append(entry.path)
+                        continue
+                    signature = self._file_signature(entry.stat())
+                except OSError:
+                    continue
+                files.add(entry.path)
+                previous = self._files.get(entry.path)
+                self._files[entry.path] = signature
+                if events is not None:
+                    if previous is None:
+                        events.append(FileCreatedEvent(entry.path))
+                    elif previous != signature:
+                        events.append(FileModifiedEvent(entry.path))
+
+        previous = self._dirs.get(directory)
+        if previous is not None:
+            if events is not None:
+                events.extend(DirCreatedEvent(path) for path in sorted(subdirs - previous[3]))
+            for path in previous[2] - files:
+                self._files.pop(path, None)
+                if events is not None:
+                    events.append(FileDeletedEvent(path))
+            for path in previous[3] - subdirs:
+                self._forget(path, events)
+        self._dirs[directory] = (dir_stat.st_mtime_ns, listed_at, files, subdirs)
+        if not self.watch.is_recursive:
+            return []
+        return new_subdirs
+
+    def _scan(self, directory, events):
+        pending = [directory]
+        while pending:
+            current = pending.pop()
+            try:
+                pending.extend(self._list(current, os.stat(current), events))
+            except OSError:
+                continue
+
+    def _forget(self, directory, events):
+        entry = self._dirs.pop(directory, None)
+        if entry is None:
+            # Subdirectory of a non-recursive watch, only its own entry is reported
+            if events is not None and not self.watch.is_recursive:
+                events.append(DirDeletedEvent(directory))
+            return
+        for path in entry[2]:
+            self._files.pop(path, None)
+            if events is not None:
+                events.append(FileDeletedEvent(path))
+        for path in entry[3]:
+            self._forget(path, events)
+        if events is not None:
+            events.append(DirDeletedEvent(directory))
+
+    def on_thread_start(self):
+        self._scan(self.watch.path, None)
+
+    def poll(self):
+        events = []
+        for directory in list(self._dirs):
+            entry = self._dirs.get(directory)
+            if entry is None:
+                continue
+            try:
+                dir_stat = os.stat(directory)
+            except OSError:
+                self._forget(directory, events)
+                continue
+
+            mtime, listed_at, files, _ = entry
+            if dir_stat.st_mtime_ns != mtime or listed_at - mtime < RACY_MTIME_NS:
+                try:
+                    for subdir in self._list(directory, dir_stat, events):
+                        self._scan(subdir, events)
+                except OSError:
+                    self._forget(directory, events)
+                continue
+
+            # Unchanged directory, entries are known so only the files are stat'ed
+            for path in files:
+                try:
+                    signature = self._file_signature(os.stat(path))
+                except OSError:
+                    signature = None
+                if signature is not None and signature != self._files.get(path):
+                    self._files[path] = signature
+                    events.append(FileModifiedEvent(path))
+        return events
+
+    def queue_events(self, timeout):
+        if self.stopped_event.wait(self.interval):
+            return
+
+        started = time.monotonic()
+        events = self.poll()
+        elapsed = time.monotonic() - started
+        for event in events:
+            self.queue_event(event)
+
+        # Fast again right after a change, slower while idle, and a pass never takes over a tenth of the time
+        self.interval = self.min_interval if events else min(self.interval * 2, self.max_interval)
+        self.interval = max(self.interval, elapsed * 10)
+        if events:
+            self._logger.debug("Poll of %s found %s changes in %.3fs", self.watch.path, len(events), elapsed)
+
+class StatIndexObserver(BaseObserver):
+    def __init__(self, interval=2, max_interval=30):
+        super().__init__(functools.partial(StatIndexEmitter, interval=interval, max_interval=max_interval))
+
+class HybridObserver:
+    def __init__(self, interval=2, max_interval=30):
+        self._logger = get_logger(type(self))
+        self.native = Observer()
+        self.polling = StatIndexObserver(interval, max_interval)
+        self._owners = {}
+        self._nested = {}
+
+    @staticmethod
+    def mounts():
+        mounts = []
+        try:
+            with open("/proc/mounts", "r", encoding="utf-8") as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) < 3:
+                        continue
+                    mounts.append((fields[1].replace("\\040", " "), fields[2]))
+        except OSError:
+            return None
+        return mounts
+
+    @classmethod
+    def filesystem_type(cls, path, mounts=None):
+        mounts = cls.mounts() if mounts is None else mounts
+        if mounts is None:
+            return None
+        path = os.path.realpath(path)
+        best = ("", None)
+        for mount_point, filesystem in mounts:
+            if (path == mount_point or path.startswith(mount_point.rstrip("/") + "/")) and len(mount_point) > len(best[0]):
+                best = (mount_point, filesystem)
+        return best[1]
+
+    @staticmethod
+    def _polled_mounts_below(path, mounts):
+        # Shares bind mounted somewhere inside a local tree, like /config/share, are invisible to its inotify watch
+        path = os.path.realpath(path)
+        below = sorted(
+            (mount_point, filesystem) for mount_point, filesystem in mounts
+            if filesystem in POLLED_FILESYSTEMS and mount_point.startswith(path.rstrip("/") + "/")
+        )
+        outermost = []
+        for mount_point, filesystem in below:
+            if not any(mount_point.startswith(outer.rstrip("/") + "/") for outer, _ in outermost):
+                outermost.append((mount_point, filesystem))
+        return outermost
+
+    def schedule(self, event_handler, path, recursive=False):
+        mounts = self.mounts() or []
+        filesystem = self.filesystem_type(path, mounts)
+        if filesystem in POLLED_FILESYSTEMS:
+            self._logger.info(f"👀 Polling {path} on {filesystem}")
+            observer = self.polling
+        else:
+            observer = self.native
+        try:
+            watch = observer.schedule(event_handler, path, recursive=recursive)
+        except OSError as e:
+            if observer is self.polling:
+                raise
+            # Typically the inotify watch limit on large trees
+            self._logger.warning(f"MAKO-028 ⚠️ Native watch of {path} failed, polling it instead: {e}")
+            observer = self.polling
+            watch = observer.schedule(event_handler, path, recursive=recursive)
+        self._owners[watch] = observer
+
+        if recursive and observer is self.native:
+            nested = []
+            real_path = os.path.realpath(path)
+            for mount_point, mount_filesystem in self._polled_mounts_below(path, mounts):
+                # Watched under the configured path so that events carry the same paths as the native ones
+                subtree = os.path.join(path, os.path.relpath(mount_point, real_path))
+                self._logger.info(f"👀 Polling {subtree} on {mount_filesystem} inside {path}")
+                nested.append(self.polling.schedule(event_handler, subtree, recursive=True))
+            if nested:
+                self._nested[watch] = nested
+        return watch
+
+    def unschedule(self, watch):
+        self._owners.pop(watch).unschedule(watch)
+        for nested in self._nested.pop(watch, []):
+            self.polling.unschedule(nested)
+
+    def unschedule_all(self):
+        self._owners.clear()
+        self._nested.clear()
+        self.native.unschedule_all()
+        self.polling.unschedule_all()
+
+    def start(self):
+        self.native.start()
+        self.polling.start()
+
+    def stop(self):
+        self.native.stop()
+        self.polling.stop()
+
+    def join(self):
+        self.native.join()
+        self.polling.join()
+
+def create_observer(run_config):
+    if run_config.hot_reload_observer == "polling":
+        return StatIndexObserver(run_config.poll_interval_secs, run_config.poll_interval_max_secs)
+    if run_config.hot_reload_observer == "hybrid":
+        return HybridObserver(run_config.poll_interval_secs, run_config.poll_interval_max_secs)
+    return Observer()
@@ -1,27 +1,143 @@
-import os
+import math
 import threading
+import itertools
 import contextlib
 import logging
-from queue import Queue, Empty
+from queue import Queue, PriorityQueue, Empty
 import time
+from .metadata import MetadataManager
 from .template_renderer import TemplateRenderer
 from .reload_worker import ReloadWorker
-from .utils import ThreadSafeSet, get_logger
+from .governor import ResourceGovernor
+from .stat_cache import StatCache
+from .utils import FileMatcher, Scheduler, ThreadSafeSet, get_logger
 import traceback
 
+LANES = ("render", "serialize", "python_serialize")
+# Sorts ahead of every queued file
+STOP = (-math.inf, -1, None)
+
+class BatchBudget:
+    # Guess for a source that has never been rendered, replaced by what the lane observes
+    DEFAULT_FILE_SECS = 0.05
+    WEIGHT = 0.3
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.metadata = MetadataManager()
+        self.file_secs = self.DEFAULT_FILE_SECS
+        self.overhead_secs = 0.0
+
+    def estimate(self, file_path):
+        secs = self.metadata.get_render_secs(file_path)
+        return secs if secs is not None else self.file_secs
+
+    @property
+    def budget(self):
+        # Raised when the fixed cost of a batch (publish barrier, metadata save) would be over a tenth of it
+        target = self.worker.run_config.batch_budget_secs
+        return max(target, self.overhead_secs * 10) if target else None
+
+    def observe(self, batch_files, elapsed):
+        recorded = [secs for secs in map(self.metadata.get_render_secs, batch_files) if secs is not None]
+        if recorded:
+            self.file_secs += self.WEIGHT * (sum(recorded) / len(recorded) - self.file_secs)
+        overhead = max(0.0, elapsed - sum(recorded))
+        self.overhead_secs += self.WEIGHT * (overhead - self.overhead_secs)
+
+class Lane:
+    def __init__(self, worker, name, index, renderer):
+        self._logger = get_logger(type(self))
+        self.worker = worker
+        self.name = f"{name}-{index}"
+        self.renderer = renderer
+        self.queue = PriorityQueue()
+        self.queued_files = ThreadSafeSet()
+        self.budget = BatchBudget(worker)
+        self._sequence = itertools.count()
+        PreprocessorWorker.Lock.register(self.name)
+        self.thread = threading.Thread(target=self._process_queue, name=f"mako-{self.name}", daemon=True)
+        self.thread.start()
+
+    def add_file(self, file_path):
+        if file_path in self.queued_files:
+            return False
+        self.queued_files.add(file_path)
+        # Slowest renders first, so that a lane does not end on a long file while the others sit idle
+        self.queue.put((-self.budget.estimate(file_path), next(self._sequence), file_path))
+        return True
+
+    def _collect_batch(self, item):
+        # Batches are cut at the time budget, the lane lock is held for about as long whatever the files
+        batch_files = [item[2]]
+        cost = -item[0]
+        budget = self.budget.budget
+        while len(batch_files) < self.worker.run_config.batch_size:
+            try:
+                item = self.queue.get_nowait()
+            except Empty:
+                break
+            if item[2] is None:
+                # Left for the loop, which stops on it
+                self.queue.put(item)
+                break
+            if budget is not None and cost - item[0] > budget:
+                self.queue.put(item)
+                break
+            cost -= item[0]
+            batch_files.append(item[2])
+        for batch_file in batch_files:
+            self.queued_files.remove(batch_file)
+        return batch_files
+
+    def _process_queue(self):
+        self._logger.debug("Starting lane %s", self.name)
+        while not self.worker.stop_event.is_set():
+            item = self.queue.get()
+            if item[2] is None:
+                continue
+            batch_files = self._collect_batch(item)
+            changed_files = 0
+            try:
+                self.worker.governor.before_batch(self.worker.stop_event)
+                usage = self.worker.governor.usage()
+                with PreprocessorWorker.Lock.acquire(self.name):
+                    started = time.monotonic()
+                    changed_files = self.renderer.process_batch(batch_files, expand_dependents=False)
+                    elapsed = time.monotonic() - started
+                    deferred_files = self.renderer.pop_deferred_files()
+                self.worker.governor.charge(usage)
+                self.budget.observe(batch_files, elapsed)
+                self._logger.debug("Lane %s rendered %s files in %.3fs", self.name, len(batch_files), elapsed)
+                self.worker._schedule_deferred(deferred_files)
+            except Exception as e:
+                self._logger.error(f"MAKO-015 Error in preprocessor lane {self.name}: {e}\n{traceback.format_exc()}")
+            finally:
+                self.worker._track_work(-len(batch_files), changed_files)
+
 class PreprocessorWorker:
     _instance = None
     _lock = threading.Lock()
 
     class Lock:
-        _thread_lock = threading.Lock()
+        _locks = {}
+        _registry_lock = threading.Lock()
+
+        @classmethod
+        def register(cls, name):
+            with cls._registry_lock:
+                return cls._locks.setdefault(name, threading.Lock())
 
         @classmethod
         @contextlib.contextmanager
-        def acquire(cls):
+        def acquire(cls, name=None):
             _logger = get_logger("PreprocessorWorker.Lock")
-            _logger.debug("Acquiring locks")
-            with cls._thread_lock:
+            _logger.debug("Acquiring locks: %s", name or 'all lanes')
+            with cls._registry_lock:
+                locks = [cls._locks[name]] if name is not None else [cls._locks[key] for key in sorted(cls._locks)]
+            with contextlib.ExitStack() as stack:
+                for lock in locks:
+                    stack.enter_context(lock)
                 _logger.debug("Acquired thread lock")
                 yield
             _logger.debug("Released thread lock")
@@ -30,8 +146,10 @@ class PreprocessorWorker:
         if cls._instance is None:
             with cls._lock:
                 if cls._instance is None:
-                    cls._instance = super().__new__(cls)
-                    cls._instance._initialize(run_config)
+                    # Published only once initialized, setup and service calls may construct it from different threads
+                    instance = super().__new__(cls)
+                    instance._initialize(run_config)
+                    cls._instance = instance
         elif run_config is not None:
             cls._instance.run_config = run_config
         return cls._instance
@@ -47,32 +165,96 @@ class PreprocessorWorker:
         self.pending_hot_reload = {}
         self.queued_files = ThreadSafeSet()
         self.scheduled_files = ThreadSafeSet()
+        self.deferred_files = ThreadSafeSet()
+        self.scheduler = Scheduler("mako-scheduler")
+        self.governor = ResourceGovernor(self)
         self.reload_worker = ReloadWorker(run_config)
+        self._pending_work = 0
+        self._coordinator_lock = threading.Lock()
+        self.idle = threading.Event()
+        self.idle.set()
+        self.idle_callbacks = []
+        # Run on the scheduler thread when work arrives at an idle pipeline
+        self.busy_callbacks = [self.governor.start_probing]
+        self.lanes = {}
+        for name in LANES:
+            self.lanes[name] = [
+                Lane(self, name, index, self._lane_renderer(name, index))
+                for index in range(self.run_config.lane_workers.get(name, 1))
+            ]
         self.worker_thread = threading.Thread(target=self._process_queue, daemon=True)
         self.worker_thread.start()
 
+    def _lane_renderer(self, name, index):
+        if name == LANES[0] and index == 0:
+            return self.template_renderer
+        return TemplateRenderer(self.run_config, render_cache=self.template_renderer.render_cache)
+
+    def renderers(self):
+        return [lane.renderer for lanes in self.lanes.values() for lane in lanes]
+
+    def _lane_for(self, file_path):
+        file_type, ext = FileMatcher.get_file_type(file_path, self.run_config)
+        if file_type != "serialize":
+            return LANES[0]
+        if file_path[:-len(ext)].endswith(".py"):
+            return "python_serialize"
+        return "serialize"
+
+    def _route(self, file_path):
+        lanes = self.lanes[self._lane_for(file_path)]
+        # The same source always lands on the same thread of its lane, so it is never rendered twice at once
+        lane = lanes[hash(file_path) % len(lanes)]
+        if lane.add_file(file_path):
+            self._track_work(1)
+
+    def _track_work(self, delta, changed_files=0):
+        # A single reload is requested once every lane has drained, however the work was spread
+        with self._coordinator_lock:
+            self._pending_work += delta
+            if self._pending_work:
+                if self.idle.is_set():
+                    self.idle.clear()
+                    for callback in self.busy_callbacks:
+                        self.scheduler.call_later(0, callback)
+            elif not self.idle.is_set():
+                self.idle.set()
+                for callback in self.idle_callbacks:
+                    self.scheduler.call_later(0, callback)
+            if changed_files:
+                self.reload_pending = True
+            if (self._pending_work == 0 and self.reload_pending
+                    and self.render_queue.empty() and self.scheduled_files.empty()):
+                self.reload_pending = False
+                self.reload_worker.request_reload()
+
+    def wait_idle(self, timeout=None):
+        return self.idle.wait(timeout)
+
     def add_file(self, file_path, from_hot_reload=False):
-        self._logger.debug(f"Add file to queue: {file_path}, from_hot_reload: {from_hot_reload}")
+        self._logger.debug("Add file to queue: %s, from_hot_reload: %s", file_path, from_hot_reload)
         if file_path in self.queued_files or (from_hot_reload and file_path in self.scheduled_files):
             return
         
         self.queued_files.add(file_path)
+        self._track_work(1)
         self.render_queue.put((file_path, from_hot_reload))
 
     def add_files(self, files):
-        self._logger.debug(f"Add multiple files to queue: {files}")
+        self._logger.debug("Add multiple files to queue: %s", files)
         for file_path in files:
             self.add_file(file_path)
 
     def _should_process_file(self, file_path, from_hot_reload):
-        self._logger.debug(f"Checking if file should be processed: {file_path}, from_hot_reload: {from_hot_reload}")
+        self._logger.debug("Checking if file should be processed: %s, from_hot_reload: %s", file_path, from_hot_reload)
         
-        if not os.path.exists(file_path) or not from_hot_reload:
+        stat = StatCache.stat(file_path)
+        if stat is None or not from_hot_reload:
             return {"should_process": True, "retry_after": None}
          
         try:
             current_time = time.time()
-            file_mod_time = os.path.getmtime(file_path)
+            file_mod_time = stat.st_mtime
             
             if file_path in self.pending_hot_reload:
                 last_known_mod_time = self.pending_hot_reload[file_path]
@@ -90,72 +272,90 @@ class PreprocessorWorker:
             self._logger.error(f"MAKO-014 Error checking file {file_path}: {traceback.format_exc()}")
             return {"should_process": False, "retry_after": None}
 
+    def _schedule_deferred(self, deferred_files):
+        # Backed off sources are retried on their own timer and do not hold back the reload of other changes
+        for file_path, retry_at in deferred_files.items():
+            if file_path in self.deferred_files:
+                continue
+            self.deferred_files.add(file_path)
+            self.scheduler.call_later(max(0, retry_at - time.time()), lambda file_path=file_path: self._retry_deferred(file_path))
+
+    def _retry_deferred(self, file_path):
+        self.deferred_files.remove(file_path)
+        self.add_file(file_path)
+
     def _schedule_retry(self, file_path, retry_after, from_hot_reload):
         self.scheduled_files.add(file_path)
-        threading.Timer(
-            retry_after,
-            lambda: self._reschedule_file(file_path, from_hot_reload)
-        ).start()
+        self.scheduler.call_later(retry_after, lambda: self._reschedule_file(file_path, from_hot_reload))
 
     def _collect_batch_files(self, file_path, from_hot_reload):
         batch_files = set()
-        while len(batch_files) < self.run_config.batch_size:
-            try:
-                self.render_queue.task_done()
-                self.queued_files.remove(file_path)
-
-                if file_path in batch_files:
-                    continue
+        consumed = 0
+        while True:
+            self.render_queue.task_done()
+            self.queued_files.remove(file_path)
+            consumed += 1
 
+            if file_path not in batch_files:
                 result = self._should_process_file(file_path, from_hot_reload)
                 if result["should_process"]:
                     batch_files.add(file_path)
                 elif result["retry_after"] is not None:
                     self._schedule_retry(file_path, result["retry_after"], from_hot_reload)
-                
-                if len(batch_files) >= self.run_config.batch_size:
-                    break
 
-                file_path, from_hot_reload = self.render_queue.get_nowait()
+            if len(batch_files) >= self.run_config.batch_size:
+                break
+
+            try:
+                item = self.render_queue.get_nowait()
             except Empty:
                 break
-        return batch_files
+            if item is None:
+                # Left for the loop, which stops on it
+                self.render_queue.task_done()
+                self.render_queue.put(None)
+                break
+            file_path, from_hot_reload = item
+        return batch_files, consumed
 
     def _process_queue(self):
-        self._logger.debug("Starting to process queue")
+        self._logger.debug("Starting to dispatch queue")
         while not self.stop_event.is_set():
+            consumed = 0
             try:
-                batch_files = None
-                self._logger.debug(f"Checking queue {self.render_queue.qsize()}")
-                file_path, from_hot_reload = self.render_queue.get(timeout=1)
-                batch_files = self._collect_batch_files(file_path, from_hot_reload)
-                self._logger.debug(f"Collected batch of files: {len(batch_files)}")
-                if batch_files:
-                    with self.Lock.acquire():
-                        self.template_renderer.process_batch(list(batch_files))
-                        self.reload_pending = True
-                
-                if self.render_queue.empty() and self.scheduled_files.empty() and self.reload_pending:
-                    self.reload_worker.request_reload()
-                    self.reload_pending = False
-            except Empty:
-                continue
+                self._logger.debug("Checking queue %s", self.render_queue.qsize())
+                item = self.render_queue.get()
+                if item is None:
+                    self.render_queue.task_done()
+                    continue
+                batch_files, consumed = self._collect_batch_files(*item)
+                self._logger.debug("Collected batch of files: %s", len(batch_files))
+                for batch_file in sorted(batch_files):
+                    for target in self.template_renderer.targets(batch_file):
+                        self._route(target)
             except Exception as e:
                 self._logger.error(f"MAKO-015 Error in preprocessor worker: {e}\n{traceback.format_exc()}")
-                continue
+            finally:
+                if consumed:
+                    self._track_work(-consumed)
 
     def schedule_hot_reload(self, file_path):
-        self._logger.debug(f"Scheduling hot reload: {file_path}")
+        self._logger.debug("Scheduling hot reload: %s", file_path)
         if file_path in self.scheduled_files:
             return
         
-        self._schedule_retry(file_path, self.run_config.hot_reload_delay_secs, from_hot_reload=True)
+        delay = self.run_config.hot_reload_delay_secs + self.governor.hot_reload_delay()
+        self._schedule_retry(file_path, delay, from_hot_reload=True)
 
     def _reschedule_file(self, file_path, from_hot_reload):
-        self._logger.debug(f"Rescheduling file: {file_path}, from_hot_reload: {from_hot_reload}")
+        self._logger.debug("Rescheduling file: %s, from_hot_reload: %s", file_path, from_hot_reload)
         self.scheduled_files.remove(file_path)
         self.add_file(file_path, from_hot_reload)
 
     def stop(self):
         self._logger.debug("Stopping PreprocessorWorker")
-        self.stop_event.set()
\ No newline at end of file
+        self.stop_event.set()
+        # Wakes the blocked threads, nothing polls
+        self.render_queue.put(None)
+        for lane in (lane for lanes in self.lanes.values() for lane in lanes):
+            lane.queue.put(STOP)
\ No newline at end of file
@@ -0,0 +1,277 @@
+import os
+import json
+import shutil
+import threading
+import traceback
+import contextlib
+from .utils import get_logger
+
+CURRENT_GENERATION = "current"
+# Lists the generations whose directories a generation shares, so pruning keeps them
+SHARED_FILE = ".mako_shared"
+
+class OutputPublisher:
+    _generation_lock = threading.Lock()
+
+    def __init__(self, run_config):
+        self._logger = get_logger(type(self))
+        self._logger.debug("Initializing OutputPublisher")
+        self.run_config = run_config
+        self._staged = {}
+        self._removed = set()
+        self._lock = threading.Lock()
+
+    def stage(self, output_path, staged_path, template_path, user_changed=False):
+        with self._lock:
+            previous = self._staged.pop(output_path, None)
+            self._staged[output_path] = (staged_path, template_path, user_changed)
+        if previous is not None:
+            with contextlib.suppress(OSError):
+                os.remove(previous[0])
+
+    def mark_removed(self, output_path):
+        # Removed outputs are left out of the next generation, whichever batch publishes it
+        if self.run_config.publish_mode != "generations":
+            return
+        with self._lock:
+            self._removed.add(os.path.abspath(output_path))
+
+    def discard(self):
+        with self._lock:
+            staged, self._staged = self._staged, {}
+        for staged_path, _, _ in staged.values():
+            with contextlib.suppress(OSError):
+                os.remove(staged_path)
+
+    @staticmethod
+    def _fsync(path):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            # Some filesystems refuse fsync on directories
+            pass
+        finally:
+            os.close(fd)
+
+    def _sync(self, files):
+        # Only the batch's own files are flushed, os.sync() would write back every filesystem on the host
+        if self.run_config.publish_sync:
+            for path in files:
+                self._fsync(path)
+
+    def _sync_directories(self, paths):
+        if self.run_config.publish_sync:
+            for directory in sorted({os.path.dirname(os.path.abspath(path)) for path in paths}):
+                self._fsync(directory)
+
+    def publish(self, backup_file):
+        with self._lock:
+            staged, self._staged = self._staged, {}
+            if not staged:
+                return {}
+            removed, self._removed = self._removed, set()
+
+        self._logger.debug("Publishing %s staged outputs", len(staged))
+        if self.run_config.publish_mode == "generations":
+            with self._generation_lock:
+                return self._publish_generation(staged, removed, backup_file)
+
+        self._sync(staged_path for staged_path, _, _ in staged.values())
+        published = {}
+        for output_path, (staged_path, template_path, user_changed) in staged.items():
+            try:
+                mtime = os.stat(staged_path).st_mtime
+                if user_changed:
+                    backup_file(output_path)
+                os.replace(staged_path, output_path)
+                published[output_path] = mtime
+                self._logger.info(f"✅ {template_path} -> {output_path}")
+            except OSError as e:
+                self._logger.error(f"MAKO-006 ❌ Error processing {template_path}: {e}\n{traceback.format_exc()}")
+                with contextlib.suppress(OSError):
+                    os.remove(staged_path)
+        self._sync_directories(published)
+        return published
+
+    @property
+    def generations_root(self):
+        return os.path.abspath(self.run_config.generations_directory)
+
+    def _generation_path(self, generation, output_path):
+        return os.path.join(self.generations_root, str(generation), os.path.abspath(output_path).lstrip(os.sep))
+
+    def _output_link_target(self, output_path):
+        return self._generation_path(CURRENT_GENERATION, output_path)
+
+    def current_generation(self):
+        try:
+            return int(os.readlink(os.path.join(self.generations_root, CURRENT_GENERATION)))
+        except (OSError, ValueError):
+            return None
+
+    def generations(self):
+        if not os.path.isdir(self.generations_root):
+            return []
+        return sorted(int(name) for name in os.listdir(self.generations_root) if name.isdigit())
+
+    @staticmethod
+    def _replace_with_symlink(link_target, link_path):
+        temp_link = f"{link_path}.mako-link.tmp"
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_link)
+        os.symlink(link_target, temp_link)
+        os.replace(temp_link, link_path)
+
+    def _carry_over(self, previous_generation, new_generation, changed):
+        # Directories without changed or removed outputs are shared with a symlink to where their files
+        # really are, only the directories on the way to a change are rebuilt with hard links
+        previous_dir = os.path.join(self.generations_root, str(previous_generation))
+        new_dir = os.path.join(self.generations_root, str(new_generation))
+        dirty = set()
+        for output_path in changed:
+            relative = os.path.dirname(os.path.abspath(output_path).lstrip(os.sep))
+            while relative not in dirty:
+                dirty.add(relative)
+                if not relative:
+                    break
+                relative = os.path.dirname(relative)
+        shared = set()
+        pending = [""]
+        while pending:
+            relative = pending.pop()
+            try:
+                entries = list(os.scandir(os.path.join(previous_dir, relative)))
+            except OSError:
+                continue
+            for entry in entries:
+                child = os.path.join(relative, entry.name)
+                if not relative and entry.name == SHARED_FILE:
+                    continue
+                new_path = os.path.join(new_dir, child)
+                if entry.is_dir():
+                    if child in dirty:
+                        os.makedirs(new_path, exist_ok=True)
+                        pending.append(child)
+                        continue
+                    target = os.path.realpath(entry.path)
+                    os.symlink(target, new_path)
+                    shared.add(os.path.relpath(target, self.generations_root).split(os.sep)[0])
+                elif os.sep + child not in changed:
+                    os.link(entry.path, new_path)
+        shared.discard(str(new_generation))
+        with open(os.path.join(new_dir, SHARED_FILE), "w", encoding="utf-8") as f:
+            json.dump(sorted(shared), f)
+
+    def _shared_generations(self, generation):
+        try:
+            with open(os.path.join(self.generations_root, str(generation), SHARED_FILE), "r", encoding="utf-8") as f:
+                return {int(name) for name in json.load(f) if str(name).isdigit()}
+        except (OSError, ValueError):
+            return set()
+
+    def _publish_generation(self, staged, removed, backup_file):
+        os.makedirs(self.generations_root, exist_ok=True)
+        current_generation = self.current_generation()
+        new_generation = max(self.generations(), default=0) + 1
+        os.makedirs(os.path.join(self.generations_root, str(new_generation)))
+        if current_generation is not None:
+            changed = {os.path.abspath(output_path) for output_path in staged} | removed
+            self._carry_over(current_generation, new_generation, changed)
+
+        published = {}
+        for output_path, (staged_path, template_path, user_changed) in staged.items():
+            try:
+                generation_path = self._generation_path(new_generation, output_path)
+                os.makedirs(os.path.dirname(generation_path), exist_ok=True)
+                mtime = os.stat(staged_path).st_mtime
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(generation_path)
+                shutil.move(staged_path, generation_path)
+                published[output_path] = (mtime, template_path, user_changed)
+            except OSError as e:
+                self._logger.error(f"MAKO-006 ❌ Error processing {template_path}: {e}\n{traceback.format_exc()}")
+                with contextlib.suppress(OSError):
+                    os.remove(staged_path)
+
+        generation_paths = [self._generation_path(new_generation, output_path) for output_path in published]
+        self._sync(generation_paths)
+        self._sync_directories(generation_paths)
+        self._replace_with_symlink(str(new_generation), os.path.join(self.generations_root, CURRENT_GENERATION))
+        self._sync_directories([os.path.join(self.generations_root, CURRENT_GENERATION)])
+
+        result = {}
+        for output_path, (mtime, template_path, user_changed) in published.items():
+            try:
+                link_target = self._output_link_target(output_path)
+                if not os.path.islink(output_path) or os.readlink(output_path) != link_target:
+                    if user_changed:
+                        backup_file(output_path)
+                    self._replace_with_symlink(link_target, output_path)
+                result[output_path] = mtime
+                self._logger.info(f"✅ {template_path} -> {output_path} (generation {new_generation})")
+            except OSError as e:
+                self._logger.error(f"MAKO-006 ❌ Error processing {template_path}: {e}\n{traceback.format_exc()}")
+
+        self._prune_generations()
+        return result
+
+    def _prune_generations(self):
+        current_generation = self.current_generation()
+        generations = [generation for generation in self.generations() if generation != current_generation]
+        pruned = generations[:max(0, len(generations) - self.run_config.generations_keep + 1)]
+        # Generations holding directories that kept ones share stay until nothing points into them
+        needed = set()
+        pending = [generation for generation in self.generations() if generation not in pruned]
+        while pending:
+            for shared in self._shared_generations(pending.pop()) - needed:
+                needed.add(shared)
+                pending.append(shared)
+        for generation in pruned:
+            if generation in needed:
+                continue
+            shutil.rmtree(os.path.join(self.generations_root, str(generation)), ignore_errors=True)
+            self._logger.debug("Pruned generation %s", generation)
+
+    def rollback(self):
+        with self._generation_lock:
+            return self._rollback()
+
+    def _rollback(self):
+        current_generation = self.current_generation()
+        previous_generations = [
+            generation for generation in self.generations()
+            if current_generation is None or generation < current_generation
+        ]
+        if not previous_generations:
+            return None
+        target_generation = previous_generations[-1]
+        target_outputs = set(self.generation_outputs(target_generation))
+        current_outputs = set(self.generation_outputs(current_generation)) if current_generation is not None else set()
+        self._replace_with_symlink(str(target_generation), os.path.join(self.generations_root, CURRENT_GENERATION))
+
+        # Outputs only the newer generation had would be left dangling, outputs removed since are linked again
+        for output_path in current_outputs - target_outputs:
+            link_target = self._output_link_target(output_path)
+            if os.path.islink(output_path) and os.readlink(output_path) == link_target:
+                with contextlib.suppress(OSError):
+                    os.remove(output_path)
+        for output_path in target_outputs - current_outputs:
+            if not os.path.lexists(output_path):
+                with contextlib.suppress(OSError):
+                    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                    self._replace_with_symlink(self._output_link_target(output_path), output_path)
+        self._logger.info(f"⏪ Rolled back outputs to generation {target_generation}")
+        return target_generation
+
+    def generation_outputs(self, generation):
+        generation_dir = os.path.join(self.generations_root, str(generation))
+        # Shared directories are symlinks, so the walk follows them
+        for root, _, files in os.walk(generation_dir, followlinks=True):
+            for name in files:
+                if root == generation_dir and name == SHARED_FILE:
+                    continue
+                yield os.sep + os.path.relpath(os.path.join(root, name), generation_dir)
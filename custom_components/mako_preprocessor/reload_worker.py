@@ -2,6 +2,7 @@ import threading
 import time
 from queue import Queue, Empty
 from .utils import get_logger
+from .trace import PipelineProbe
 
 class ReloadWorker:
     _instance = None
@@ -30,63 +31,34 @@ class ReloadWorker:
         last_request_time = first_request_time
 
         while not self.stop_event.is_set():
-            time_to_wait_from_last = self.run_config.reload_wait_min_secs - (time.time() - last_request_time)
-            min_wait_time = time_to_wait_from_last
+            # Blocks until the next request or the moment the reload is due, whichever comes first
+            deadline = last_request_time + self.run_config.reload_wait_min_secs
+            if getattr(self.run_config, 'reload_wait_max_secs', None):
+                deadline = min(deadline, first_request_time + self.run_config.reload_wait_max_secs)
 
-            if (hasattr(self.run_config, 'reload_wait_max_secs') and 
-                self.run_config.reload_wait_max_secs):
-                time_to_wait_from_first = self.run_config.reload_wait_max_secs - (time.time() - first_request_time)
-                if time_to_wait_from_first < min_wait_time:
-                    min_wait_time = time_to_wait_from_first
-
-            if min_wait_time > 0:
-                try:
-                    while min_wait_time > 1:
-                        min_wait_time -= 1
-                        if self.stop_event.is_set():
-                            break
-                        self.reload_queue.get(timeout=1)
-                    if self.stop_event.is_set():
-                        break
-
-                    last_request_time = self.reload_queue.get(timeout=min_wait_time)
-                except Empty:
-                    self.reload_ha()
-                    break
-
-            while not self.reload_queue.empty():
-                last_request_time = self.reload_queue.get_nowait()
-        
-            current_time = time.time()
-            time_since_first = current_time - first_request_time
-            time_since_last = current_time - last_request_time
-
-            # Проверяем максимальное время ожидания
-            if (hasattr(self.run_config, 'reload_wait_max_secs') and 
-                self.run_config.reload_wait_max_secs and 
-                time_since_first >= self.run_config.reload_wait_max_secs):
-                self._logger.debug("Maximum wait time exceeded, reloading")
+            try:
+                request_time = self.reload_queue.get(timeout=max(0, deadline - time.time()))
+            except Empty:
+                self._logger.debug("Reload wait time elapsed, reloading")
                 self.reload_ha()
                 break
-            
-            # Проверяем минимальное время с последнего запроса
-            if time_since_last >= self.run_config.reload_wait_min_secs:
-                self._logger.debug("Minimum wait time after last request met, reloading")
-                self.reload_ha()
+            if request_time is None:
                 break
+            last_request_time = request_time
 
     def _reload_worker(self):
         self._logger = get_logger(type(self))
         self._logger.debug("Starting reload worker thread")
 
         while not self.stop_event.is_set():
-            try:
-                self._process_debounce(self.reload_queue.get(timeout=1))
-            except Empty:
-                continue
+            request_time = self.reload_queue.get()
+            if request_time is not None:
+                self._process_debounce(request_time)
 
     def reload_ha(self):
         self._logger.debug("Reloading Home Assistant")
+        if PipelineProbe.listeners:
+            PipelineProbe.emit("reload", behavior=self.run_config.reload_behavior)
         if self.run_config.reload_behavior == "reload_core_config":
             self._logger.info("🔄 Reloading Home Assistant core config")
             self.run_config.hass.services.call("homeassistant", "reload_core_config")
@@ -103,3 +75,4 @@ class ReloadWorker:
     def stop(self):
         self._logger.debug("Stopping ReloadWorker")
         self.stop_event.set()
+        self.reload_queue.put(None)
@@ -0,0 +1,90 @@
+import os
+import threading
+import contextlib
+from collections import OrderedDict
+from .utils import get_logger
+
+CACHE_DIR = os.path.join(".mako_cache", "renders")
+
+class RenderCache:
+    def __init__(self, run_config):
+        self._logger = get_logger(type(self))
+        self._logger.debug("Initializing RenderCache")
+        self.run_config = run_config
+        self._entries = None
+        self._total_size = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.run_config.render_cache_size_mb > 0
+
+    @property
+    def max_size(self):
+        return self.run_config.render_cache_size_mb * 1024 * 1024
+
+    def _entry_path(self, key):
+        return os.path.join(CACHE_DIR, f"{key}.txt")
+
+    def _load_index(self):
+        # Entry mtimes are bumped on every hit, so sorting by mtime restores the LRU order
+        entries = []
+        if os.path.isdir(CACHE_DIR):
+            with os.scandir(CACHE_DIR) as it:
+                for entry in it:
+                    if entry.is_file() and entry.name.endswith(".txt"):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime_ns, entry.name[:-len(".txt")], stat.st_size))
+        entries.sort()
+        self._entries = OrderedDict((key, size) for _, key, size in entries)
+        self._total_size = sum(self._entries.values())
+        self._logger.debug("Render cache index loaded: %s entries, %s bytes", len(self._entries), self._total_size)
+
+    def _drop(self, key):
+        size = self._entries.pop(key, None)
+        if size is not None:
+            self._total_size -= size
+        with contextlib.suppress(OSError):
+            os.remove(self._entry_path(key))
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        with self._lock:
+            if self._entries is None:
+                self._load_index()
+            if key not in self._entries:
+                return None
+            try:
+                with open(self._entry_path(key), "rb") as f:
+                    data = f.read()
+                os.utime(self._entry_path(key))
+            except OSError:
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+        self._logger.debug("Render cache hit: %s", key)
+        return data.decode("utf-8")
+
+    def put(self, key, rendered_output):
+        if not self.enabled:
+            return
+        data = rendered_output.encode("utf-8")
+        with self._lock:
+            if self._entries is None:
+                self._load_index()
+            try:
+                os.makedirs(CACHE_DIR, exist_ok=True)
+                temp_path = f"{self._entry_path(key)}.tmp"
+                with open(temp_path, "wb") as f:
+                    f.write(data)
+                os.replace(temp_path, self._entry_path(key))
+            except OSError as e:
+                self._logger.warning(f"MAKO-021 ⚠️ Unable to write render cache entry {key}: {e}")
+                return
+            self._total_size += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            while self._total_size > self.max_size and len(self._entries) > 1:
+                evicted_key = next(iter(self._entries))
+                self._drop(evicted_key)
+                self._logger.debug("Render cache entry evicted: %s", evicted_key)
@@ -0,0 +1,145 @@
+import os
+import threading
+import traceback
+import multiprocessing
+from .utils import get_logger
+
+STARTUP_TIMEOUT_SECS = 120
+
+class RenderTimeout(Exception):
+    pass
+
+def _serve(conn, nice):
+    from mako.template import Template
+    from mako.runtime import Context
+    from .data_loader import DataLoader
+    from .fragment_cache import FragmentCache, PLUGIN_NAME as CACHE_PLUGIN_NAME
+    from .template_renderer import TemplateRenderer
+    from .utils import TrackingMapping
+    from .governor import lower_priority
+
+    lower_priority(nice)
+    data_loader = DataLoader()
+    lookup = None
+    directories = None
+    compiled = {}
+    conn.send("ready")
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+
+        run_config = request["run_config"]
+        if run_config.render_nice != nice:
+            nice = run_config.render_nice
+            lower_priority(nice)
+        FragmentCache(run_config)
+        if directories != run_config.directories:
+            directories = run_config.directories
+            lookup = None if run_config.is_template_disabled() else TemplateRenderer.TrackingUrisLookup(
+                directories=directories, input_encoding='utf-8', output_encoding='utf-8', cache_impl=CACHE_PLUGIN_NAME
+            )
+            compiled.clear()
+
+        template_path = request["template_path"]
+        constants = TrackingMapping(run_config.constants)
+        data_dependencies = set()
+        response = { "output": None, "error": None }
+        if lookup is not None:
+            lookup.fetch_files_and_clear()
+        try:
+            with FragmentCache.rendering(request["source"]) as scope:
+                scope.dependencies = [data_dependencies] + ([lookup.requested_files] if lookup else [])
+                scope.constants = constants
+                mtime = os.stat(template_path).st_mtime_ns
+                if compiled.get(template_path, (None,))[0] != mtime:
+                    compiled[template_path] = (
+                        mtime, Template(filename=template_path, lookup=lookup, cache_impl=CACHE_PLUGIN_NAME)
+                    )
+                template = compiled[template_path][1]
+                render_args = {
+                    "variables": request["variables"],
+                    "constants": constants,
+                    "load_data": data_loader.bind(os.path.dirname(template_path), data_dependencies),
+                }
+                if request.get("staged_path"):
+                    with open(request["staged_path"], "w", encoding="utf-8") as f:
+                        f.write(request["prefix"])
+                        template.render_context(Context(f, **render_args))
+                        f.write(request["postfix"])
+                else:
+                    response["output"] = template.render(**render_args)
+        except Exception as e:
+            response["error"] = f"{e}\n{traceback.format_exc()}"
+        response["dependencies"] = lookup.fetch_files_and_clear() if lookup is not None else []
+        response["dependencies"].extend(sorted(data_dependencies))
+        response["constants"] = sorted(constants.accessed)
+        conn.send(response)
+
+class RenderSupervisor:
+    _live_pids = set()
+    _live_lock = threading.Lock()
+
+    def __init__(self, run_config):
+        self._logger = get_logger(type(self))
+        self._logger.debug("Initializing RenderSupervisor")
+        self.run_config = run_config
+        self._context = multiprocessing.get_context("spawn")
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(target=_serve, args=(child_conn, self.run_config.render_nice), name="mako-render", daemon=True)
+        process.start()
+        with RenderSupervisor._live_lock:
+            RenderSupervisor._live_pids.add(process.pid)
+        child_conn.close()
+        # Interpreter startup must not count against the render timeout
+        if not parent_conn.poll(STARTUP_TIMEOUT_SECS) or parent_conn.recv() != "ready":
+            self._kill((process, parent_conn))
+            raise RuntimeError("Render process failed to start")
+        self._logger.debug("Render process started: %s", process.pid)
+        return process, parent_conn
+
+    def _kill(self, worker):
+        process, conn = worker
+        with RenderSupervisor._live_lock:
+            RenderSupervisor._live_pids.discard(process.pid)
+        process.kill()
+        process.join()
+        conn.close()
+
+    @staticmethod
+    def live_pids():
+        with RenderSupervisor._live_lock:
+            return list(RenderSupervisor._live_pids)
+
+    def render(self, request, timeout):
+        with self._lock:
+            worker = self._idle.pop() if self._idle else None
+        if worker is None or not worker[0].is_alive():
+            worker = self._start()
+
+        process, conn = worker
+        try:
+            conn.send(request)
+            if not conn.poll(timeout):
+                self._logger.debug("Killing render process %s after %ss", process.pid, timeout)
+                self._kill(worker)
+                raise RenderTimeout(f"Render did not finish within {timeout}s")
+            response = conn.recv()
+        except (EOFError, OSError) as e:
+            self._kill(worker)
+            raise RuntimeError(f"Render process exited unexpectedly: {e}") from e
+
+        with self._lock:
+            self._idle.append(worker)
+        return response
+
+    def stop(self):
+        with self._lock:
+            workers, self._idle = self._idle, []
+        for worker in workers:
+            self._kill(worker)
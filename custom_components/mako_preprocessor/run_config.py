@@ -1,3 +1,4 @@
+import copy
 import json
 import os
 import threading
@@ -5,7 +6,26 @@ from .utils import get_logger
 
 DOMAIN = "mako_preprocessor"
 
-class RunConfig:
+class FeatureFlags:
+    def is_template_disabled(self):
+        return "template" not in self.enable_features
+
+    def is_render_disabled(self):
+        return "render" not in self.enable_features
+
+    def is_serialize_disabled(self):
+        return "serialize" not in self.enable_features
+
+    def is_hot_reload_disabled(self):
+        return "hot_reload" not in self.enable_features
+
+class RunConfigSnapshot(FeatureFlags):
+    def __init__(self, values):
+        self.values = values
+        for key, value in values.items():
+            setattr(self, key, value)
+
+class RunConfig(FeatureFlags):
     _instance = None
     _lock = threading.Lock()
     
@@ -15,9 +35,38 @@ class RunConfig:
         "run_on_start_ha": True,
         "reload_wait_min_secs": 1,
         "batch_size": 50,
+        "batch_budget_secs": 2,
         "hot_reload_extensions": [".yaml"],
+        "hot_reload_observer": "native",
+        "hot_reload_scope": "all",
+        "hot_reload_sweep_secs": 10,
+        "storm_threshold_events": 100,
+        "event_trace_file": "",
+        "poll_interval_secs": 2,
+        "poll_interval_max_secs": 30,
         "backup_enabled": False,
-        "backup_directory": "/backup"
+        "backup_directory": "/backup",
+        "backup_retention_count": 10,
+        "backup_retention_days": 30,
+        "backup_max_size_mb": 100,
+        "fragment_cache_size": 256,
+        "fragment_cache_disk": False,
+        "serialize_workers": 1,
+        "lane_workers": {},
+        "render_timeout_secs": 0,
+        "cpu_share": 0,
+        "io_rate_mb_secs": 0,
+        "render_nice": 0,
+        "hot_reload_rate_per_min": 0,
+        "loop_lag_threshold_ms": 0,
+        "failure_backoff_secs": 5,
+        "failure_backoff_max_secs": 600,
+        "render_cache_size_mb": 0,
+        "streaming_render": False,
+        "publish_sync": True,
+        "publish_mode": "in_place",
+        "generations_directory": "/config/.mako_generations",
+        "generations_keep": 3
     }
     
     def __new__(cls, hass=None, **kwargs):
@@ -36,6 +85,7 @@ class RunConfig:
         self.hass = hass
         for key, value in kwargs.items():
             setattr(self, key, value)
+        self._config_keys = list(kwargs)
         self.version = self._load_version()
 
     def _load_version(self):
@@ -61,14 +111,15 @@ class RunConfig:
 
         return RunConfig(hass, **params)
 
-    def is_template_disabled(self):
-        return "template" not in self.enable_features
-
-    def is_render_disabled(self):
-        return "render" not in self.enable_features
-
-    def is_serialize_disabled(self):
-        return "serialize" not in self.enable_features
+    def snapshot(self):
+        return RunConfigSnapshot({key: copy.deepcopy(getattr(self, key)) for key in self._config_keys})
 
-    def is_hot_reload_disabled(self):
-        return "hot_reload" not in self.enable_features
+    @staticmethod
+    def diff(previous, current):
+        changes = {}
+        for key in set(previous.values) | set(current.values):
+            old_value = previous.values.get(key)
+            new_value = current.values.get(key)
+            if old_value != new_value:
+                changes[key] = (old_value, new_value)
+        return changes
@@ -1,5 +1,6 @@
 import logging
 import os
+from .metadata import MetadataManager
 from .utils import FileMatcher, get_logger
 from .preprocessor_worker import PreprocessorWorker
 import traceback
@@ -11,9 +12,9 @@ class RunPreprocessor:
         self.run_config = run_config
         self.worker = PreprocessorWorker(run_config)
 
-    def _feature_paths(self):
+    def _feature_paths(self, directories, file_filter=None):
         self._logger.debug("Generating feature paths")
-        for base_dir in self.run_config.directories:
+        for base_dir in directories:
             if not os.path.exists(base_dir):
                 self._logger.warning(f"MAKO-012 ⚠️ Directory {base_dir} not found, skipping.")
                 continue
@@ -21,16 +22,37 @@ class RunPreprocessor:
                 for file in files:
                     full_path = os.path.join(root, file)
                     file_type, ext = FileMatcher.get_file_type(full_path, self.run_config)
-                    if file_type:
-                        self._logger.debug(f"File matched: {full_path}, type: {file_type}, extension: {ext}")
+                    if file_type and (file_filter is None or file_filter(full_path)):
+                        self._logger.debug("File matched: %s, type: %s, extension: %s", full_path, file_type, ext)
                         yield full_path
 
-    def run(self):
+    def run(self, directories=None, file_filter=None):
         self._logger.debug("Running preprocessor")
         try:
-            files_to_process = list(self._feature_paths())
+            if directories is None:
+                directories = self.run_config.directories
+            files_to_process = list(self._feature_paths(directories, file_filter))
             if files_to_process:
+                # A full run is the way to retry failures whose inputs have not changed
+                MetadataManager().remove_failures(files_to_process)
+                # The graph is known before anything renders, so edits to shared files are routed right away
+                self.worker.template_renderer.record_static_dependencies(files_to_process)
                 self.worker.add_files(files_to_process)
                 self._logger.info("✅ Files added to processing queue")
         except Exception as e:
             self._logger.error(f"MAKO-013 ❌ Error collecting files: {e}\n{traceback.format_exc()}")
+
+    def rescan(self, directories):
+        self._logger.debug("Rescanning %s", directories)
+        try:
+            # Known sources and dependencies are queued too, so changed dependencies and deleted files are handled
+            tracked = [
+                path for path in MetadataManager().tracked_paths()
+                if any(path.startswith(os.path.join(directory, "")) for directory in directories)
+            ]
+            sources = list(self._feature_paths([directory for directory in directories if os.path.isdir(directory)]))
+            self.worker.template_renderer.record_static_dependencies(sources)
+            self.worker.add_files(sorted(set(sources) | set(tracked)))
+            self._logger.info("✅ Files added to processing queue")
+        except Exception as e:
+            self._logger.error(f"MAKO-013 ❌ Error collecting files: {e}\n{traceback.format_exc()}")
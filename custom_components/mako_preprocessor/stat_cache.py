@@ -0,0 +1,121 @@
+import os
+import errno
+import threading
+import contextlib
+from collections import Counter
+from .utils import get_logger
+
+# Directories holding at least this many files of a batch are listed once instead of stat'ed file by file
+LISTING_MIN_FILES = 4
+
+class StatCache:
+    # Stats taken during a batch are reused for the rest of it. A file edited mid-batch keeps its earlier
+    # stat, which only records an older mtime or digest, so the edit's own event still renders it again
+    _scope = threading.local()
+
+    def __init__(self):
+        self._logger = get_logger(type(self))
+        self._stats = {}
+        self._listings = {}
+        self._changed = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def current(cls):
+        return getattr(cls._scope, "cache", None)
+
+    @classmethod
+    @contextlib.contextmanager
+    def batch(cls, files=()):
+        outer = cls.current()
+        if outer is not None:
+            yield outer
+            return
+        cache = cls()
+        cache._list_directories(files)
+        cls._scope.cache = cache
+        try:
+            yield cache
+        finally:
+            cls._scope.cache = None
+
+    @classmethod
+    @contextlib.contextmanager
+    def joined(cls, cache):
+        # Helper threads of a batch, like parallel serialize renders, share its cache
+        previous = cls.current()
+        cls._scope.cache = cache
+        try:
+            yield
+        finally:
+            cls._scope.cache = previous
+
+    def _list_directories(self, files):
+        # On Linux a listing gives names but not stats, so it answers existence for every file in the directory
+        counts = Counter(os.path.dirname(file_path) for file_path in files)
+        for directory, count in counts.items():
+            if count < LISTING_MIN_FILES:
+                continue
+            try:
+                with os.scandir(directory) as entries:
+                    self._listings[directory] = {entry.name: entry for entry in entries}
+            except OSError:
+                continue
+        self._logger.debug("Listed %s directories for a batch of %s files", len(self._listings), len(files))
+
+    def _lookup(self, path):
+        with self._lock:
+            if path in self._stats:
+                return self._stats[path]
+        directory, name = os.path.split(path)
+        listing = self._listings.get(directory)
+        try:
+            if listing is None or path in self._changed:
+                stat = os.stat(path)
+            elif name in listing:
+                stat = listing[name].stat()
+            else:
+                stat = None
+        except OSError:
+            stat = None
+        with self._lock:
+            self._stats[path] = stat
+        return stat
+
+    def _forget(self, path):
+        with self._lock:
+            self._stats.pop(path, None)
+            # The listing is out of date for this name, it is stat'ed again when next asked for
+            self._changed.add(path)
+
+    @classmethod
+    def stat(cls, path):
+        cache = cls.current()
+        if cache is not None:
+            return cache._lookup(path)
+        try:
+            return os.stat(path)
+        except OSError:
+            return None
+
+    @classmethod
+    def exists(cls, path):
+        return cls.stat(path) is not None
+
+    @classmethod
+    def require(cls, path):
+        stat = cls.stat(path)
+        if stat is None:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        return stat
+
+    @classmethod
+    def getmtime(cls, path):
+        return cls.require(path).st_mtime
+
+    @classmethod
+    def forget(cls, path):
+        # Called after the preprocessor's own writes and removals
+        cache = cls.current()
+        if cache is not None:
+            cache._forget(path)
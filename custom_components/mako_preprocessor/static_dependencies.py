@@ -0,0 +1,112 @@
+import os
+import re
+import json
+import threading
+import yaml
+from .stat_cache import StatCache
+from .utils import FileMatcher, get_logger
+
+TAG_FILE_PATTERN = re.compile(
+    r"<%\s*(?:inherit|include|namespace)\b[^>]*?\bfile\s*=\s*(['\"])(.*?)\1", re.DOTALL
+)
+
+class StaticDependencyScanner:
+    def __init__(self, run_config):
+        self._logger = get_logger(type(self))
+        self._logger.debug("Initializing StaticDependencyScanner")
+        self.run_config = run_config
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _signature(file_path):
+        stat = StatCache.stat(file_path)
+        if stat is None:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _cached(self, file_path, parse):
+        signature = self._signature(file_path)
+        if signature is None:
+            return set()
+        with self._lock:
+            cached = self._cache.get(file_path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        result = parse(file_path)
+        with self._lock:
+            self._cache[file_path] = (signature, result)
+        return result
+
+    def _resolve(self, uri, template_path):
+        # Mirrors the lookup: absolute uris are searched in the configured directories, others are relative to the template
+        if uri.startswith("/"):
+            candidates = [os.path.normpath(os.path.join(directory, uri.lstrip("/"))) for directory in self.run_config.directories]
+        else:
+            candidates = [os.path.normpath(os.path.join(os.path.dirname(template_path), uri))]
+        for candidate in candidates:
+            if StatCache.exists(candidate):
+                return candidate
+        # A missing file is still recorded so that creating it triggers the template
+        return candidates[0] if candidates else None
+
+    def _parse_template(self, template_path):
+        with open(template_path, "r", encoding="utf-8", errors="replace") as f:
+            source = f.read()
+        dependencies = set()
+        for _, uri in TAG_FILE_PATTERN.findall(source):
+            # Expressions are only known at render time and are left to the dynamic tracking
+            if "${" in uri:
+                continue
+            resolved = self._resolve(uri, template_path)
+            if resolved is not None:
+                dependencies.add(resolved)
+        return dependencies
+
+    def template_dependencies(self, template_path):
+        dependencies = set()
+        pending = [template_path]
+        while pending:
+            current = pending.pop()
+            for dependency in self._cached(current, self._parse_template):
+                if dependency not in dependencies and dependency != template_path:
+                    dependencies.add(dependency)
+                    pending.append(dependency)
+        return dependencies
+
+    def _parse_manifest(self, manifest_path):
+        _, ext = FileMatcher.get_file_type(manifest_path, self.run_config)
+        manifest_path_without_ext = manifest_path[:-len(ext)]
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            if manifest_path_without_ext.endswith(".yaml"):
+                data = yaml.safe_load(f)
+            elif manifest_path_without_ext.endswith(".json"):
+                data = json.load(f)
+            else:
+                return set()
+        if not isinstance(data, dict):
+            return set()
+
+        base_dir = os.path.dirname(manifest_path)
+        templates = set()
+        if data.get("template"):
+            templates.add(os.path.join(base_dir, data["template"]))
+        for output in data.get("outputs") or []:
+            if isinstance(output, dict) and output.get("template"):
+                templates.add(os.path.join(base_dir, output["template"]))
+        return templates
+
+    def dependencies(self, file_path):
+        file_type, _ = FileMatcher.get_file_type(file_path, self.run_config)
+        try:
+            if file_type == "render":
+                return self.template_dependencies(file_path)
+            if file_type == "serialize":
+                dependencies = set()
+                for template_path in self._cached(file_path, self._parse_manifest):
+                    dependencies.add(template_path)
+                    dependencies.update(self.template_dependencies(template_path))
+                return dependencies
+        except Exception as e:
+            self._logger.debug("Static dependency scan of %s failed: %s", file_path, e)
+        return set()
@@ -1,57 +1,103 @@
 import os
+import time
 import logging
+import threading
 import traceback
-import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from mako.template import Template
 from mako.lookup import TemplateLookup
+from mako.runtime import Context
 from .run_config import DOMAIN
-from .utils import FileMatcher, SerializedParser, get_logger
+from .utils import REPEAT_WINDOW_SECS, FileMatcher, RepeatedMessages, SerializedParser, TrackingMapping, get_logger
 from .metadata import MetadataManager
+from .data_loader import DataLoader
+from .fragment_cache import FragmentCache, PLUGIN_NAME as CACHE_PLUGIN_NAME
+from .fingerprint import Fingerprinter
+from .render_cache import RenderCache
+from .publisher import OutputPublisher
+from .backup_store import BackupStore
+from .render_supervisor import RenderSupervisor, RenderTimeout
+from .governor import lower_priority
+from .static_dependencies import StaticDependencyScanner
+from .stat_cache import StatCache
+from .trace import PipelineProbe
 from datetime import datetime, UTC
 
+STREAM_BUFFER_SIZE = 1024 * 1024
+
 class TemplateRenderer:
     _logger = get_logger("TemplateRenderer")
+    # Shared by the lanes' renderers, so a source retried on backoff fills the log once per window
+    failure_messages = RepeatedMessages(REPEAT_WINDOW_SECS)
     class TrackingUrisLookup(TemplateLookup):
         def __init__(self, *args, **kwargs):
-            self.requested_uris = set()
+            self._tracking = threading.local()
             super().__init__(*args, **kwargs)
 
+        @property
+        def requested_files(self):
+            if not hasattr(self._tracking, "files"):
+                self._tracking.files = set()
+            return self._tracking.files
+
         def get_template(self, uri):
-            self.requested_uris.add(uri)
-            return super().get_template(uri)
+            template = super().get_template(uri)
+            self.requested_files.add(template.filename or uri)
+            return template
         
-        def fetch_uris_and_clear(self):
-            uris = list(self.requested_uris)
-            self.requested_uris.clear()
-            return uris
+        def fetch_files_and_clear(self):
+            files = list(self.requested_files)
+            self.requested_files.clear()
+            return files
 
-    def __init__(self, run_config):
+    def __init__(self, run_config, render_cache=None):
         self._logger = get_logger(type(self))
         self._logger.debug("Initializing TemplateRenderer")
         self._batch_active = 0
-        if not run_config.is_template_disabled():
-            self.lookup = self.TrackingUrisLookup(directories=run_config.directories, input_encoding='utf-8', output_encoding='utf-8')
-        else:
-            self.lookup = None
         self.run_config = run_config
+        self.reconfigure()
         self.metadata = MetadataManager()
+        self.data_loader = DataLoader()
+        self.fragment_cache = FragmentCache(run_config)
+        self.fingerprinter = Fingerprinter(run_config)
+        self.render_cache = render_cache or RenderCache(run_config)
+        self.publisher = OutputPublisher(run_config)
+        self.backup_store = BackupStore(run_config)
+        self.supervisor = RenderSupervisor(run_config)
+        self.static_scanner = StaticDependencyScanner(run_config)
+        self._pending_fingerprints = {}
+        self._failed_inputs = None
+        self._failure_transient = False
+        self._rendered_units = 0
+        self._deferred_files = {}
+        self._template_inputs_lock = threading.Lock()
         self._rendered_files = set()
+        self._changed_files = 0
+
+    def _log_failure(self, source, msg):
+        # Identical failures of a source collapse, a different one is news and is logged at once
+        self.failure_messages.log(self._logger, logging.ERROR, (source, msg), msg)
+
+    def reconfigure(self):
+        self._logger.debug("Reconfiguring TemplateRenderer")
+        if not self.run_config.is_template_disabled():
+            self.lookup = self.TrackingUrisLookup(
+                directories=self.run_config.directories, input_encoding='utf-8', output_encoding='utf-8',
+                cache_impl=CACHE_PLUGIN_NAME
+            )
+        else:
+            self.lookup = None
 
     def _backup_file(self, file_path):
         if not self.run_config.backup_enabled:
             return
-
-        backup_dir = self.run_config.backup_directory
-        if not os.path.exists(backup_dir):
-            os.makedirs(backup_dir)
-        timestamp = datetime.fromtimestamp(os.path.getmtime(file_path), UTC).strftime('%Y%m%d%H%M%S')
-        backup_path = os.path.join(backup_dir, f"{timestamp}_{os.path.basename(file_path)}")
-        shutil.move(file_path, backup_path)
-        self._logger.debug(f"📦 Backup created: {backup_path}")
+        self.backup_store.backup(file_path)
 
     def _change_file_allowed(self, output_path):
-        self._logger.debug(f"Checking if file change is allowed: {output_path}")
-        if not os.path.exists(output_path):
+        self._logger.debug("Checking if file change is allowed: %s", output_path)
+        stat = StatCache.stat(output_path)
+        if stat is None:
             return { "allowed": True, "user_changed": False }
         
         
@@ -64,8 +110,7 @@ class TemplateRenderer:
             self._logger.error(f"MAKO-005 ❌ File {output_path} was manually modified! Not overwriting.")
             return { "allowed": False, "user_changed": True }
 
-        last_modified = os.path.getmtime(output_path)
-        if last_saved == last_modified:
+        if last_saved == stat.st_mtime:
             return { "allowed": True, "user_changed": False }
         
         if self.run_config.overwrite_modified_files:
@@ -76,6 +121,10 @@ class TemplateRenderer:
         return { "allowed": False, "user_changed": True }
 
     def format_output(self, rendered_output, template_path, output_path, variables):
+        prefix, postfix = self._output_envelope(template_path, output_path, variables)
+        return f"{prefix}{rendered_output}{postfix}"
+
+    def _output_envelope(self, template_path, output_path, variables):
         prefix = f"# Generated by: {DOMAIN}\n"
         timestamp = datetime.now(UTC).isoformat()
         prev_timestamp = self.metadata.get(output_path)
@@ -91,31 +140,283 @@ class TemplateRenderer:
             f"#   version: {self.run_config.version}\n"
             f"#   metadata_version: {metadata_version}\n"
         )
-        return f"{prefix}{rendered_output}{postfix}"
+        return prefix, postfix
+
+    def _compile(self, template_path):
+        return Template(filename=template_path, lookup=self.lookup, cache_impl=CACHE_PLUGIN_NAME)
+
+    def _unchanged_fingerprint(self, template_path, output_path, variables, check):
+        fingerprint = self.metadata.get_fingerprint(output_path)
+        if fingerprint is None or check["user_changed"] or not StatCache.exists(output_path):
+            return None
+        digest = self.fingerprinter.inputs_digest(
+            template_path, fingerprint["dependencies"], variables, fingerprint["constants"]
+        )
+        return fingerprint if digest == fingerprint["digest"] else None
+
+    def _cached_render(self, template_path, variables):
+        template_inputs = self.metadata.get_template_inputs(template_path)
+        if not self.render_cache.enabled or template_inputs is None:
+            return None
+        cache_key = self.fingerprinter.inputs_digest(
+            template_path, template_inputs["dependencies"], variables, template_inputs["constants"]
+        )
+        rendered_output = self.render_cache.get(cache_key)
+        if rendered_output is None:
+            return None
+        return rendered_output, template_inputs
+
+    def _store_render(self, template_path, variables, rendered_output, dependencies, constants):
+        if not self.render_cache.enabled:
+            return
+        # Keys are derived from the union of everything the template has ever read, so a cached
+        # result can be looked up before rendering and is missed as soon as any of those inputs changes
+        with self._template_inputs_lock:
+            template_inputs = self.metadata.get_template_inputs(template_path)
+            previous_inputs = template_inputs or { "dependencies": [], "constants": [] }
+            merged_inputs = {
+                "dependencies": sorted(set(previous_inputs["dependencies"]) | set(dependencies)),
+                "constants": sorted(set(previous_inputs["constants"]) | set(constants)),
+            }
+            if merged_inputs != template_inputs:
+                self.metadata.set_template_inputs(template_path, merged_inputs)
+        cache_key = self.fingerprinter.inputs_digest(
+            template_path, merged_inputs["dependencies"], variables, merged_inputs["constants"]
+        )
+        self.render_cache.put(cache_key, rendered_output)
+
+    def _render_unit(self, template_path, output_path, variables, template=None):
+        unit = { "success": False, "output_path": output_path, "dependencies": [], "constants": [] }
+        unit["check"] = self._change_file_allowed(output_path)
+        if not unit["check"]["allowed"]:
+            return unit
+
+        fingerprint = self._unchanged_fingerprint(template_path, output_path, variables, unit["check"])
+        if fingerprint is not None:
+            self._logger.debug("Inputs of %s are unchanged. Skipping render.", output_path)
+            unit.update({
+                "success": True, "skipped": True, "fingerprint": fingerprint,
+                "dependencies": list(fingerprint["dependencies"]), "constants": list(fingerprint["constants"]),
+            })
+            return unit
+
+        self._rendered_units += 1
+        cached = None if self.run_config.streaming_render else self._cached_render(template_path, variables)
+        if cached is not None:
+            rendered_output, template_inputs = cached
+            self._logger.debug("Render of %s for %s served from render cache", template_path, output_path)
+            unit.update({
+                "success": True,
+                "output": self.format_output(rendered_output, template_path, output_path, variables),
+                "dependencies": list(template_inputs["dependencies"]),
+                "constants": list(template_inputs["constants"]),
+            })
+            unit["fingerprint"] = self._output_fingerprint(template_path, variables, unit)
+            return unit
+
+        if self.run_config.render_timeout_secs:
+            self._supervised_render(template_path, output_path, variables, unit)
+        else:
+            self._local_render(template_path, output_path, variables, unit, template)
+        if unit["success"]:
+            unit["fingerprint"] = self._output_fingerprint(template_path, variables, unit)
+            if "rendered_output" in unit:
+                self._store_render(
+                    template_path, variables, unit.pop("rendered_output"), unit["dependencies"], unit["constants"]
+                )
+        return unit
+
+    def _local_render(self, template_path, output_path, variables, unit, template):
+        constants = TrackingMapping(self.run_config.constants)
+        data_dependencies = set()
+        if self.lookup is not None:
+            self.lookup.fetch_files_and_clear()
+        scope = FragmentCache.current_scope()
+        if scope is not None:
+            scope.dependencies = [data_dependencies] + ([self.lookup.requested_files] if self.lookup else [])
+            scope.constants = constants
+        try:
+            if template is None:
+                template = self._compile(template_path)
+            render_args = {
+                "variables": variables,
+                "constants": constants,
+                "load_data": self.data_loader.bind(os.path.dirname(template_path), data_dependencies),
+            }
+            if self.run_config.streaming_render:
+                unit["staged_path"] = self._stream_render(template, template_path, output_path, variables, render_args)
+            else:
+                rendered_output = template.render(**render_args)
+                unit["output"] = self.format_output(rendered_output, template_path, output_path, variables)
+                unit["rendered_output"] = rendered_output
+            unit["success"] = True
+        except Exception as e:
+            self._log_failure(template_path, f"MAKO-006 ❌ Error processing {template_path}: {e}\n{traceback.format_exc()}")
+        finally:
+            unit["dependencies"] = self.lookup.fetch_files_and_clear() if self.lookup is not None else []
+            unit["dependencies"].extend(sorted(data_dependencies))
+            unit["constants"] = sorted(constants.accessed)
+
+    def _supervised_render(self, template_path, output_path, variables, unit):
+        scope = FragmentCache.current_scope()
+        request = {
+            "run_config": self.run_config.snapshot(),
+            "source": scope.source if scope is not None else template_path,
+            "template_path": template_path,
+            "variables": variables,
+        }
+        if self.run_config.streaming_render:
+            fd, request["staged_path"] = self._stage_file(output_path)
+            os.close(fd)
+            request["prefix"], request["postfix"] = self._output_envelope(template_path, output_path, variables)
+        try:
+            response = self.supervisor.render(request, self.run_config.render_timeout_secs)
+        except RenderTimeout:
+            self._logger.error(
+                f"MAKO-025 ❌ Rendering {template_path} to {output_path} timed out after "
+                f"{self.run_config.render_timeout_secs}s. The render process was killed."
+            )
+            response = { "error": None, "dependencies": [], "constants": [] }
+            unit["transient"] = True
+        except Exception as e:
+            self._log_failure(template_path, f"MAKO-006 ❌ Error processing {template_path}: {e}\n{traceback.format_exc()}")
+            response = { "error": None, "dependencies": [], "constants": [] }
+            unit["transient"] = True
+        else:
+            if response["error"] is not None:
+                self._log_failure(template_path, f"MAKO-006 ❌ Error processing {template_path}: {response['error']}")
+            else:
+                unit["success"] = True
+
+        unit["dependencies"] = response["dependencies"]
+        unit["constants"] = response["constants"]
+        if not unit["success"]:
+            if "staged_path" in request:
+                os.remove(request["staged_path"])
+        elif "staged_path" in request:
+            unit["staged_path"] = request["staged_path"]
+        else:
+            unit["output"] = self.format_output(response["output"], template_path, output_path, variables)
+            unit["rendered_output"] = response["output"]
+
+    @staticmethod
+    def _stage_file(output_path):
+        fd, staged_path = tempfile.mkstemp(
+            dir=os.path.dirname(output_path) or ".", prefix=f".{os.path.basename(output_path)}.", suffix=".tmp"
+        )
+        # mkstemp creates the file with 0600, keep the permissions a plain open() would have produced
+        stat = StatCache.stat(output_path)
+        mode = stat.st_mode if stat is not None else 0o644
+        os.chmod(staged_path, mode & 0o777)
+        return fd, staged_path
+
+    def _stream_render(self, template, template_path, output_path, variables, render_args):
+        prefix, postfix = self._output_envelope(template_path, output_path, variables)
+        fd, staged_path = self._stage_file(output_path)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8", buffering=STREAM_BUFFER_SIZE) as f:
+                f.write(prefix)
+                template.render_context(Context(f, **render_args))
+                f.write(postfix)
+        except BaseException:
+            os.remove(staged_path)
+            raise
+        return staged_path
+
+    def _output_fingerprint(self, template_path, variables, unit):
+        return {
+            "digest": self.fingerprinter.inputs_digest(
+                template_path, unit["dependencies"], variables, unit["constants"]
+            ),
+            "dependencies": unit["dependencies"],
+            "constants": unit["constants"],
+        }
+
+    def _write_output(self, template_path, unit):
+        output_path = unit["output_path"]
+        if unit.get("skipped"):
+            return True
+        try:
+            if "staged_path" not in unit:
+                fd, unit["staged_path"] = self._stage_file(output_path)
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    f.write(unit.pop("output"))
+            self.publisher.stage(output_path, unit.pop("staged_path"), template_path, unit["check"]["user_changed"])
+            self._pending_fingerprints[output_path] = unit["fingerprint"]
+            return True
+        except Exception as e:
+            self._log_failure(template_path, f"MAKO-006 ❌ Error processing {template_path}: {e}\n{traceback.format_exc()}")
+            if "staged_path" in unit:
+                os.remove(unit.pop("staged_path"))
+            unit["success"] = False
+            return False
+
+    def _publish(self):
+        # Staged outputs of the whole batch become visible together, after a single durability barrier
+        published = self.publisher.publish(self._backup_file)
+        fingerprints, self._pending_fingerprints = self._pending_fingerprints, {}
+        with self.metadata.batch_update():
+            for output_path, mtime in published.items():
+                self.metadata.set(output_path, mtime)
+                self.metadata.set_fingerprint(output_path, fingerprints[output_path])
+        self._changed_files += len(published)
+        for output_path in published:
+            StatCache.forget(output_path)
+        if PipelineProbe.listeners:
+            for output_path in published:
+                PipelineProbe.emit("publish", output=output_path)
+
+    def rollback_generation(self):
+        generation = self.publisher.rollback()
+        if generation is None:
+            self._logger.warning("MAKO-022 ⚠️ No previous generation to roll back to.")
+            return None
+        # Recorded mtimes must follow the swapped outputs, fingerprints no longer describe them
+        with self.metadata.batch_update():
+            for output_path in self.publisher.generation_outputs(generation):
+                stat = StatCache.stat(output_path)
+                if self.metadata.get(output_path) is not None and stat is not None:
+                    self.metadata.set(output_path, stat.st_mtime)
+                    self.metadata.set_fingerprint(output_path, None)
+        return generation
 
     def _render(self, template_path, output_path, **variables):
-        self._logger.debug(f"Rendering template: {template_path} to {output_path}")
-        dependencies = []
-        check = self._change_file_allowed(output_path)
-        if not check["allowed"]:
-            return { "success": False, "dependencies": dependencies }
+        self._logger.debug("Rendering template: %s to %s", template_path, output_path)
+        unit = self._render_unit(template_path, output_path, variables)
+        if PipelineProbe.listeners:
+            PipelineProbe.emit("render", template=template_path, output=output_path, success=unit["success"])
+        if unit["success"] and self._write_output(template_path, unit) and self._batch_active == 0:
+            self._publish()
+        return unit
+
+    def _render_outputs(self, template_path, outputs):
+        self._logger.debug("Rendering %s outputs from template: %s", len(outputs), template_path)
         try:
-            template = Template(filename=template_path, lookup=self.lookup)
-            rendered_output = template.render(variables=variables, constants=self.run_config.constants)
-            dependencies = self.lookup.fetch_uris_and_clear()
-            final_output = self.format_output(rendered_output, template_path, output_path, variables)
-            
-            if check["user_changed"]:
-                self._backup_file(output_path)
-            with open(output_path, "w", encoding="utf-8") as f:
-                f.write(final_output)
-            self.metadata.set(output_path, os.path.getmtime(output_path))
-            
-            self._logger.info(f"✅ {template_path} -> {output_path}")
-            return { "success": True, "dependencies": dependencies }
+            template = self._compile(template_path)
         except Exception as e:
-            self._logger.error(f"MAKO-006 ❌ Error processing {template_path}: {e}\n{traceback.format_exc()}")
-            return { "success": False, "dependencies": dependencies }
+            self._log_failure(template_path, f"MAKO-006 ❌ Error processing {template_path}: {e}\n{traceback.format_exc()}")
+            return [
+                { "success": False, "output_path": output_path, "dependencies": [], "constants": [] }
+                for output_path, _ in outputs
+            ]
+
+        workers = min(self.run_config.serialize_workers, len(outputs))
+        if workers <= 1:
+            return [
+                self._render_unit(template_path, output_path, variables, template)
+                for output_path, variables in outputs
+            ]
+
+        scope = FragmentCache.current_scope()
+        source = scope.source if scope is not None else template_path
+        stat_cache = StatCache.current()
+        def render(output):
+            with StatCache.joined(stat_cache), FragmentCache.rendering(source):
+                return self._render_unit(template_path, output[0], output[1], template)
+        with ThreadPoolExecutor(
+            max_workers=workers, initializer=lower_priority, initargs=(self.run_config.render_nice,)
+        ) as executor:
+            return list(executor.map(render, outputs))
 
     def _remove_outdated_files(self, current_generated_files, previous_generated_files):
         for file in previous_generated_files:
@@ -129,20 +430,32 @@ class TemplateRenderer:
                         self._backup_file(file)
                         
                     os.remove(file)
+                    StatCache.forget(file)
+                    self.publisher.mark_removed(file)
+                    self.metadata.remove_generated_file(file)
+                    self._changed_files += 1
                     self._logger.info(f"🗑️ Removed outdated file: {file}")
                 except OSError as e:
                     self._logger.error(f"MAKO-017 ❌ Error removing outdated file {file}: {e}")
 
     def _render_serialize(self, serialize_file_path, matched_ext):
-        self._logger.debug(f"Rendering serialize file: {serialize_file_path}")
-        parsed_data = SerializedParser.parse(serialize_file_path, matched_ext, self.run_config.constants)
+        self._logger.debug("Rendering serialize file: %s", serialize_file_path)
+        constants = TrackingMapping(self.run_config.constants)
+        parsed_data = SerializedParser.parse(
+            serialize_file_path, matched_ext, constants, timeout=self.run_config.render_timeout_secs or None,
+            nice=self.run_config.render_nice
+        )
         if not parsed_data:
             self._logger.error(f"MAKO-007 ❌ Failed to get data from {serialize_file_path}.")
+            self._failed_inputs = ([], constants.accessed)
+            # Scripts may fail on services or time limits outside their inputs
+            self._failure_transient = serialize_file_path[:-len(matched_ext)].endswith(".py")
             return
 
         outputs = parsed_data.get("outputs")
         if not outputs:
             self._logger.error(f"MAKO-008 ❌ File {serialize_file_path} must contain 'outputs' key.")
+            self._failed_inputs = ([], constants.accessed)
             return
 
         default_template = parsed_data.get("template")
@@ -150,6 +463,7 @@ class TemplateRenderer:
         base_dir = os.path.dirname(serialize_file_path)
         dependencies = set()
         generated_files = set()
+        template_outputs = {}
         if "dependencies" in parsed_data:
             dependencies.update(parsed_data["dependencies"])
 
@@ -169,79 +483,206 @@ class TemplateRenderer:
                 merged_vars.update(output["variables"])
             template_path = os.path.join(base_dir, tmpl)
             dependencies.add(template_path)
-            if not os.path.exists(template_path):
+            if not StatCache.exists(template_path):
                 self._logger.error(
                     f"MAKO-010 ❌ Template {template_path} not found for file {serialize_file_path}. Skipping output {output}."
                 )
                 continue
             output_filename = os.path.join(base_dir, output.get("filename"))
-            result = self._render(template_path, output_filename, **merged_vars)
-            if result["success"]:
-                dependencies.update(result["dependencies"])
-                generated_files.add(output_filename)
+            template_outputs.setdefault(template_path, []).append((output_filename, merged_vars))
+
+        rendered_units = []
+        for template_path, template_group in template_outputs.items():
+            for unit in self._render_outputs(template_path, template_group):
+                rendered_units.append((template_path, unit))
+
+        failed = False
+        for template_path, unit in rendered_units:
+            constants.touch(unit["constants"])
+            if not unit["success"]:
+                failed = failed or unit.get("check", { "allowed": True })["allowed"]
+                self._failure_transient = self._failure_transient or unit.get("transient", False)
+                dependencies.update(unit["dependencies"])
+                continue
+            if self._write_output(template_path, unit):
+                dependencies.update(unit["dependencies"])
+                generated_files.add(unit["output_path"])
         
         previous_generated_files = set(self.metadata.get_generated_files(serialize_file_path))
         self._remove_outdated_files(generated_files, previous_generated_files)
         
-        self.metadata.set(serialize_file_path, os.path.getmtime(serialize_file_path))
-        self.metadata.update_dependencies(serialize_file_path, dependencies)
-        self.metadata.set_generated_files(serialize_file_path, generated_files)
+        with self.metadata.batch_update():
+            self.metadata.set(serialize_file_path, StatCache.getmtime(serialize_file_path))
+            self.metadata.update_dependencies(serialize_file_path, dependencies)
+            self.metadata.set_generated_files(serialize_file_path, generated_files)
+            self.metadata.set_constants(serialize_file_path, constants.accessed)
+        if failed:
+            self._failed_inputs = (dependencies, constants.accessed)
 
     def _process_file(self, file_path):
-        self._logger.debug(f"Processing file: {file_path}")
+        self._logger.debug("Processing file: %s", file_path)
         if file_path in self._rendered_files:
-            self._logger.debug(f"File {file_path} already rendered in this batch. Skipping.")
+            self._logger.debug("File %s already rendered in this batch. Skipping.", file_path)
             return True
 
-        if not os.path.exists(file_path):
-            self._logger.debug(f"File {file_path} does not exist. Removing metadata.")
+        if not StatCache.exists(file_path):
+            self._logger.debug("File %s does not exist. Removing metadata.", file_path)
+            self.fragment_cache.invalidate_sources([file_path])
             self.metadata.remove_file_metadata(file_path)
             return True
         
         file_type, ext = FileMatcher.get_file_type(file_path, self.run_config)
+        if file_type in ("render", "serialize"):
+            self.record_static_dependencies([file_path])
+            if self._failure_pending(file_path):
+                return False
         
+        self._failed_inputs = None
+        self._failure_transient = False
+        self._rendered_units = 0
+        started = time.monotonic()
         try:
-            if file_type == "render":
-                output_path = file_path[:-len(ext)]
-                result = self._render(file_path, output_path)
-                if not result["success"]:
-                    return False
-                
-                previous_generated_files = set(self.metadata.get_generated_files(file_path))
-                current_generated_files = {output_path}
-                self._remove_outdated_files(current_generated_files, previous_generated_files)
-                
-                self.metadata.set(file_path, os.path.getmtime(file_path))
-                self.metadata.update_dependencies(file_path, result["dependencies"])
-                self.metadata.set_generated_files(file_path, current_generated_files)
-                return True
-            elif file_type == "serialize":
-                return self._render_serialize(file_path, ext)
-            if self._batch_active > 0:
-                self._rendered_files.add(file_path)
-            return False
+            with FragmentCache.rendering(file_path):
+                result = self._process_matched_file(file_path, file_type, ext)
         except Exception as e:
-            self._logger.error(f"MAKO-011 ❌ Error processing {file_path}: {e}\n{traceback.format_exc()}")
+            self._log_failure(file_path, f"MAKO-011 ❌ Error processing {file_path}: {e}\n{traceback.format_exc()}")
+            self._failed_inputs = ([], [])
+            self._failure_transient = True
+            result = False
+        if file_type in ("render", "serialize"):
+            self._record_outcome(file_path)
+            # Sources whose outputs were all skipped as unchanged say nothing about what a render costs
+            if self._rendered_units or self._failed_inputs is not None:
+                self.metadata.record_render_secs(file_path, time.monotonic() - started)
+        return result
+
+    def record_static_dependencies(self, files):
+        with self.metadata.batch_update():
+            for file_path in files:
+                dependencies = self.static_scanner.dependencies(file_path)
+                if dependencies == set(self.metadata.get_static_dependencies(file_path)):
+                    continue
+                self._logger.debug("Static dependencies of %s: %s", file_path, sorted(dependencies))
+                self.metadata.set_static_dependencies(file_path, dependencies)
+                self.metadata.update_dependencies(file_path, self.metadata.get_dependencies(file_path))
+
+    def _failure_digest(self, file_path, dependencies, constants):
+        return self.fingerprinter.inputs_digest(file_path, dependencies, {}, constants)
+
+    def _failure_pending(self, file_path):
+        failure = self.metadata.get_failure(file_path)
+        if failure is None:
+            return False
+        unchanged = self._failure_digest(file_path, failure["dependencies"], failure["constants"]) == failure["digest"]
+        if unchanged and not failure.get("transient"):
+            self._logger.debug("Inputs of %s are unchanged since it failed. Not retrying.", file_path)
+            return True
+        # An edit after a transient failure is tried at once, its backoff only paces retries of the same inputs
+        if failure.get("transient") and not unchanged:
             return False
+        if time.time() < failure["retry_after"]:
+            self._logger.debug("%s failed %s times in a row. Retrying after backoff.", file_path, failure['attempts'])
+            self._deferred_files[file_path] = failure["retry_after"]
+            return True
+        return False
 
-    def _process_file_and_deps(self, file_path):
-        self._logger.debug(f"Processing file and dependencies: {file_path}")
+    def _record_outcome(self, file_path):
+        if self._failed_inputs is None:
+            self.metadata.remove_failure(file_path)
+            return
+
+        # Everything the source is known to read counts, so fixing any of it triggers a retry
+        dependencies, constants = self._failed_inputs
+        dependencies = sorted(set(dependencies) | set(self.metadata.get_dependencies(file_path)))
+        constants = sorted(set(constants))
+        previous = self.metadata.get_failure(file_path)
+        attempts = previous["attempts"] + 1 if previous is not None else 1
+        # Timeouts, crashes and script failures can pass without any input changing, so they are retried
+        # on the backoff timer alone instead of waiting for an edit
+        exponent = attempts - 1 if self._failure_transient else attempts - 2
+        backoff = 0
+        if exponent >= 0:
+            backoff = min(self.run_config.failure_backoff_secs * 2 ** exponent, self.run_config.failure_backoff_max_secs)
+        retry_after = time.time() + backoff
+        self.metadata.set_failure(file_path, {
+            "digest": self._failure_digest(file_path, dependencies, constants),
+            "dependencies": dependencies,
+            "constants": constants,
+            "attempts": attempts,
+            "retry_after": retry_after,
+            "transient": self._failure_transient,
+        })
+        if self._failure_transient:
+            self._deferred_files[file_path] = retry_after
+
+    def pop_deferred_files(self):
+        deferred, self._deferred_files = self._deferred_files, {}
+        return deferred
+
+    def _process_matched_file(self, file_path, file_type, ext):
+        if file_type == "render":
+            output_path = file_path[:-len(ext)]
+            result = self._render(file_path, output_path)
+            if not result["success"]:
+                if result["check"]["allowed"]:
+                    self._failed_inputs = (result["dependencies"], result["constants"])
+                    self._failure_transient = result.get("transient", False)
+                return False
+            
+            previous_generated_files = set(self.metadata.get_generated_files(file_path))
+            current_generated_files = {output_path}
+            self._remove_outdated_files(current_generated_files, previous_generated_files)
+            
+            self.metadata.set(file_path, StatCache.getmtime(file_path))
+            self.metadata.update_dependencies(file_path, result["dependencies"])
+            self.metadata.set_generated_files(file_path, current_generated_files)
+            self.metadata.set_constants(file_path, result["constants"])
+            return True
+        elif file_type == "serialize":
+            return self._render_serialize(file_path, ext)
+        if self._batch_active > 0:
+            self._rendered_files.add(file_path)
+        return False
+
+    def cleanup_file(self, file_path):
+        self._logger.debug("Cleaning up generated files of: %s", file_path)
+        with self.metadata.batch_update():
+            previous_generated_files = set(self.metadata.get_generated_files(file_path))
+            self._remove_outdated_files(set(), previous_generated_files)
+            self.metadata.remove_file_metadata(file_path)
+
+    def targets(self, file_path):
         dependents = self.metadata.get_dependents(file_path)
         if not dependents:
-            return self._process_file(file_path)
+            return [file_path]
         
-        for dep in dependents:
-            self._process_file(dep)
+        self.fragment_cache.invalidate_sources(dependents)
+        return list(dependents)
+
+    def _process_file_and_deps(self, file_path):
+        self._logger.debug("Processing file and dependencies: %s", file_path)
+        for target in self.targets(file_path):
+            self._process_file(target)
 
-    def process_batch(self, files):
-        self._logger.debug(f"Processing batch of files: {files}")
+    def process_batch(self, files, expand_dependents=True):
+        self._logger.debug("Processing batch of files: %s", files)
+        if self._batch_active == 0:
+            self._changed_files = 0
         self._batch_active += 1
         try:
-            with self.metadata.batch_update():
+            with StatCache.batch(files), self.metadata.batch_update():
                 for file_path in files:
-                    self._process_file_and_deps(file_path)
+                    if expand_dependents:
+                        self._process_file_and_deps(file_path)
+                    else:
+                        self._process_file(file_path)
+                if self._batch_active == 1:
+                    self._publish()
         finally:
             self._batch_active -= 1
-            if self._batch_active == 0 and self._rendered_files:
+            if self._batch_active == 0:
+                self.publisher.discard()
+                self._pending_fingerprints.clear()
                 self._rendered_files.clear()
-            self._logger.debug(f"Batch update finished, level: {self._batch_active}")
+            self._logger.debug("Batch update finished, level: %s", self._batch_active)
+        return self._changed_files
@@ -0,0 +1,65 @@
+import os
+import json
+import time
+import threading
+from .utils import get_logger
+
+TRACE_VERSION = 1
+
+class EventTraceRecorder:
+    def __init__(self, trace_path, roots):
+        self._logger = get_logger(type(self))
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self.trace_path = os.path.abspath(trace_path)
+        os.makedirs(os.path.dirname(self.trace_path), exist_ok=True)
+        # Each start of the watcher begins a new trace, replays need one header and one clock
+        self._file = open(trace_path, "w", encoding="utf-8", buffering=1)
+        self._write({
+            "version": TRACE_VERSION,
+            "roots": [os.path.abspath(root) for root in roots],
+            "started": time.time(),
+        })
+        self._logger.info(f"⏺️ Recording watcher events to {trace_path}")
+
+    def _write(self, record):
+        with self._lock:
+            if self._file is not None:
+                self._file.write(json.dumps(record) + "\n")
+
+    def record(self, event):
+        path = os.fsdecode(event.src_path)
+        dest_path = os.fsdecode(event.dest_path) if event.dest_path else None
+        # Writes to a trace inside a watched directory would otherwise record themselves without end
+        if self.trace_path in (os.path.abspath(path), dest_path and os.path.abspath(dest_path)):
+            return
+        self._write({
+            "time": round(time.monotonic() - self._started, 6),
+            "event": event.event_type,
+            "path": path,
+            "dest_path": dest_path,
+            "is_directory": event.is_directory,
+        })
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+def read_trace(trace_path):
+    with open(trace_path, "r", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if not records or records[0].get("version") != TRACE_VERSION:
+        raise ValueError(f"{trace_path} is not an event trace of version {TRACE_VERSION}")
+    return records[0], records[1:]
+
+class PipelineProbe:
+    # Listeners see renders, publishes and reloads as they happen, call sites check listeners first so this costs nothing unused
+    listeners = []
+
+    @classmethod
+    def emit(cls, kind, **fields):
+        now = time.monotonic()
+        for listener in cls.listeners:
+            listener(kind, now, fields)
@@ -1,23 +1,71 @@
 import json
+import heapq
+import functools
+import itertools
 import subprocess
+import tempfile
 import traceback
 import yaml
 import logging
 import threading
 import os
-from datetime import datetime
+import time
+from collections.abc import Mapping
+
+REPEAT_WINDOW_SECS = 300
+
+class RepeatedMessages:
+    def __init__(self, window_secs):
+        self.window_secs = window_secs
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._scheduler = None
+
+    def log(self, logger, level, key, msg):
+        # The first message for a key is logged at once, the ones following it within the window are counted
+        # and the last of them is logged with the count when the window closes
+        with self._lock:
+            entry = self._pending.get(key)
+            if entry is not None:
+                entry[0] += 1
+                entry[1] = msg
+                return
+            self._pending[key] = [0, msg]
+            if self._scheduler is None:
+                self._scheduler = Scheduler("mako-repeated-messages")
+            self._scheduler.call_later(self.window_secs, functools.partial(self._flush, logger, level, key))
+        logger.log(level, msg)
+
+    def _flush(self, logger, level, key):
+        with self._lock:
+            repeated, msg = self._pending.pop(key)
+        if repeated:
+            logger.log(level, f"{msg} (repeated {repeated} more times in the last {self.window_secs}s)")
 
 class ClassLoggerAdapter(logging.LoggerAdapter):
+    def debug(self, msg, *args, **kwargs):
+        # Disabled debug calls on the hot paths return after a single cached level check
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f"[{self.extra['class_name']}] {msg}", *args, extra=self.extra, **kwargs)
+
     def process(self, msg, kwargs):
-        class_name = self.extra.get('class_name', '')
-        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-        pid = os.getpid()
-        tid = threading.get_ident()
-        return f"[{now}] [PID:{pid}] [TID:{tid}] [{class_name}] {msg}", kwargs
+        # Only reached for enabled levels, timestamp and process/thread ids are added by ClassLogPrefix
+        kwargs["extra"] = self.extra
+        return f"[{self.extra['class_name']}] {msg}", kwargs
+
+class ClassLogPrefix(logging.Filter):
+    def filter(self, record):
+        # Runs for emitted records only and reuses the time and ids the record already holds
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record.created))
+        record.msg = f"[{timestamp}.{int(record.msecs):03d}] [PID:{record.process}] [TID:{record.thread}] {record.msg}"
+        return True
+
+_integration_logger = logging.getLogger(__name__)
+_integration_logger.addFilter(ClassLogPrefix())
 
 def get_logger(class_or_name):
     name = class_or_name if isinstance(class_or_name, str) else class_or_name.__name__
-    return ClassLoggerAdapter(logging.getLogger(__name__), {'class_name': name})
+    return ClassLoggerAdapter(_integration_logger, {'class_name': name})
 
 class ThreadSafeSet:
     def __init__(self):
@@ -29,46 +77,147 @@ class ThreadSafeSet:
     def add(self, item):
         with self._lock:
             self._set.add(item)
-            self._logger.debug(f"Item added to ThreadSafeSet: {item}")
+        self._logger.debug("Item added to ThreadSafeSet: %s", item)
 
     def remove(self, item):
         with self._lock:
             self._set.remove(item)
-            self._logger.debug(f"Item removed from ThreadSafeSet: {item}")
+        self._logger.debug("Item removed from ThreadSafeSet: %s", item)
 
     def empty(self):
         with self._lock:
             result = len(self._set) == 0
-            self._logger.debug(f"ThreadSafeSet is empty: {result}")
-            return result
+        self._logger.debug("ThreadSafeSet is empty: %s", result)
+        return result
         
     def __contains__(self, item):
         with self._lock:
             result = item in self._set
-            self._logger.debug(f"Item checked in ThreadSafeSet: {item}, result: {result}")
-            return result
+        self._logger.debug("Item checked in ThreadSafeSet: %s, result: %s", item, result)
+        return result
+
+class Scheduler:
+    def __init__(self, name):
+        self._logger = get_logger(type(self))
+        self._logger.debug("Initializing Scheduler %s", name)
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def call_later(self, delay, callback):
+        with self._condition:
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._counter), callback))
+            self._condition.notify()
+
+    def _run(self):
+        # One thread sleeps until the earliest due callback and is woken by notify when an earlier one arrives
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._condition.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, callback = heapq.heappop(self._heap)
+            try:
+                callback()
+            except Exception as e:
+                self._logger.error(f"MAKO-027 ❌ Error in scheduled callback: {e}\n{traceback.format_exc()}")
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def consume(self, amount):
+        # Spending past empty is allowed, the debt is what the next caller waits for
+        with self._lock:
+            self._refill()
+            self._tokens -= amount
+            return max(0.0, -self._tokens / self.rate)
+
+    def delay(self):
+        with self._lock:
+            self._refill()
+            return max(0.0, -self._tokens / self.rate)
+
+class TrackingMapping(Mapping):
+    ALL_KEYS = "*"
+
+    def __init__(self, data):
+        self.raw = data
+        self.accessed = set()
+
+    def __getitem__(self, key):
+        self.accessed.add(key)
+        return self.raw[key]
+
+    def __iter__(self):
+        self.accessed.add(self.ALL_KEYS)
+        return iter(self.raw)
+
+    def __len__(self):
+        self.accessed.add(self.ALL_KEYS)
+        return len(self.raw)
+
+    def touch(self, keys):
+        self.accessed.update(keys)
+
+# Runs a serialize script with os.environ recording which of the tracked variables it reads
+ENV_TRACE_BOOTSTRAP = """
+import atexit, json, os, runpy, sys
+trace_path = os.environ.pop("MAKO_PREPROCESSOR_ENV_TRACE")
+tracked = set(json.loads(os.environ.pop("MAKO_PREPROCESSOR_TRACKED_ENV")))
+nice = int(os.environ.pop("MAKO_PREPROCESSOR_NICE", "0"))
+if nice > os.getpriority(os.PRIO_PROCESS, 0):
+    os.setpriority(os.PRIO_PROCESS, 0, nice)
+accessed = set()
+class TrackingEnviron(type(os.environ)):
+    def __getitem__(self, key):
+        accessed.add(key)
+        return super().__getitem__(key)
+    def __iter__(self):
+        accessed.add("*")
+        return super().__iter__()
+os.environ.__class__ = TrackingEnviron
+def write_trace():
+    with open(trace_path, "w", encoding="utf-8") as f:
+        json.dump(sorted(key for key in accessed if key in tracked or key == "*"), f)
+atexit.register(write_trace)
+script_path = sys.argv[1]
+sys.argv = sys.argv[1:]
+sys.path[0] = os.path.dirname(os.path.abspath(script_path))
+runpy.run_path(script_path, run_name="__main__")
+"""
 
 class FileMatcher:
     _logger = get_logger("FileMatcher")
     @staticmethod
     def get_file_type(file_path, run_config):
-        FileMatcher._logger.debug(f"Getting file type for: {file_path}")
+        FileMatcher._logger.debug("Getting file type for: %s", file_path)
         if not run_config.is_serialize_disabled():
             for ext in run_config.serialize_extensions:
                 if file_path.endswith(ext):
-                    FileMatcher._logger.debug(f"File matched as serialize: {file_path}, extension: {ext}")
+                    FileMatcher._logger.debug("File matched as serialize: %s, extension: %s", file_path, ext)
                     return "serialize", ext
 
         if not run_config.is_render_disabled():
             for ext in run_config.render_extensions:
                 if file_path.endswith(ext):
-                    FileMatcher._logger.debug(f"File matched as render: {file_path}, extension: {ext}")
+                    FileMatcher._logger.debug("File matched as render: %s, extension: %s", file_path, ext)
                     return "render", ext
 
         if not run_config.is_hot_reload_disabled():
             for ext in run_config.hot_reload_extensions:
                 if file_path.endswith(ext):
-                    FileMatcher._logger.debug(f"File matched as hot_reload: {file_path}, extension: {ext}")
+                    FileMatcher._logger.debug("File matched as hot_reload: %s, extension: %s", file_path, ext)
                     return "hot_reload", ext
                     
         return None, None
@@ -76,30 +225,50 @@ class FileMatcher:
 class SerializedParser:
     _logger = get_logger("SerializedParser")
     @staticmethod
-    def parse(file_path, matched_ext, constants=None):
-        SerializedParser._logger.debug(f"Parsing file: {file_path}, extension: {matched_ext}")
+    def parse(file_path, matched_ext, constants=None, timeout=None, nice=0):
+        SerializedParser._logger.debug("Parsing file: %s, extension: %s", file_path, matched_ext)
+        if not isinstance(constants, TrackingMapping):
+            constants = TrackingMapping(constants or {})
         try:
             file_path_without_ext = file_path[:-len(matched_ext)]
             if file_path_without_ext.endswith(".yaml"):
                 with open(file_path, "r", encoding="utf-8") as f:
                     data = yaml.safe_load(f)
-                    SerializedParser._logger.debug(f"YAML file parsed: {file_path}")
+                    SerializedParser._logger.debug("YAML file parsed: %s", file_path)
                     return data
             elif file_path_without_ext.endswith(".json"):
                 with open(file_path, "r", encoding="utf-8") as f:
                     data = json.load(f)
-                    SerializedParser._logger.debug(f"JSON file parsed: {file_path}")
+                    SerializedParser._logger.debug("JSON file parsed: %s", file_path)
                     return data
             elif file_path_without_ext.endswith(".py"):
-                env = os.environ.copy()
-                if constants:
-                    env.update(constants)
-                result = subprocess.run(["python", file_path], capture_output=True, text=True, env=env)
+                fd, trace_path = tempfile.mkstemp(prefix=".mako_env_trace_", suffix=".json")
+                os.close(fd)
+                try:
+                    env = os.environ.copy()
+                    env.update(constants.raw)
+                    env["MAKO_PREPROCESSOR_ENV_TRACE"] = trace_path
+                    env["MAKO_PREPROCESSOR_TRACKED_ENV"] = json.dumps(list(constants.raw))
+                    env["MAKO_PREPROCESSOR_NICE"] = str(nice)
+                    try:
+                        result = subprocess.run(
+                            ["python", "-c", ENV_TRACE_BOOTSTRAP, file_path],
+                            capture_output=True, text=True, env=env, timeout=timeout
+                        )
+                    except subprocess.TimeoutExpired:
+                        SerializedParser._logger.error(
+                            f"MAKO-025 ❌ Executing Python file {file_path} timed out after {timeout}s. The process was killed."
+                        )
+                        return None
+                    finally:
+                        SerializedParser._touch_traced_constants(constants, trace_path)
+                finally:
+                    os.remove(trace_path)
                 if result.returncode != 0:
                     SerializedParser._logger.error(f"MAKO-001 ❌ Error executing Python file {file_path}: {result.stderr}")
                     return None
-                data = json.safe_load(result.stdout)
-                SerializedParser._logger.debug(f"Python file executed and parsed: {file_path}, data: {data}")
+                data = json.loads(result.stdout)
+                SerializedParser._logger.debug("Python file executed and parsed: %s, data: %s", file_path, data)
                 return data
             else:
                 SerializedParser._logger.error(f"MAKO-002 ❌ Unknown format {matched_ext} for file {file_path}. Skipping.")
@@ -107,3 +276,12 @@ class SerializedParser:
         except Exception as e:
             SerializedParser._logger.error(f"MAKO-003 ❌ Error parsing file {file_path}: {e}\n{traceback.format_exc()}")
             return None
+
+    @staticmethod
+    def _touch_traced_constants(constants, trace_path):
+        try:
+            with open(trace_path, "r", encoding="utf-8") as f:
+                constants.touch(json.load(f))
+        except (OSError, ValueError):
+            # The script exited without writing its trace, so it may depend on any constant
+            constants.touch([TrackingMapping.ALL_KEYS])
@@ -0,0 +1,48 @@
+"""Microbenchmark of the logging cost on the hot paths.
+
+Run with `python -m tests.benchmark_logging` from the repository root.
+"""
+import logging
+import os
+import tempfile
+import timeit
+from unittest.mock import patch
+
+from custom_components.mako_preprocessor.metadata import MetadataManager
+from custom_components.mako_preprocessor.run_config import RunConfig, RunConfigSnapshot
+from custom_components.mako_preprocessor.utils import FileMatcher, ThreadSafeSet, get_logger
+
+NUMBER = 100_000
+
+def report(name, seconds):
+    print(f"{name:<40} {seconds / NUMBER * 1e9:8.0f} ns/call")
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    logger = get_logger("Benchmark")
+    path = "/config/templates/automations.yaml.mako"
+    values = {"path": path, "mtime": 1700000000.0}
+
+    report("debug, eager f-string", timeit.timeit(lambda: logger.debug(f"Processing {path}: {values}"), number=NUMBER))
+    report("debug, lazy %-args", timeit.timeit(lambda: logger.debug("Processing %s: %s", path, values), number=NUMBER))
+
+    run_config = RunConfigSnapshot(RunConfig.DEFAULT_VALUES | {
+        "render_extensions": [".mako"],
+        "serialize_extensions": [".serialize"],
+        "enable_features": ["render", "template", "serialize"],
+    })
+    report("FileMatcher.get_file_type", timeit.timeit(lambda: FileMatcher.get_file_type(path, run_config), number=NUMBER))
+
+    files = ThreadSafeSet()
+    files.add(path)
+    report("ThreadSafeSet.__contains__", timeit.timeit(lambda: path in files, number=NUMBER))
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with patch("custom_components.mako_preprocessor.metadata.META_FILE", os.path.join(temp_dir, "meta.json")):
+            metadata = MetadataManager()
+            with metadata.batch_update():
+                report("MetadataManager.set in batch", timeit.timeit(lambda: metadata.set(path, values), number=NUMBER))
+                report("MetadataManager.get in batch", timeit.timeit(lambda: metadata.get(path), number=NUMBER))
+
+if __name__ == "__main__":
+    main()
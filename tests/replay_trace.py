@@ -0,0 +1,242 @@
+"""Replays a recorded watcher event trace against a fixture tree.
+
+Record a trace by setting `event_trace_file` in the configuration, then run
+`python -m tests.replay_trace TRACE FIXTURE_DIR` from the repository root. The
+fixture is copied, every event is applied to the copy and fed to the hot reload
+handler with its recorded timing, and the renders, reloads and edit-to-render
+latency of the pipeline are reported.
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+from watchdog.events import (
+    DirCreatedEvent, DirDeletedEvent, DirModifiedEvent, DirMovedEvent,
+    FileClosedEvent, FileCreatedEvent, FileDeletedEvent, FileModifiedEvent, FileMovedEvent, FileOpenedEvent,
+)
+
+from custom_components.mako_preprocessor import CONFIG_SCHEMA, DOMAIN, async_setup
+from custom_components.mako_preprocessor.hot_reload_worker import HotReloadWorker
+from custom_components.mako_preprocessor.metadata import MetadataManager
+from custom_components.mako_preprocessor.preprocessor_worker import PreprocessorWorker
+from custom_components.mako_preprocessor.trace import PipelineProbe, read_trace
+
+EVENT_CLASSES = {
+    (cls.event_type, cls.is_directory): cls
+    for cls in (
+        DirCreatedEvent, DirDeletedEvent, DirModifiedEvent, DirMovedEvent,
+        FileClosedEvent, FileCreatedEvent, FileDeletedEvent, FileModifiedEvent, FileMovedEvent, FileOpenedEvent,
+    )
+}
+
+def _digest(path):
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+class PipelineRecorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.renders = 0
+        self.publishes = 0
+        self.reloads = 0
+        self.changed_outputs = 0
+        self.edited_at = {}
+        self.latencies = {}
+        self.hashes = {}
+
+    def edited(self, path):
+        with self.lock:
+            self.edited_at.setdefault(path, time.monotonic())
+
+    def __call__(self, kind, now, fields):
+        with self.lock:
+            if kind == "render":
+                self.renders += 1
+                if fields["output"] not in self.hashes:
+                    self.hashes[fields["output"]] = _digest(fields["output"])
+                edited_at = self.edited_at.pop(fields["template"], None)
+                if edited_at is not None:
+                    self.latencies.setdefault(fields["template"], []).append(now - edited_at)
+            elif kind == "publish":
+                self.publishes += 1
+                output = fields["output"]
+                digest = _digest(output)
+                if digest is None or self.hashes.get(output) != digest:
+                    self.changed_outputs += 1
+                self.hashes[output] = digest
+            elif kind == "reload":
+                self.reloads += 1
+
+def _map_path(path, roots, fixture_dir):
+    for root in roots:
+        if path == root or path.startswith(root + os.sep):
+            return os.path.join(fixture_dir, os.path.relpath(path, root))
+    return None
+
+def _apply(record, path, dest_path, edit_text):
+    # The trace holds no content, edits are reproduced by appending edit_text so the source really changes
+    event = record["event"]
+    if record["is_directory"]:
+        if event == "created":
+            os.makedirs(path, exist_ok=True)
+        elif event == "deleted":
+            shutil.rmtree(path, ignore_errors=True)
+        elif event == "moved" and os.path.isdir(path):
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            os.replace(path, dest_path)
+        return
+    if event == "created":
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not os.path.exists(path):
+            open(path, "w").close()
+    elif event == "modified":
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a") as f:
+            f.write(edit_text)
+    elif event == "deleted":
+        if os.path.exists(path):
+            os.remove(path)
+    elif event == "moved" and os.path.exists(path):
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        os.replace(path, dest_path)
+
+def _wait_settled(worker, quiet_secs, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if worker.wait_idle(max(0, deadline - time.monotonic())) and worker.scheduled_files.empty():
+            time.sleep(quiet_secs)
+            if worker.idle.is_set() and worker.scheduled_files.empty():
+                return True
+        else:
+            time.sleep(0.1)
+    return False
+
+def replay(trace_path, fixture_dir, speed=1.0, options=None, edit_text="\n"):
+    header, records = read_trace(trace_path)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        directory = os.path.join(temp_dir, "config")
+        shutil.copytree(fixture_dir, directory)
+        with patch("custom_components.mako_preprocessor.metadata.META_FILE", os.path.join(temp_dir, ".mako_meta.json")):
+            metadata = MetadataManager()
+            metadata._initialize()
+            os.makedirs(os.path.join(temp_dir, "backups"))
+            hass = MagicMock()
+            hass.data = {}
+            config = CONFIG_SCHEMA({DOMAIN: {
+                "directories": [directory],
+                "backup_directory": os.path.join(temp_dir, "backups"),
+                "hot_reload": True,
+                "reload_behavior": "none",
+            } | (options or {})})
+            loop = asyncio.new_event_loop()
+            try:
+                hass.async_add_executor_job = lambda target, *args: loop.run_in_executor(None, target, *args)
+                hass.async_create_background_task = lambda target, name: loop.create_task(target)
+                loop.run_until_complete(async_setup(hass, config))
+                loop.run_until_complete(asyncio.gather(*asyncio.all_tasks(loop)))
+            finally:
+                loop.close()
+            config = config[DOMAIN]
+            worker = PreprocessorWorker()
+            # Only the replayed events reach the handler, the live observer would report them a second time
+            handler = HotReloadWorker().handler
+            HotReloadWorker().stop()
+            quiet_secs = config["hot_reload_delay_secs"] + config["reload_wait_min_secs"] + 0.5
+            _wait_settled(worker, quiet_secs, 600)
+
+            # Writes of generated outputs, staged under a temporary name and moved in place, were the pipeline's
+            # own and are only dispatched, the replay produces them itself
+            generated = metadata.generated_outputs()
+            for record in records:
+                if record["event"] == "moved" and _map_path(record["dest_path"], header["roots"], directory) in generated:
+                    generated.add(_map_path(record["path"], header["roots"], directory))
+
+            recorder = PipelineRecorder()
+            PipelineProbe.listeners.append(recorder)
+            try:
+                started = time.monotonic()
+                replayed = 0
+                for record in records:
+                    path = _map_path(record["path"], header["roots"], directory)
+                    if path is None:
+                        continue
+                    dest_path = _map_path(record["dest_path"], header["roots"], directory) if record["dest_path"] else None
+                    if speed > 0:
+                        time.sleep(max(0, started + record["time"] / speed - time.monotonic()))
+                    if path not in generated:
+                        _apply(record, path, dest_path, edit_text)
+                    cls = EVENT_CLASSES.get((record["event"], record["is_directory"]))
+                    if cls is None:
+                        continue
+                    event = cls(path, dest_path) if record["event"] == "moved" else cls(path)
+                    recorder.edited(dest_path or path)
+                    handler.dispatch(event)
+                    replayed += 1
+                replay_secs = time.monotonic() - started
+                settled = _wait_settled(worker, quiet_secs, 600)
+            finally:
+                PipelineProbe.listeners.remove(recorder)
+            worker.stop()
+
+    latencies = sorted(latency for values in recorder.latencies.values() for latency in values)
+    return {
+        "events": replayed,
+        "replay_secs": replay_secs,
+        "settled": settled,
+        "renders": recorder.renders,
+        "publishes": recorder.publishes,
+        # Renders that left their output as it was, whether skipped or republished unchanged
+        "redundant_renders": recorder.renders - recorder.changed_outputs,
+        "reloads": recorder.reloads,
+        "latency_p50": statistics.median(latencies) if latencies else None,
+        "latency_p90": latencies[int(len(latencies) * 0.9)] if latencies else None,
+        "latency_max": latencies[-1] if latencies else None,
+        "latencies": recorder.latencies,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("trace", help="trace recorded through event_trace_file")
+    parser.add_argument("fixture", help="directory standing in for the recorded roots")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed factor, 0 replays without gaps")
+    parser.add_argument("--edit-text", default="\n",
+                        help="text appended to a source on each recorded modification, escapes such as \\n are expanded")
+    parser.add_argument("--option", action="append", default=[], metavar="KEY=VALUE",
+                        help="configuration option, the value is parsed as an integer or float when possible")
+    args = parser.parse_args()
+
+    options = {}
+    for option in args.option:
+        key, _, value = option.partition("=")
+        for convert in (int, float):
+            try:
+                value = convert(value)
+                break
+            except ValueError:
+                continue
+        options[key] = value
+
+    edit_text = args.edit_text.encode("utf-8").decode("unicode_escape")
+    result = replay(args.trace, args.fixture, args.speed, options, edit_text)
+    print(f"Events replayed      {result['events']} in {result['replay_secs']:.2f}s")
+    print(f"Renders              {result['renders']} ({result['redundant_renders']} left the output unchanged)")
+    print(f"Outputs published    {result['publishes']}")
+    print(f"Reloads              {result['reloads']}")
+    if result["latency_p50"] is not None:
+        print(f"Edit to render       p50 {result['latency_p50']:.3f}s, p90 {result['latency_p90']:.3f}s, "
+              f"max {result['latency_max']:.3f}s")
+    if not result["settled"]:
+        print("Pipeline did not settle")
+
+if __name__ == "__main__":
+    main()
@@ -2,20 +2,33 @@ import os
 import sys
 import time
 import shutil
+import subprocess
 import tempfile
 import unittest
 import asyncio
 import logging
+import threading
 from io import StringIO
 from contextlib import contextmanager
 from unittest.mock import MagicMock, patch
+from watchdog.observers.api import EventQueue, ObservedWatch
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from custom_components.mako_preprocessor.run_config import RunConfig
-from custom_components.mako_preprocessor import setup, DOMAIN
+from custom_components.mako_preprocessor.run_config import RunConfig, RunConfigSnapshot
+from custom_components.mako_preprocessor import async_setup, DOMAIN
 from custom_components.mako_preprocessor.metadata import MetadataManager
 from custom_components.mako_preprocessor.template_renderer import TemplateRenderer
+from custom_components.mako_preprocessor.config_reloader import ConfigReloader
+from custom_components.mako_preprocessor.preprocessor_worker import Lane, PreprocessorWorker
+from custom_components.mako_preprocessor.backup_store import BackupStore
+from custom_components.mako_preprocessor.observers import HybridObserver, StatIndexEmitter
+from custom_components.mako_preprocessor.stat_cache import StatCache
+from custom_components.mako_preprocessor.hot_reload_worker import HotReloadWorker
+from custom_components.mako_preprocessor.run_preprocessor import RunPreprocessor
+from custom_components.mako_preprocessor.trace import PipelineProbe, read_trace
+from custom_components.mako_preprocessor.utils import RepeatedMessages, get_logger
+from mako.template import Template
 
 @contextmanager
 def suppress_logs():
@@ -128,6 +141,15 @@ class TestSetup(unittest.TestCase):
         
         self.timer.stopTest(self)
 
+    def _setup(self, loop):
+        """Runs async_setup with executor jobs on the loop's executor and waits for the initial run"""
+
+        self.hass.async_add_executor_job = lambda target, *args: loop.run_in_executor(None, target, *args)
+        background_tasks = []
+        self.hass.async_create_background_task = lambda target, name: background_tasks.append(loop.create_task(target))
+        self.assertTrue(loop.run_until_complete(async_setup(self.hass, { DOMAIN: self.config })))
+        loop.run_until_complete(asyncio.gather(*background_tasks))
+
     def _validate_template_output(self, expected_content = "key: value"):
         """Validates the template output format"""
 
@@ -156,7 +178,7 @@ class TestSetup(unittest.TestCase):
             asyncio.set_event_loop(loop)
             
             try:
-                setup(self.hass, { DOMAIN: self.config })
+                self._setup(loop)
                 loop.run_until_complete(asyncio.sleep(0.1))
                 
                 self.assertTrue(os.path.exists(self.test_output_file))
@@ -184,7 +206,7 @@ class TestSetup(unittest.TestCase):
                 self.config["overwrite_modified_files"] = False
                 
                 # Small delay to allow async operations to complete
-                setup(self.hass, { DOMAIN: self.config })
+                self._setup(loop)
                 loop.run_until_complete(asyncio.sleep(0.1))
                 
                 # Check file still exists and content hasn't changed
@@ -219,7 +241,7 @@ class TestSetup(unittest.TestCase):
                 self.config["backup_directory"] = backup_dir
                 self.config["overwrite_modified_files"] = False
                 
-                setup(self.hass, { DOMAIN: self.config })
+                self._setup(loop)
                 loop.run_until_complete(asyncio.sleep(0.1))
                 
                 # Verify original file remains unchanged
@@ -247,7 +269,7 @@ class TestSetup(unittest.TestCase):
 
                 # First run to generate initial file
                 self.config["overwrite_modified_files"] = True
-                setup(self.hass, { DOMAIN: self.config })
+                self._setup(loop)
                 loop.run_until_complete(asyncio.sleep(0.1))
 
                 with open(self.test_mako_file, "w") as f:
@@ -258,7 +280,7 @@ class TestSetup(unittest.TestCase):
                 self.config["backup_directory"] = backup_dir
                 self.config["overwrite_modified_files"] = True
                 
-                setup(self.hass, { DOMAIN: self.config })
+                self._setup(loop)
                 loop.run_until_complete(asyncio.sleep(0.1))
                 
                 # Verify file was overwritten but not backed up
@@ -279,7 +301,7 @@ class TestSetup(unittest.TestCase):
             try:
                 # First run to generate initial file
                 self.config["overwrite_modified_files"] = True
-                setup(self.hass, { DOMAIN: self.config })
+                self._setup(loop)
                 loop.run_until_complete(asyncio.sleep(0.1))
                 
                 # Store initial yaml timestamp and content
@@ -296,7 +318,7 @@ class TestSetup(unittest.TestCase):
                     f.write(new_content)
                 
                 # Run setup again
-                setup(self.hass, { DOMAIN: self.config })
+                self._setup(loop)
                 loop.run_until_complete(asyncio.sleep(0.1))
                 
                 # Verify file was overwritten
@@ -315,7 +337,7 @@ class TestSetup(unittest.TestCase):
             try:
                 # First run to generate initial file
                 self.config["overwrite_modified_files"] = True
-                setup(self.hass, { DOMAIN: self.config })
+                self._setup(loop)
                 loop.run_until_complete(asyncio.sleep(0.1))
                 
                 # Store initial yaml timestamp
@@ -332,7 +354,7 @@ class TestSetup(unittest.TestCase):
                 MetadataManager()._initialize()
                 
                 # Run setup again with overwrite enabled
-                setup(self.hass, { DOMAIN: self.config })
+                self._setup(loop)
                 loop.run_until_complete(asyncio.sleep(0.1))
                 
                 # Verify warning message about corrupted metadata
@@ -363,7 +385,7 @@ class TestSetup(unittest.TestCase):
                 # Configure and run setup
                 self.config["overwrite_modified_files"] = True
 
-                setup(self.hass, { DOMAIN: self.config })
+                self._setup(loop)
                 loop.run_until_complete(asyncio.sleep(0.1))
                 
                 # Verify changes
@@ -399,16 +421,16 @@ class TestSetup(unittest.TestCase):
                 self.config["overwrite_modified_files"] = True
                 
                 # Run setup
-                setup(self.hass, { DOMAIN: self.config })
+                self._setup(loop)
                 loop.run_until_complete(asyncio.sleep(0.1))
                 
                 # Verify backup was created
-                backup_files = os.listdir(backup_dir)
-                self.assertEqual(len(backup_files), 1)
+                backup_store = BackupStore(RunConfig())
+                backup_entries = backup_store.entries(self.test_output_file)
+                self.assertEqual(len(backup_entries), 1)
                 
                 # Verify backup content
-                backup_path = os.path.join(backup_dir, backup_files[0])
-                with open(backup_path, "r") as f:
+                with open(backup_store.blob_path(backup_entries[0]), "r") as f:
                     backup_content = f.read()
                 self.assertEqual(backup_content, user_content)
                 
@@ -440,7 +462,7 @@ class TestSetup(unittest.TestCase):
                 self.config["overwrite_modified_files"] = True
                 
                 # Run setup
-                setup(self.hass, { DOMAIN: self.config })
+                self._setup(loop)
                 loop.run_until_complete(asyncio.sleep(0.1))
                 
                 # Verify backup directory is empty
@@ -474,7 +496,7 @@ class TestSetup(unittest.TestCase):
                 self.config["overwrite_modified_files"] = True
                 
                 # Run setup
-                setup(self.hass, { DOMAIN: self.config })
+                self._setup(loop)
                 loop.run_until_complete(asyncio.sleep(0.1))
                 
                 # Verify original file was not modified
@@ -515,7 +537,7 @@ class TestSetup(unittest.TestCase):
                 self.config["overwrite_modified_files"] = True
                 
                 # Run setup
-                setup(self.hass, { DOMAIN: self.config })
+                self._setup(loop)
                 loop.run_until_complete(asyncio.sleep(0.1))
                 
                 # Verify backup directory is empty
@@ -555,7 +577,7 @@ item_${i}: value_${i}
 
                 # Configure and run setup
                 self.config["overwrite_modified_files"] = True
-                setup(self.hass, { DOMAIN: self.config })
+                self._setup(loop)
                 loop.run_until_complete(asyncio.sleep(0.1))
 
                 # Verify file was generated
@@ -626,7 +648,7 @@ ${'Dynamic content'}"""
 
                 # Configure and run setup
                 self.config["overwrite_modified_files"] = True
-                setup(self.hass, { DOMAIN: self.config })
+                self._setup(loop)
                 loop.run_until_complete(asyncio.sleep(0.1))
 
                 # Verify file was generated
@@ -665,7 +687,7 @@ username: admin"""
                 # Configure and run setup
                 self.config["overwrite_modified_files"] = True
                 self.config["constants"] ={"other": "secret"}
-                setup(self.hass, { DOMAIN: self.config })
+                self._setup(loop)
                 loop.run_until_complete(asyncio.sleep(0.1))
                 
                 # Verify error was logged
@@ -695,7 +717,7 @@ username: admin"""
                 # Configure secrets and run setup
                 self.config["overwrite_modified_files"] = True
                 self.config["constants"] ={"test": "secret_password"}
-                setup(self.hass, { DOMAIN: self.config })
+                self._setup(loop)
                 loop.run_until_complete(asyncio.sleep(0.1))
                 
                 # Verify file was generated
@@ -741,7 +763,7 @@ outputs:
                 # Configure and run setup
                 self.config["overwrite_modified_files"] = True
                 self.config["constants"] = {"prefix": "Hi,"}
-                setup(self.hass, { DOMAIN: self.config })
+                self._setup(loop)
                 loop.run_until_complete(asyncio.sleep(0.1))
                 
                 # Verify output file was generated
@@ -790,7 +812,7 @@ outputs:
 
                 # Configure and run setup with overwrite enabled
                 self.config["overwrite_modified_files"] = True
-                setup(self.hass, { DOMAIN: self.config })
+                self._setup(loop)
                 loop.run_until_complete(asyncio.sleep(0.1))
 
                 # Verify file was modified
@@ -839,7 +861,7 @@ outputs:
 
                 # Configure and run setup
                 self.config["overwrite_modified_files"] = True
-                setup(self.hass, { DOMAIN: self.config })
+                self._setup(loop)
                 loop.run_until_complete(asyncio.sleep(0.1))
 
                 # Verify first output file was generated
@@ -897,7 +919,7 @@ outputs:
 
                 # Configure and run setup
                 self.config["overwrite_modified_files"] = True
-                setup(self.hass, { DOMAIN: self.config })
+                self._setup(loop)
                 loop.run_until_complete(asyncio.sleep(0.1))
 
                 # Verify first output file was generated using template1
@@ -944,7 +966,7 @@ outputs:
 
                 # Configure and run setup
                 self.config["overwrite_modified_files"] = True
-                setup(self.hass, { DOMAIN: self.config })
+                self._setup(loop)
                 loop.run_until_complete(asyncio.sleep(0.1))
 
                 # Verify output file was not created
@@ -987,7 +1009,7 @@ outputs:
 
                 # Configure and run setup
                 self.config["overwrite_modified_files"] = True
-                setup(self.hass, { DOMAIN: self.config })
+                self._setup(loop)
                 loop.run_until_complete(asyncio.sleep(0.1))
 
                 # Verify first output file was not created due to error
@@ -1039,7 +1061,7 @@ outputs:
 
                 # Configure and run setup
                 self.config["overwrite_modified_files"] = True
-                setup(self.hass, { DOMAIN: self.config })
+                self._setup(loop)
                 loop.run_until_complete(asyncio.sleep(0.1))
 
                 # Verify directory was NOT created
@@ -1067,7 +1089,7 @@ outputs:
                 self.config["reload_behavior"] = "reload_all"
 
                 # Initial setup
-                setup(self.hass, { DOMAIN: self.config })
+                self._setup(loop)
                 loop.run_until_complete(asyncio.sleep(0.1))
 
                 # Store initial yaml content and timestamp
@@ -1117,7 +1139,7 @@ outputs:
                 self.config["reload_behavior"] = "reload_all"
 
                 # Initial setup
-                setup(self.hass, { DOMAIN: self.config })
+                self._setup(loop)
                 loop.run_until_complete(asyncio.sleep(0.1))
 
                 # Store initial yaml timestamp
@@ -1163,6 +1185,1312 @@ outputs:
             finally:
                 loop.close()
 
+    def test_query_metadata_filters_and_paginates(self):
+        with suppress_logs():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            
+            try:
+                # Create several templates in a subdirectory
+                sub_dir = os.path.join(self.directories, "packages")
+                os.makedirs(sub_dir)
+                for name in ["a", "b", "c"]:
+                    with open(os.path.join(sub_dir, f"{name}.yaml.mako"), "w") as f:
+                        f.write(f"{name}: value")
+
+                self._setup(loop)
+                loop.run_until_complete(asyncio.sleep(0.1))
+
+                metadata = MetadataManager()
+
+                # Filter by prefix and kind
+                result = metadata.query(path=sub_dir, kind="generated_files")
+                self.assertEqual(
+                    [record["path"] for record in result["records"]],
+                    [os.path.join(sub_dir, f"{name}.yaml.mako") for name in ["a", "b", "c"]]
+                )
+                self.assertIsNone(result["next_cursor"])
+
+                # Filter by glob
+                result = metadata.query(path=os.path.join(sub_dir, "*.yaml"), kind="mtime")
+                self.assertEqual(len(result["records"]), 3)
+
+                # Paginate with cursor
+                first_page = metadata.query(path=sub_dir, kind="generated_files", limit=2)
+                self.assertEqual(len(first_page["records"]), 2)
+                self.assertIsNotNone(first_page["next_cursor"])
+                second_page = metadata.query(
+                    path=sub_dir, kind="generated_files", limit=2, cursor=first_page["next_cursor"]
+                )
+                self.assertEqual(len(second_page["records"]), 1)
+                self.assertEqual(second_page["records"][0]["path"], os.path.join(sub_dir, "c.yaml.mako"))
+                self.assertIsNone(second_page["next_cursor"])
+                
+            finally:
+                loop.close()
+
+    def test_reload_config_applies_changes_in_place(self):
+        with suppress_logs():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            
+            try:
+                with open(self.test_mako_file, "w") as f:
+                    f.write("prefix: ${constants['prefix']}")
+
+                self.config["constants"] = {"prefix": "old"}
+                self._setup(loop)
+                loop.run_until_complete(asyncio.sleep(0.1))
+                self._validate_template_output("prefix: old")
+
+                # Add a new directory with its own template
+                extra_directory = tempfile.mkdtemp()
+                self.addCleanup(lambda: shutil.rmtree(extra_directory, ignore_errors=True))
+                extra_mako_file = os.path.join(extra_directory, "extra.yaml.mako")
+                extra_output_file = os.path.join(extra_directory, "extra.yaml")
+                with open(extra_mako_file, "w") as f:
+                    f.write("extra: value")
+
+                # Change a constant and add the directory at runtime
+                new_config = dict(self.config)
+                new_config["constants"] = {"prefix": "new"}
+                new_config["directories"] = [self.directories, extra_directory]
+                ConfigReloader(RunConfig()).reload(new_config)
+                loop.run_until_complete(asyncio.sleep(0.2))
+
+                self._validate_template_output("prefix: new")
+                self.assertTrue(os.path.exists(extra_output_file))
+
+                # Removing the directory again cleans up its generated files
+                ConfigReloader(RunConfig()).reload(self.config | {"constants": {"prefix": "new"}})
+                loop.run_until_complete(asyncio.sleep(0.1))
+
+                self.assertFalse(os.path.exists(extra_output_file))
+                self.assertEqual(MetadataManager().get_generated_files(extra_mako_file), [])
+                
+            finally:
+                loop.close()
+
+    def test_reload_config_rerenders_only_templates_using_changed_constant(self):
+        with suppress_logs():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            
+            try:
+                with open(self.test_mako_file, "w") as f:
+                    f.write("first: ${constants['first']}")
+                other_mako_file = os.path.join(self.directories, "other.yaml.mako")
+                other_output_file = os.path.join(self.directories, "other.yaml")
+                with open(other_mako_file, "w") as f:
+                    f.write("second: ${constants.get('second')}")
+
+                self.config["constants"] = {"first": "a", "second": "b"}
+                self._setup(loop)
+                loop.run_until_complete(asyncio.sleep(0.1))
+
+                metadata = MetadataManager()
+                self.assertEqual(metadata.get_constants(self.test_mako_file), ["first"])
+                self.assertEqual(metadata.get_constants(other_mako_file), ["second"])
+                other_mtime = os.path.getmtime(other_output_file)
+
+                ConfigReloader(RunConfig()).reload(self.config | {"constants": {"first": "c", "second": "b"}})
+                loop.run_until_complete(asyncio.sleep(0.1))
+
+                self._validate_template_output("first: c")
+                self.assertEqual(os.path.getmtime(other_output_file), other_mtime)
+                
+            finally:
+                loop.close()
+
+    def test_reload_config_rerenders_failed_template_using_changed_constant(self):
+        with suppress_logs():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            
+            try:
+                with open(self.test_mako_file, "w") as f:
+                    f.write("first: ${constants['first'] if constants['first'] != 'a' else 1 / 0}")
+
+                self.config["constants"] = {"first": "a"}
+                self._setup(loop)
+                loop.run_until_complete(asyncio.sleep(0.1))
+
+                metadata = MetadataManager()
+                self.assertIsNotNone(metadata.get_failure(self.test_mako_file))
+                self.assertEqual(metadata.get_generated_files(self.test_mako_file), [])
+
+                ConfigReloader(RunConfig()).reload(self.config | {"constants": {"first": "c"}})
+                loop.run_until_complete(asyncio.sleep(0.1))
+
+                self._validate_template_output("first: c")
+                self.assertIsNone(metadata.get_failure(self.test_mako_file))
+                
+            finally:
+                loop.close()
+
+    def test_load_data_tracks_data_file_dependency(self):
+        with suppress_logs():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            
+            try:
+                data_file = os.path.join(self.directories, "rooms.json")
+                with open(data_file, "w") as f:
+                    f.write('{"rooms": ["kitchen", "hall"]}')
+                with open(self.test_mako_file, "w") as f:
+                    f.write("rooms: ${', '.join(load_data('rooms.json')['rooms'])}")
+
+                self._setup(loop)
+                loop.run_until_complete(asyncio.sleep(0.1))
+
+                self._validate_template_output("rooms: kitchen, hall")
+                self.assertIn(data_file, MetadataManager().get_dependencies(self.test_mako_file))
+                self.assertIn(self.test_mako_file, MetadataManager().get_dependents(data_file))
+
+                # Editing the data file re-renders its dependents
+                with open(data_file, "w") as f:
+                    f.write('{"rooms": ["garage"]}')
+                PreprocessorWorker().add_file(data_file)
+                loop.run_until_complete(asyncio.sleep(0.1))
+
+                self._validate_template_output("rooms: garage")
+                
+            finally:
+                loop.close()
+
+    def test_cached_block_is_reused_until_dependency_changes(self):
+        with suppress_logs():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            
+            try:
+                data_file = os.path.join(self.directories, "entities.json")
+                with open(data_file, "w") as f:
+                    f.write('{"count": 1}')
+                with open(self.test_mako_file, "w") as f:
+                    f.write("<%block cached=\"True\">entities: ${load_data('entities.json')['count']}-${variables.get('run')}</%block>")
+
+                self._setup(loop)
+                loop.run_until_complete(asyncio.sleep(0.1))
+                self._validate_template_output("entities: 1-None")
+
+                # The cached block is served from the cache on the next render
+                renderer = PreprocessorWorker().template_renderer
+                with PreprocessorWorker.Lock.acquire():
+                    renderer._render(self.test_mako_file, self.test_output_file, run="second")
+                self._validate_template_output("entities: 1-None")
+
+                # Changing the data file invalidates the cached block
+                with open(data_file, "w") as f:
+                    f.write('{"count": 22}')
+                PreprocessorWorker().add_file(data_file)
+                loop.run_until_complete(asyncio.sleep(0.1))
+                self._validate_template_output("entities: 22-None")
+                
+            finally:
+                loop.close()
+
+    def test_serialize_compiles_shared_template_once(self):
+        with suppress_logs():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            
+            try:
+                template_path = os.path.join(self.directories, "fanout.template")
+                with open(template_path, "w") as f:
+                    f.write("index: ${variables['index']}")
+
+                serialize_path = os.path.join(self.directories, "fanout.yaml.serialize")
+                outputs = "\n".join(
+                    f"  - filename: fanout_{index}.yaml\n    variables:\n      index: {index}" for index in range(20)
+                )
+                with open(serialize_path, "w") as f:
+                    f.write(f"template: fanout.template\noutputs:\n{outputs}\n")
+
+                self.config["serialize_workers"] = 4
+                with patch.object(
+                    TemplateRenderer, "_compile", autospec=True, side_effect=TemplateRenderer._compile
+                ) as compile_mock:
+                    self._setup(loop)
+                    loop.run_until_complete(asyncio.sleep(0.2))
+
+                compiled_templates = [call.args[1] for call in compile_mock.call_args_list]
+                self.assertEqual(compiled_templates.count(template_path), 1)
+
+                metadata = MetadataManager()
+                self.assertEqual(len(metadata.get_generated_files(serialize_path)), 20)
+                for index in range(20):
+                    output_path = os.path.join(self.directories, f"fanout_{index}.yaml")
+                    with open(output_path, "r") as f:
+                        self.assertEqual(f.read().split("\n")[1], f"index: {index}")
+                    self.assertEqual(metadata.get(output_path), os.path.getmtime(output_path))
+                
+            finally:
+                loop.close()
+
+    def test_serialize_rerenders_only_outputs_with_changed_inputs(self):
+        with suppress_logs():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            
+            try:
+                template_path = os.path.join(self.directories, "test.template")
+                with open(template_path, "w") as f:
+                    f.write("message: ${variables['text']}")
+
+                serialize_path = os.path.join(self.directories, "test.yaml.serialize")
+                serialize_content = """
+template: test.template
+outputs:
+  - filename: output1.yaml
+    variables:
+      text: first
+  - filename: output2.yaml
+    variables:
+      text: second
+"""
+                with open(serialize_path, "w") as f:
+                    f.write(serialize_content)
+
+                self._setup(loop)
+                loop.run_until_complete(asyncio.sleep(0.1))
+
+                output1_path = os.path.join(self.directories, "output1.yaml")
+                output2_path = os.path.join(self.directories, "output2.yaml")
+                output1_mtime = os.path.getmtime(output1_path)
+                output2_mtime = os.path.getmtime(output2_path)
+
+                # Edit only the second output's variables
+                with open(serialize_path, "w") as f:
+                    f.write(serialize_content.replace("text: second", "text: changed"))
+                renderer = PreprocessorWorker().template_renderer
+                with PreprocessorWorker.Lock.acquire():
+                    changed_files = renderer.process_batch([serialize_path])
+
+                self.assertEqual(changed_files, 1)
+                self.assertEqual(os.path.getmtime(output1_path), output1_mtime)
+                self.assertGreater(os.path.getmtime(output2_path), output2_mtime)
+                with open(output2_path, "r") as f:
+                    self.assertIn("message: changed", f.read())
+
+                # Processing the unchanged manifest again touches nothing
+                with PreprocessorWorker.Lock.acquire():
+                    self.assertEqual(renderer.process_batch([serialize_path]), 0)
+                
+            finally:
+                loop.close()
+
+    def test_render_cache_reuses_identical_renders(self):
+        with suppress_logs():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            
+            try:
+                cache_dir = os.path.join(self.meta_dir, "renders")
+                template_path = os.path.join(self.directories, "shared.template")
+                with open(template_path, "w") as f:
+                    f.write("shared: ${variables['name']}")
+
+                serialize_path = os.path.join(self.directories, "shared.yaml.serialize")
+                with open(serialize_path, "w") as f:
+                    f.write("""
+template: shared.template
+variables:
+  name: same
+outputs:
+  - filename: package1.yaml
+  - filename: package2.yaml
+""")
+
+                self.config["render_cache_size_mb"] = 1
+                with patch('custom_components.mako_preprocessor.render_cache.CACHE_DIR', cache_dir), \
+                        patch.object(Template, "render", autospec=True, side_effect=Template.render) as render_mock:
+                    self._setup(loop)
+                    loop.run_until_complete(asyncio.sleep(0.1))
+
+                # The second output is served from the cache instead of executing the template
+                rendered_templates = [call.args[0].filename for call in render_mock.call_args_list]
+                self.assertEqual(rendered_templates.count(template_path), 1)
+                for name in ["package1.yaml", "package2.yaml"]:
+                    with open(os.path.join(self.directories, name), "r") as f:
+                        self.assertEqual(f.read().split("\n")[1], "shared: same")
+                
+            finally:
+                loop.close()
+
+    def test_streaming_render_replaces_output_atomically(self):
+        with suppress_logs():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            
+            try:
+                with open(self.test_mako_file, "w") as f:
+                    f.write("% for i in range(3):\nitem_${i}: value\n% endfor")
+
+                self.config["streaming_render"] = True
+                self._setup(loop)
+                loop.run_until_complete(asyncio.sleep(0.1))
+
+                with open(self.test_output_file, "r") as f:
+                    lines = f.read().split("\n")
+                self.assertTrue(lines[0].startswith("# Generated by: mako_preprocessor"))
+                self.assertEqual(lines[1:4], ["item_0: value", "item_1: value", "item_2: value"])
+                self.assertEqual(lines[5], "# Rendered with:")
+                initial_mtime = os.path.getmtime(self.test_output_file)
+
+                # A failing render leaves the previous output and no staged files behind
+                with open(self.test_mako_file, "w") as f:
+                    f.write("broken: ${constants['missing']}")
+                renderer = PreprocessorWorker().template_renderer
+                with PreprocessorWorker.Lock.acquire():
+                    renderer.process_batch([self.test_mako_file])
+
+                self.assertEqual(os.path.getmtime(self.test_output_file), initial_mtime)
+                self.assertEqual(
+                    sorted(os.listdir(self.directories)), ["test.yaml", "test.yaml.mako"]
+                )
+                
+            finally:
+                loop.close()
+
+    def test_generations_publish_and_rollback(self):
+        with suppress_logs():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            generations_directory = tempfile.mkdtemp()
+            self.addCleanup(lambda: shutil.rmtree(generations_directory, ignore_errors=True))
+            
+            try:
+                self.config["publish_mode"] = "generations"
+                self.config["generations_directory"] = generations_directory
+                self.config["generations_keep"] = 2
+                self._setup(loop)
+                loop.run_until_complete(asyncio.sleep(0.1))
+
+                self.assertTrue(os.path.islink(self.test_output_file))
+                self.assertEqual(os.readlink(os.path.join(generations_directory, "current")), "1")
+                self._validate_template_output()
+
+                with open(self.test_mako_file, "w") as f:
+                    f.write("key: second")
+                renderer = PreprocessorWorker().template_renderer
+                with PreprocessorWorker.Lock.acquire():
+                    self.assertEqual(renderer.process_batch([self.test_mako_file]), 1)
+                self.assertEqual(os.readlink(os.path.join(generations_directory, "current")), "2")
+                self._validate_template_output("key: second")
+
+                with PreprocessorWorker.Lock.acquire():
+                    self.assertEqual(renderer.rollback_generation(), 1)
+                self._validate_template_output()
+                metadata = MetadataManager()
+                self.assertEqual(metadata.get(self.test_output_file), os.path.getmtime(self.test_output_file))
+
+                # The rolled back output is not treated as manually modified
+                with PreprocessorWorker.Lock.acquire():
+                    renderer.process_batch([self.test_mako_file])
+                self.assertEqual(os.readlink(os.path.join(generations_directory, "current")), "3")
+                self._validate_template_output("key: second")
+                self.assertEqual(sorted(os.listdir(generations_directory)), ["2", "3", "current"])
+                
+            finally:
+                loop.close()
+
+    def test_generations_share_unchanged_directories_and_roll_back_new_outputs(self):
+        with suppress_logs():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            generations_directory = tempfile.mkdtemp()
+            self.addCleanup(lambda: shutil.rmtree(generations_directory, ignore_errors=True))
+            
+            try:
+                lights_dir = os.path.join(self.directories, "lights")
+                os.makedirs(lights_dir)
+                lights_file = os.path.join(lights_dir, "lights.yaml.mako")
+                with open(lights_file, "w") as f:
+                    f.write("lights: on")
+                self.config["publish_mode"] = "generations"
+                self.config["generations_directory"] = generations_directory
+                self.config["generations_keep"] = 3
+                self._setup(loop)
+                self.assertTrue(PreprocessorWorker().wait_idle(5))
+                renderer = PreprocessorWorker().template_renderer
+
+                # The untouched directory is shared with the generation that holds it instead of hard linked
+                with open(self.test_mako_file, "w") as f:
+                    f.write("key: second")
+                with patch("os.sync") as sync, PreprocessorWorker.Lock.acquire():
+                    self.assertEqual(renderer.process_batch([self.test_mako_file]), 1)
+                sync.assert_not_called()
+                generation = os.readlink(os.path.join(generations_directory, "current"))
+                shared_dir = os.path.join(generations_directory, generation, lights_dir.lstrip(os.sep))
+                self.assertTrue(os.path.islink(shared_dir))
+                self._validate_template_output("key: second")
+                with open(os.path.join(lights_dir, "lights.yaml"), "r") as f:
+                    self.assertIn("lights: on", f.read())
+
+                # An output only the newer generation has is removed on rollback instead of left dangling
+                new_file = os.path.join(self.directories, "new.yaml.mako")
+                new_output_file = os.path.join(self.directories, "new.yaml")
+                with open(new_file, "w") as f:
+                    f.write("new: output")
+                with PreprocessorWorker.Lock.acquire():
+                    self.assertEqual(renderer.process_batch([new_file]), 1)
+                    self.assertTrue(os.path.exists(new_output_file))
+                    self.assertEqual(renderer.rollback_generation(), int(generation))
+                self.assertFalse(os.path.lexists(new_output_file))
+                self._validate_template_output("key: second")
+
+                # Generations still shared by kept ones survive pruning
+                for index in range(3):
+                    with open(self.test_mako_file, "w") as f:
+                        f.write(f"key: round{index}")
+                    with PreprocessorWorker.Lock.acquire():
+                        renderer.process_batch([self.test_mako_file])
+                with open(os.path.join(lights_dir, "lights.yaml"), "r") as f:
+                    self.assertIn("lights: on", f.read())
+                self._validate_template_output("key: round2")
+                
+            finally:
+                loop.close()
+
+    def test_backup_store_deduplicates_and_restores(self):
+        with suppress_logs():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            backup_dir = tempfile.mkdtemp()
+            self.addCleanup(lambda: shutil.rmtree(backup_dir, ignore_errors=True))
+            
+            try:
+                self.config["backup_enabled"] = True
+                self.config["backup_directory"] = backup_dir
+                self.config["backup_retention_count"] = 2
+                self._setup(loop)
+                loop.run_until_complete(asyncio.sleep(0.1))
+
+                backup_store = BackupStore(RunConfig())
+                other_file = os.path.join(self.directories, "other", "test.yaml")
+                os.makedirs(os.path.dirname(other_file))
+                for index, content in enumerate(["first", "second", "first", "third"]):
+                    for file_path in (self.test_output_file, other_file):
+                        with open(file_path, "w") as f:
+                            f.write(content)
+                        os.utime(file_path, (1700000000 + index, 1700000000 + index))
+                        backup_store.backup(file_path)
+
+                # Same basenames do not collide, identical content is stored once and only two versions are kept
+                entries = backup_store.entries(self.test_output_file)
+                self.assertEqual(len(entries), 2)
+                self.assertEqual(len(backup_store.entries(other_file)), 2)
+                blobs = [
+                    name for _, _, files in os.walk(os.path.join(backup_dir, "blobs")) for name in files
+                ]
+                self.assertEqual(len(blobs), 2)
+
+                self.hass.services.async_register.reset_mock()
+                self._setup(loop)
+                handlers = {
+                    call.args[1]: call.args[2] for call in self.hass.services.async_register.call_args_list
+                }
+                call = MagicMock()
+                call.data = { "path": self.test_output_file, "timestamp": entries[0]["timestamp"] }
+                loop.run_until_complete(handlers["restore_backup"](call))
+                with open(self.test_output_file, "r") as f:
+                    self.assertEqual(f.read(), "first")
+                
+            finally:
+                loop.close()
+
+    def test_backup_restore_keeps_mode_and_collects_garbage_on_eviction(self):
+        with suppress_logs():
+            backup_dir = tempfile.mkdtemp()
+            self.addCleanup(lambda: shutil.rmtree(backup_dir, ignore_errors=True))
+            run_config = RunConfigSnapshot({
+                "backup_directory": backup_dir, "backup_retention_count": 2,
+                "backup_retention_days": 0, "backup_max_size_mb": 0,
+            })
+            backup_store = BackupStore(run_config)
+
+            with open(self.test_output_file, "w") as f:
+                f.write("secret: first")
+            os.utime(self.test_output_file, (1700000000, 1700000000))
+            os.chmod(self.test_output_file, 0o600)
+            with patch.object(backup_store, "_collect_garbage", wraps=backup_store._collect_garbage) as collect:
+                entry = backup_store.backup(self.test_output_file)
+                with open(self.test_output_file, "w") as f:
+                    f.write("secret: second")
+                os.utime(self.test_output_file, (1700000000 + 1, 1700000000 + 1))
+                backup_store.backup(self.test_output_file)
+                collect.assert_not_called()
+
+                # The third version evicts the first, whose blob is then collected
+                with open(self.test_output_file, "w") as f:
+                    f.write("secret: third")
+                os.utime(self.test_output_file, (1700000000 + 2, 1700000000 + 2))
+                backup_store.backup(self.test_output_file)
+                collect.assert_called_once()
+            blobs = [name for _, _, files in os.walk(os.path.join(backup_dir, "blobs")) for name in files]
+            self.assertEqual(len(blobs), 2)
+            self.assertNotIn(entry["blob"], blobs)
+
+            os.chmod(self.test_output_file, 0o644)
+            restored = backup_store.entries(self.test_output_file)[0]
+            backup_store.restore(self.test_output_file, restored["timestamp"])
+            with open(self.test_output_file, "r") as f:
+                self.assertEqual(f.read(), "secret: second")
+            self.assertEqual(os.stat(self.test_output_file).st_mode & 0o777, 0o600)
+
+    def test_slow_python_serialize_does_not_block_renders(self):
+        with suppress_logs():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            
+            try:
+                self._setup(loop)
+                loop.run_until_complete(asyncio.sleep(0.1))
+                worker = PreprocessorWorker()
+
+                slow_serialize = os.path.join(self.directories, "slow.py.serialize")
+                slow_output = os.path.join(self.directories, "slow.yaml")
+                with open(os.path.join(self.directories, "slow.tmpl"), "w") as f:
+                    f.write("slow: done")
+                with open(slow_serialize, "w") as f:
+                    f.write(
+                        "import json, time\n"
+                        "time.sleep(2)\n"
+                        "print(json.dumps({'template': 'slow.tmpl', 'outputs': [{'filename': 'slow.yaml'}]}))\n"
+                    )
+                with open(self.test_mako_file, "w") as f:
+                    f.write("key: second")
+
+                with patch.object(worker.reload_worker, "request_reload") as request_reload:
+                    worker.add_files([slow_serialize, self.test_mako_file])
+
+                    deadline = time.time() + 1.5
+                    while time.time() < deadline:
+                        with open(self.test_output_file, "r") as f:
+                            if "key: second" in f.read():
+                                break
+                        time.sleep(0.05)
+                    self._validate_template_output("key: second")
+                    self.assertFalse(os.path.exists(slow_output))
+                    request_reload.assert_not_called()
+
+                    deadline = time.time() + 10
+                    while not os.path.exists(slow_output) and time.time() < deadline:
+                        time.sleep(0.05)
+                    self.assertTrue(os.path.exists(slow_output))
+                    time.sleep(0.2)
+                    request_reload.assert_called_once()
+                
+            finally:
+                loop.close()
+
+    def test_render_timeout_kills_runaway_template(self):
+        with suppress_logs() as logs:
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            
+            try:
+                self.config["render_timeout_secs"] = 2
+                self._setup(loop)
+                loop.run_until_complete(asyncio.sleep(0.1))
+                renderer = PreprocessorWorker().template_renderer
+                deadline = time.time() + 30
+                while not os.path.exists(self.test_output_file) and time.time() < deadline:
+                    time.sleep(0.1)
+                self._validate_template_output()
+                initial_mtime = os.path.getmtime(self.test_output_file)
+
+                with open(self.test_mako_file, "w") as f:
+                    f.write("<% \n    while True:\n        pass\n%>key: never")
+                with PreprocessorWorker.Lock.acquire():
+                    started = time.time()
+                    self.assertEqual(renderer.process_batch([self.test_mako_file]), 0)
+                    self.assertLess(time.time() - started, 15)
+                self.assertIn("MAKO-025", logs.getvalue())
+                self.assertEqual(os.path.getmtime(self.test_output_file), initial_mtime)
+
+                # The killed process is replaced and later renders are unaffected
+                with open(self.test_mako_file, "w") as f:
+                    f.write("key: second")
+                with PreprocessorWorker.Lock.acquire():
+                    self.assertEqual(renderer.process_batch([self.test_mako_file]), 1)
+                self._validate_template_output("key: second")
+                
+            finally:
+                PreprocessorWorker().template_renderer.supervisor.stop()
+                loop.close()
+
+    def test_failing_template_is_not_retried_until_inputs_change(self):
+        with suppress_logs() as logs:
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            
+            try:
+                with open(self.test_mako_file, "w") as f:
+                    f.write("broken: ${constants['missing']}")
+                self.config["failure_backoff_secs"] = 1
+                self._setup(loop)
+                loop.run_until_complete(asyncio.sleep(0.1))
+                renderer = PreprocessorWorker().template_renderer
+                metadata = MetadataManager()
+                self.assertEqual(metadata.get_failure(self.test_mako_file)["attempts"], 1)
+                self.assertEqual(logs.getvalue().count("MAKO-006"), 1)
+
+                # Unchanged inputs are not rendered again
+                with PreprocessorWorker.Lock.acquire():
+                    renderer.process_batch([self.test_mako_file])
+                self.assertEqual(logs.getvalue().count("MAKO-006"), 1)
+
+                # A change is retried at once, repeated failures back off
+                with open(self.test_mako_file, "w") as f:
+                    f.write("broken: ${constants['still_missing']}")
+                with PreprocessorWorker.Lock.acquire():
+                    renderer.process_batch([self.test_mako_file])
+                self.assertEqual(metadata.get_failure(self.test_mako_file)["attempts"], 2)
+                with open(self.test_mako_file, "w") as f:
+                    f.write("key: value")
+                with PreprocessorWorker.Lock.acquire():
+                    self.assertEqual(renderer.process_batch([self.test_mako_file]), 0)
+                    self.assertIn(self.test_mako_file, renderer.pop_deferred_files())
+
+                time.sleep(1.1)
+                with PreprocessorWorker.Lock.acquire():
+                    self.assertEqual(renderer.process_batch([self.test_mako_file]), 1)
+                self._validate_template_output()
+                self.assertIsNone(metadata.get_failure(self.test_mako_file))
+
+                # Only render failures collapse, and the count swallowed in the window is logged when it closes
+                logger = get_logger("RepeatedErrors")
+                for _ in range(3):
+                    logger.error(f"MAKO-999 ❌ {self.test_mako_file}")
+                self.assertEqual(logs.getvalue().count("MAKO-999"), 3)
+                failure_messages = RepeatedMessages(0.5)
+                for _ in range(3):
+                    failure_messages.log(logger, logging.ERROR, self.test_mako_file, f"MAKO-998 ❌ {self.test_mako_file}")
+                self.assertEqual(logs.getvalue().count("MAKO-998"), 1)
+                time.sleep(1)
+                self.assertEqual(logs.getvalue().count("MAKO-998"), 2)
+                self.assertIn("(repeated 2 more times in the last 0.5s)", logs.getvalue())
+                
+            finally:
+                loop.close()
+
+    def test_transient_failures_retry_on_backoff_and_full_runs_retry_all(self):
+        with suppress_logs():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            
+            try:
+                service_flag = os.path.join(self.meta_dir, "service_up")
+                script = os.path.join(self.directories, "service.py.serialize")
+                script_output = os.path.join(self.directories, "service.yaml")
+                with open(os.path.join(self.directories, "service.tmpl"), "w") as f:
+                    f.write("service: up")
+                with open(script, "w") as f:
+                    f.write(
+                        "import json, os, sys\n"
+                        f"if not os.path.exists({service_flag!r}):\n"
+                        "    sys.exit(1)\n"
+                        "print(json.dumps({'template': 'service.tmpl', 'outputs': [{'filename': 'service.yaml'}]}))\n"
+                    )
+                untracked_file = os.path.join(self.meta_dir, "untracked.txt")
+                with open(self.test_mako_file, "w") as f:
+                    f.write(f"key: ${{open({untracked_file!r}).read()}}")
+                self.config["failure_backoff_secs"] = 1
+                self._setup(loop)
+                self.assertTrue(PreprocessorWorker().wait_idle(5))
+                metadata = MetadataManager()
+                self.assertTrue(metadata.get_failure(script)["transient"])
+                self.assertFalse(metadata.get_failure(self.test_mako_file)["transient"])
+
+                # The script is retried once its backoff passes, although none of its inputs changed
+                open(service_flag, "w").close()
+                deadline = time.time() + 5
+                while not os.path.exists(script_output) and time.time() < deadline:
+                    time.sleep(0.05)
+                self.assertTrue(os.path.exists(script_output))
+                self.assertIsNone(metadata.get_failure(script))
+
+                # A template failing on a file it does not track is only retried by a full run
+                with open(untracked_file, "w") as f:
+                    f.write("found")
+                PreprocessorWorker().add_files([self.test_mako_file])
+                self.assertTrue(PreprocessorWorker().wait_idle(5))
+                self.assertEqual(metadata.get_failure(self.test_mako_file)["attempts"], 1)
+                RunPreprocessor(RunConfig()).run()
+                self.assertTrue(PreprocessorWorker().wait_idle(5))
+                self._validate_template_output("key: found")
+                self.assertIsNone(metadata.get_failure(self.test_mako_file))
+                
+            finally:
+                loop.close()
+
+    def test_static_dependencies_recorded_for_failing_templates(self):
+        with suppress_logs():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            
+            try:
+                part_file = os.path.join(self.directories, "part.tmpl")
+                library_file = os.path.join(self.directories, "lib", "macros.tmpl")
+                serialize_template = os.path.join(self.directories, "item.tmpl")
+                serialize_file = os.path.join(self.directories, "items.yaml.serialize")
+                os.makedirs(os.path.dirname(library_file))
+                with open(part_file, "w") as f:
+                    f.write("part: value")
+                with open(library_file, "w") as f:
+                    f.write("<%def name='name()'>item</%def>")
+                with open(serialize_template, "w") as f:
+                    f.write("<%namespace name='macros' file='lib/macros.tmpl'/>\n${macros.name()}: ${variables['value']}")
+                with open(serialize_file, "w") as f:
+                    f.write("template: item.tmpl\noutputs:\n  - filename: items.yaml\n    variables: {value: 1}\n")
+                with open(self.test_mako_file, "w") as f:
+                    f.write("<%include file=\"part.tmpl\"/>\nbroken: ${constants['missing']}")
+
+                self._setup(loop)
+                loop.run_until_complete(asyncio.sleep(0.1))
+
+                metadata = MetadataManager()
+                self.assertFalse(os.path.exists(self.test_output_file))
+                self.assertIn(part_file, metadata.get_static_dependencies(self.test_mako_file))
+                self.assertIn(self.test_mako_file, metadata.get_dependents(part_file))
+                self.assertIn(serialize_file, metadata.get_dependents(library_file))
+                self.assertIn(serialize_file, metadata.get_dependents(serialize_template))
+                
+            finally:
+                loop.close()
+
+    def test_async_setup_runs_services_in_executor(self):
+        with suppress_logs():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            
+            try:
+                self.hass.async_add_executor_job = lambda target, *args: loop.run_in_executor(None, target, *args)
+                background_tasks = []
+                self.hass.async_create_background_task = lambda target, name: background_tasks.append(loop.create_task(target))
+                self.assertTrue(loop.run_until_complete(async_setup(self.hass, { DOMAIN: self.config })))
+                handlers = {
+                    call.args[1]: call.args[2] for call in self.hass.services.async_register.call_args_list
+                }
+                self.assertTrue(all(asyncio.iscoroutinefunction(handler) for handler in handlers.values()))
+
+                # The initial run was started in the background, waiting on the service drains it
+                self.assertEqual(len(background_tasks), 1)
+                call = MagicMock()
+                call.data = { "wait": True }
+                loop.run_until_complete(handlers["run_preprocessor"](call))
+                loop.run_until_complete(asyncio.gather(*background_tasks))
+                self._validate_template_output()
+
+                with open(self.test_mako_file, "w") as f:
+                    f.write("key: second")
+                loop.run_until_complete(handlers["run_preprocessor"](call))
+                self._validate_template_output("key: second")
+                
+            finally:
+                loop.close()
+
+    def test_reload_fires_once_debounce_elapses(self):
+        with suppress_logs():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            
+            try:
+                self.config["run_on_start_ha"] = False
+                self.config["reload_behavior"] = "reload_all"
+                self.config["reload_wait_min_secs"] = 1
+                self._setup(loop)
+                loop.run_until_complete(asyncio.sleep(0.1))
+                reload_worker = PreprocessorWorker(RunConfig()).reload_worker
+                self.hass.services.call.reset_mock()
+
+                # The debounce restarts on the second request, so the reload waits the full delay after it
+                called_at = []
+                self.hass.services.call.side_effect = lambda *args: called_at.append(time.time())
+                reload_worker.request_reload()
+                time.sleep(0.5)
+                second_request = time.time()
+                reload_worker.request_reload()
+                while not called_at and time.time() - second_request < 10:
+                    time.sleep(0.01)
+                time.sleep(0.2)
+                self.hass.services.call.assert_called_once_with("homeassistant", "reload_all")
+                self.assertGreaterEqual(called_at[0] - second_request, 1)
+                self.assertLess(called_at[0] - second_request, 5)
+                
+            finally:
+                loop.close()
+
+    def test_stat_index_emitter_reports_changes(self):
+        with suppress_logs():
+            def age(path):
+                # Leaves the window in which a directory listing cannot be trusted
+                os.utime(path, (1700000000, 1700000000))
+
+            subdir = os.path.join(self.directories, "sub")
+            os.makedirs(subdir)
+            nested_file = os.path.join(subdir, "nested.yaml.mako")
+            with open(nested_file, "w") as f:
+                f.write("a: 1")
+            age(subdir)
+            age(self.directories)
+            emitter = StatIndexEmitter(EventQueue(), ObservedWatch(self.directories, recursive=True))
+            emitter.on_thread_start()
+            self.assertEqual(emitter.poll(), [])
+
+            with open(nested_file, "w") as f:
+                f.write("a: 22")
+            new_dir = os.path.join(self.directories, "new")
+            os.makedirs(new_dir)
+            new_file = os.path.join(new_dir, "new.yaml.mako")
+            with open(new_file, "w") as f:
+                f.write("b: 2")
+            os.remove(self.test_mako_file)
+            events = {(event.event_type, event.src_path) for event in emitter.poll() if not event.is_directory}
+            self.assertEqual(events, {
+                ("modified", nested_file), ("created", new_file), ("deleted", self.test_mako_file),
+            })
+
+            # Listing unchanged directories is skipped, their files are still stat'ed
+            age(new_dir)
+            age(self.directories)
+            emitter.poll()
+            with patch("os.scandir", side_effect=AssertionError("unexpected listing")):
+                with open(new_file, "w") as f:
+                    f.write("b: 33")
+                age(new_dir)
+                events = [(event.event_type, event.src_path) for event in emitter.poll()]
+            self.assertEqual(events, [("modified", new_file)])
+
+    def test_hybrid_observer_polls_network_mounts_inside_local_tree(self):
+        with suppress_logs():
+            share_dir = os.path.join(self.directories, "share")
+            nested_dir = os.path.join(share_dir, "nested")
+            os.makedirs(nested_dir)
+            root = os.path.realpath(self.directories)
+            mounts = [
+                ("/", "ext4"),
+                (os.path.join(root, "share"), "nfs4"),
+                (os.path.join(root, "share", "nested"), "cifs"),
+            ]
+            observer = HybridObserver(interval=1)
+            with patch.object(HybridObserver, "mounts", return_value=mounts):
+                watch = observer.schedule(MagicMock(), self.directories, recursive=True)
+            try:
+                # The local root stays on inotify and only the outermost share below it is polled
+                self.assertIs(observer._owners[watch], observer.native)
+                self.assertEqual([nested.path for nested in observer._nested[watch]], [share_dir])
+                self.assertEqual({emitter.watch.path for emitter in observer.polling.emitters}, {share_dir})
+                observer.unschedule(watch)
+                self.assertFalse(observer.polling.emitters)
+            finally:
+                observer.unschedule_all()
+
+    def test_hot_reload_watches_only_relevant_directories(self):
+        with suppress_logs():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            
+            try:
+                package_dir = os.path.join(self.directories, "packages", "lights")
+                parts_dir = os.path.join(self.directories, "parts")
+                storage_dir = os.path.join(self.directories, ".storage")
+                for directory in (package_dir, parts_dir, storage_dir):
+                    os.makedirs(directory)
+                with open(os.path.join(package_dir, "lights.yaml.mako"), "w") as f:
+                    f.write("lights: on")
+                with open(os.path.join(parts_dir, "part.tmpl"), "w") as f:
+                    f.write("part: value")
+                with open(os.path.join(storage_dir, "core.config"), "w") as f:
+                    f.write("{}")
+                with open(self.test_mako_file, "w") as f:
+                    f.write("<%include file=\"parts/part.tmpl\"/>")
+
+                self.config["hot_reload"] = True
+                self.config["hot_reload_scope"] = "relevant"
+                self._setup(loop)
+                worker = HotReloadWorker(RunConfig())
+                worker.reconfigure()
+                self.assertTrue(PreprocessorWorker().wait_idle(5))
+                worker.refresh_watches()
+
+                self.assertEqual(set(worker.watches), {
+                    self.directories, os.path.dirname(package_dir), package_dir, parts_dir,
+                })
+
+                # New directories are watched as soon as they appear
+                new_dir = os.path.join(self.directories, "new")
+                os.makedirs(new_dir)
+                deadline = time.time() + 3
+                while new_dir not in worker.watches and time.time() < deadline:
+                    time.sleep(0.05)
+                self.assertIn(new_dir, worker.watches)
+                
+            finally:
+                loop.close()
+
+    def test_relevant_scope_sweep_finds_first_source_in_unwatched_directory(self):
+        with suppress_logs():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            
+            try:
+                automations_dir = os.path.join(self.directories, "automations")
+                os.makedirs(automations_dir)
+                with open(os.path.join(automations_dir, "existing.yaml"), "w") as f:
+                    f.write("[]")
+
+                self.config["hot_reload"] = True
+                self.config["hot_reload_scope"] = "relevant"
+                self.config["hot_reload_sweep_secs"] = 1
+                self._setup(loop)
+                self.assertTrue(PreprocessorWorker().wait_idle(5))
+                worker = HotReloadWorker(RunConfig())
+                deadline = time.time() + 3
+                while self.directories not in worker.watches and time.time() < deadline:
+                    time.sleep(0.05)
+                self.assertNotIn(automations_dir, worker.watches)
+
+                # The first template in a directory without one is found by the sweep and watched from then on
+                new_mako_file = os.path.join(automations_dir, "new.yaml.mako")
+                with open(new_mako_file, "w") as f:
+                    f.write("new: automation")
+                new_output_file = os.path.join(automations_dir, "new.yaml")
+                deadline = time.time() + 8
+                while not os.path.exists(new_output_file) and time.time() < deadline:
+                    time.sleep(0.1)
+                self.assertTrue(os.path.exists(new_output_file))
+                self.assertIn(automations_dir, worker.watches)
+                worker.stop()
+                worker.worker_thread.join()
+                
+            finally:
+                loop.close()
+
+    def test_event_storm_switches_to_one_rescan(self):
+        with suppress_logs():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            
+            try:
+                self.config["hot_reload"] = True
+                self.config["hot_reload_delay_secs"] = 1
+                self.config["storm_threshold_events"] = 5
+                self._setup(loop)
+                self.assertTrue(PreprocessorWorker().wait_idle(5))
+                worker = HotReloadWorker(RunConfig())
+
+                # The burst is fed in directly, the observer's own events would race with it
+                with patch.object(worker.handler, "dispatch"):
+                    storm_dir = os.path.join(self.directories, "checkout")
+                    os.makedirs(storm_dir)
+                    sources = []
+                    for index in range(20):
+                        sources.append(os.path.join(storm_dir, f"file{index}.yaml.mako"))
+                        with open(sources[-1], "w") as f:
+                            f.write(f"index: {index}")
+
+                    with patch.object(worker.preprocessor, "schedule_hot_reload", wraps=worker.preprocessor.schedule_hot_reload) as schedule:
+                        for source in sources:
+                            worker.file_changed(source)
+                        # Only the changes before the burst crossed the threshold were scheduled one by one
+                        self.assertEqual(schedule.call_count, 5)
+
+                    deadline = time.time() + 5
+                    while not all(os.path.exists(source[:-len(".mako")]) for source in sources) and time.time() < deadline:
+                        time.sleep(0.05)
+                self.assertTrue(all(os.path.exists(source[:-len(".mako")]) for source in sources))
+                self.assertIsNone(worker.storm_directories)
+                
+            finally:
+                loop.close()
+
+    def test_event_trace_records_watcher_events(self):
+        with suppress_logs():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            
+            try:
+                trace_file = os.path.join(self.meta_dir, "events.jsonl")
+                self.config["hot_reload"] = True
+                self.config["event_trace_file"] = trace_file
+                self._setup(loop)
+                self.assertTrue(PreprocessorWorker().wait_idle(5))
+                worker = HotReloadWorker(RunConfig())
+                deadline = time.time() + 3
+                while worker.trace is None and time.time() < deadline:
+                    time.sleep(0.05)
+
+                probes = []
+                PipelineProbe.listeners.append(lambda kind, now, fields: probes.append((kind, fields)))
+                try:
+                    with open(self.test_mako_file, "w") as f:
+                        f.write("key: traced")
+                    deadline = time.time() + 5
+                    while ("publish", {"output": self.test_output_file}) not in probes and time.time() < deadline:
+                        time.sleep(0.05)
+                finally:
+                    PipelineProbe.listeners.clear()
+                worker.stop()
+                worker.worker_thread.join()
+                self._validate_template_output("key: traced")
+
+                header, events = read_trace(trace_file)
+                self.assertEqual(header["roots"], [self.directories])
+                self.assertIn(("modified", self.test_mako_file), [(event["event"], event["path"]) for event in events])
+                self.assertIn("render", [kind for kind, _ in probes])
+                
+            finally:
+                loop.close()
+
+    def test_event_trace_inside_watched_directory_skips_its_own_writes(self):
+        with suppress_logs():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            
+            try:
+                trace_file = os.path.join(self.directories, "events.jsonl")
+                self.config["hot_reload"] = True
+                self.config["event_trace_file"] = trace_file
+                self._setup(loop)
+                self.assertTrue(PreprocessorWorker().wait_idle(5))
+                worker = HotReloadWorker(RunConfig())
+                deadline = time.time() + 3
+                while worker.trace is None and time.time() < deadline:
+                    time.sleep(0.05)
+
+                fingerprint = MetadataManager().get_fingerprint(self.test_output_file)
+                with open(self.test_mako_file, "w") as f:
+                    f.write("key: traced")
+                deadline = time.time() + 5
+                while MetadataManager().get_fingerprint(self.test_output_file) == fingerprint and time.time() < deadline:
+                    time.sleep(0.05)
+                time.sleep(0.5)
+                _, first_events = read_trace(trace_file)
+                time.sleep(1)
+                _, events = read_trace(trace_file)
+                worker.stop()
+                worker.worker_thread.join()
+
+                self.assertEqual(len(events), len(first_events))
+                self.assertIn(("modified", self.test_mako_file), [(event["event"], event["path"]) for event in events])
+                self.assertNotIn(trace_file, [event["path"] for event in events])
+                self._validate_template_output("key: traced")
+                
+            finally:
+                loop.close()
+
+    def test_lanes_batch_by_render_time_slowest_first(self):
+        with suppress_logs():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            
+            try:
+                self._setup(loop)
+                self.assertTrue(PreprocessorWorker().wait_idle(5))
+                self.assertIsNotNone(MetadataManager().get_render_secs(self.test_mako_file))
+
+                # A lane whose thread has already stopped, so its queue is drained by hand
+                worker = MagicMock()
+                worker.run_config = RunConfigSnapshot({ "batch_size": 50, "batch_budget_secs": 1 })
+                worker.stop_event = threading.Event()
+                worker.stop_event.set()
+                lane = Lane(worker, "budget-test", 0, None)
+                lane.thread.join()
+
+                metadata = MetadataManager()
+                small_files = [os.path.join(self.directories, f"small{index}.yaml.mako") for index in range(15)]
+                big_file = os.path.join(self.directories, "big.yaml.mako")
+                for file_path in small_files:
+                    metadata.record_render_secs(file_path, 0.1)
+                metadata.record_render_secs(big_file, 5)
+                for file_path in small_files + [big_file]:
+                    lane.add_file(file_path)
+
+                batches = []
+                while not lane.queue.empty():
+                    batches.append(lane._collect_batch(lane.queue.get_nowait()))
+                self.assertEqual(batches, [[big_file], small_files[:10], small_files[10:]])
+                self.assertTrue(lane.queued_files.empty())
+                
+            finally:
+                loop.close()
+
+    def test_governor_rate_limits_hot_reload_and_backs_off_on_loop_lag(self):
+        with suppress_logs():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            loop_thread = threading.Thread(target=loop.run_forever, daemon=True)
+            
+            try:
+                self.hass.loop = loop
+                self.config["hot_reload_rate_per_min"] = 60
+                self.config["loop_lag_threshold_ms"] = 100
+                self._setup(loop)
+                self.assertTrue(PreprocessorWorker().wait_idle(5))
+                governor = PreprocessorWorker().governor
+                loop_thread.start()
+
+                # A minute's worth of hot reloads goes straight through, the next one waits for its token
+                governor._buckets.pop("hot_reload", None)
+                delays = [governor.hot_reload_delay() for _ in range(61)]
+                self.assertEqual(max(delays[:60]), 0)
+                self.assertAlmostEqual(delays[60], 1, delta=0.1)
+
+                # A blocked event loop is noticed while the probe is still unanswered, the loop is kept
+                # busy since Home Assistant's blocking call detection refuses time.sleep on it
+                def block_loop():
+                    until = time.monotonic() + 0.8
+                    while time.monotonic() < until:
+                        pass
+                loop.call_soon_threadsafe(block_loop)
+                deadline = time.time() + 0.5
+                while governor.loop_lag() <= 0.1 and time.time() < deadline:
+                    governor.probe()
+                    time.sleep(0.02)
+                self.assertGreater(governor.loop_lag(), 0.1)
+                started = time.monotonic()
+                governor.before_batch(threading.Event())
+                self.assertGreaterEqual(time.monotonic() - started, 0.5)
+
+                # Batches run without pausing once the loop answers promptly again
+                deadline = time.time() + 3
+                while governor.loop_lag() > 0.1 and time.time() < deadline:
+                    governor.probe()
+                    time.sleep(0.05)
+                started = time.monotonic()
+                governor.before_batch(threading.Event())
+                self.assertLess(time.monotonic() - started, 0.1)
+                
+            finally:
+                loop.call_soon_threadsafe(loop.stop)
+                loop_thread.join()
+                loop.close()
+
+    def test_governor_charges_process_wide_usage_and_nices_render_helpers(self):
+        with suppress_logs():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            
+            try:
+                script = os.path.join(self.directories, "nice.py.serialize")
+                with open(os.path.join(self.directories, "nice.tmpl"), "w") as f:
+                    f.write("script: ${variables['nice']} pool: ${__import__('os').getpriority(0, __import__('threading').get_native_id())}")
+                with open(script, "w") as f:
+                    f.write(
+                        "import json, os\n"
+                        "outputs = [{'filename': name, 'variables': {'nice': os.getpriority(os.PRIO_PROCESS, 0)}} for name in ('nice1.yaml', 'nice2.yaml')]\n"
+                        "print(json.dumps({'template': 'nice.tmpl', 'outputs': outputs}))\n"
+                    )
+                self.config["cpu_share"] = 1
+                self.config["render_nice"] = 5
+                self.config["serialize_workers"] = 2
+                self._setup(loop)
+                worker = PreprocessorWorker()
+                self.assertTrue(worker.wait_idle(5))
+
+                # Scripts and the pool threads rendering their outputs run at the configured niceness
+                for name in ("nice1.yaml", "nice2.yaml"):
+                    with open(os.path.join(self.directories, name)) as f:
+                        self.assertIn("script: 5 pool: 5", f.read())
+
+                # CPU spent by child processes is charged, and only once when charges overlap
+                governor = worker.governor
+                bucket = governor._bucket("cpu", 1, 5)
+                usage = governor.usage()
+                subprocess.run([sys.executable, "-c", "import time\nuntil = time.process_time() + 0.5\nwhile time.process_time() < until: pass"])
+                governor.charge(usage)
+                self.assertLess(bucket._tokens, 4.7)
+                tokens = bucket._tokens
+                governor.charge(usage)
+                self.assertGreater(bucket._tokens, tokens - 0.1)
+                
+            finally:
+                loop.close()
+
+    def test_governor_probes_event_loop_only_while_busy(self):
+        with suppress_logs():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            
+            try:
+                self.config["loop_lag_threshold_ms"] = 100
+                self._setup(loop)
+                worker = PreprocessorWorker()
+                self.assertTrue(worker.wait_idle(5))
+                governor = worker.governor
+                time.sleep(1.2)
+                self.assertFalse(governor._probing)
+
+                with patch.object(governor, "probe") as probe:
+                    time.sleep(1.2)
+                    probe.assert_not_called()
+
+                    # Work arriving at an idle pipeline starts the probes, holding it busy keeps them going
+                    worker._track_work(1)
+                    deadline = time.time() + 2
+                    while not probe.called and time.time() < deadline:
+                        time.sleep(0.05)
+                    probe.assert_called()
+                    worker._track_work(-1)
+                    time.sleep(1.2)
+                    self.assertFalse(governor._probing)
+
+                    # A threshold of 0 turns the probes off altogether
+                    probe.reset_mock()
+                    RunConfig().loop_lag_threshold_ms = 0
+                    worker._track_work(1)
+                    time.sleep(0.3)
+                    worker._track_work(-1)
+                    probe.assert_not_called()
+                
+            finally:
+                loop.close()
+
+    def test_stat_cache_lists_batch_directories_once(self):
+        with suppress_logs():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            
+            try:
+                files = [os.path.join(self.directories, f"stat{index}.yaml.mako") for index in range(5)]
+                for file_path in files:
+                    with open(file_path, "w") as f:
+                        f.write("value: 1\n")
+                missing_file = os.path.join(self.directories, "missing.yaml.mako")
+
+                # The batch directory is listed once, stats of listed or absent files never reach os.stat
+                with patch("os.stat", side_effect=AssertionError("unexpected stat")):
+                    with StatCache.batch(files):
+                        for file_path in files:
+                            self.assertEqual(StatCache.getmtime(file_path), StatCache.getmtime(file_path))
+                        self.assertFalse(StatCache.exists(missing_file))
+
+                with StatCache.batch(files):
+                    mtime = StatCache.getmtime(files[0])
+                    os.utime(files[0], (mtime + 10, mtime + 10))
+                    with open(missing_file, "w") as f:
+                        f.write("value: 2\n")
+                    self.assertEqual(StatCache.getmtime(files[0]), mtime)
+                    self.assertFalse(StatCache.exists(missing_file))
+                    # The preprocessor's own writes are forgotten and stat'ed again
+                    StatCache.forget(files[0])
+                    StatCache.forget(missing_file)
+                    self.assertEqual(StatCache.getmtime(files[0]), mtime + 10)
+                    self.assertTrue(StatCache.exists(missing_file))
+                self.assertIsNone(StatCache.current())
+
+                self._setup(loop)
+                self.assertTrue(PreprocessorWorker().wait_idle(5))
+                for file_path in files:
+                    self.assertTrue(os.path.exists(file_path[:-len(".mako")]))
+                    self.assertEqual(MetadataManager().get(file_path), os.path.getmtime(file_path))
+                
+            finally:
+                loop.close()
+
 if __name__ == "__main__":
     runner = unittest.TextTestRunner()
     suite = unittest.TestLoader().loadTestsFromTestCase(TestSetup)